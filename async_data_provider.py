@@ -0,0 +1,378 @@
+from dns_client.adapters.requests import DNSClientSession
+from psycopg.conninfo import make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
+from data_provider import (dbname, user, password, host, pool_min, pool_max, pool_timeout, query_log_batch, query_log_interval,
+                           query_links, query_ids_query, query_record, query_log_rows, query_rollup_by_ids,
+                           list_table, movie_from_row, movies_from_list_query, search_movies_query,
+                           params_page_query, params_page, suggest_query,
+                           search_movies_page_query, movies_page_from_rows,
+                           LookupCache, PosterCache, lookup_queries, lookup_by_ids_query, lookup_names,
+                           preferences_query, recommender_movies_query, recommender_relation_queries, recommender_ttl,
+                           compilation_size, movies_by_ids_query, movies_in_order, neighbours_query, neighbours_weight,
+                           set_movie_score_query, precomputed_recommendations_query, store_recommendation_query,
+                           invalidate_recommendations_query, recommendation_cache_ttl, recommendation_cache_size, recommendation_workers,
+                           movie_signature_query, similar_candidates_query, similar_movies_count,
+                           score_weight, old_score_query, user_profile_query, profile_lock_query, profile_delta_statements, user_profile)
+from collections import OrderedDict
+from recommender import ContentRecommender
+from similarity import rank_similar, signature_from_bytes
+import asyncio, psycopg, time, traceback
+
+class AsyncQueryLogBuffer:
+    """Асинхронный вариант QueryLogBuffer: сброс выполняется фоновой задачей в цикле событий бота."""
+    def __init__(self, flush, max_size: int = query_log_batch, interval: float = query_log_interval):
+        self.max_size = max_size
+        self.interval = interval
+        self.__flush = flush
+        self.__records: list[dict] = []
+        self.__wakeup = asyncio.Event()
+        self.__closed = False
+        self.__task: asyncio.Task = None
+
+    def start(self):
+        if self.__task is None:
+            self.__task = asyncio.create_task(self.__run())
+
+    def add(self, record: dict):
+        self.__records.append(record)
+        if len(self.__records) >= self.max_size:
+            self.__wakeup.set()
+
+    async def close(self):
+        self.__closed = True
+        self.__wakeup.set()
+        if self.__task is not None:
+            await self.__task
+            self.__task = None
+        await self.drain()
+
+    async def drain(self):
+        records, self.__records = self.__records, []
+        if not records:
+            return
+        try:
+            await self.__flush(records)
+        except Exception:
+            print(traceback.format_exc())
+            self.__records = (records + self.__records)[-self.max_size * 10:]
+
+    async def __run(self):
+        while not self.__closed:
+            try:
+                await asyncio.wait_for(self.__wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self.__wakeup.clear()
+            await self.drain()
+
+class RecommendationCache:
+    """Персональные подборки пользователей в памяти бота. Устаревшая или сброшенная подборка отдаётся сразу,
+    а новая считается фоновой задачей (stale-while-revalidate); одновременно считается не больше workers подборок."""
+    def __init__(self, compute, ttl: float = recommendation_cache_ttl, max_size: int = recommendation_cache_size,
+                 workers: int = recommendation_workers):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.__compute = compute
+        self.__semaphore = asyncio.Semaphore(workers)
+        # user_id -> (время расчёта, версия данных пользователя на момент расчёта, подборка)
+        self.__entries: OrderedDict[int, tuple[float, int, list[dict]]] = OrderedDict()
+        self.__versions: dict[int, int] = {}
+        self.__tasks: dict[int, asyncio.Task] = {}
+
+    async def get(self, user_id: int) -> list[dict]:
+        entry = self.__entries.get(user_id)
+        if entry is None:
+            # shield: отмена обработчика не должна прерывать расчёт, который ждут и другие нажатия
+            return await asyncio.shield(self.__refresh(user_id))
+        self.__entries.move_to_end(user_id)
+        computed_at, version, movies = entry
+        if version != self.__versions.get(user_id, 0) or time.monotonic() - computed_at > self.ttl:
+            self.__refresh(user_id)
+        return movies
+
+    def invalidate(self, user_id: int):
+        """Оценки или избранное пользователя изменились: подборка пересчитывается в фоне."""
+        self.__versions[user_id] = self.__versions.get(user_id, 0) + 1
+        if user_id in self.__entries:
+            self.__refresh(user_id)
+
+    async def close(self):
+        tasks = list(self.__tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def __refresh(self, user_id: int) -> asyncio.Task:
+        # Повторные нажатия во время расчёта ждут уже запущенную задачу
+        task = self.__tasks.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self.__compute_entry(user_id))
+            self.__tasks[user_id] = task
+            task.add_done_callback(lambda _: self.__tasks.pop(user_id, None))
+        return task
+
+    async def __compute_entry(self, user_id: int) -> list[dict]:
+        version = self.__versions.get(user_id, 0)
+        try:
+            async with self.__semaphore:
+                movies = await self.__compute(user_id)
+        except Exception:
+            print(traceback.format_exc())
+            entry = self.__entries.get(user_id)
+            return entry[2] if entry else []
+        self.__entries[user_id] = (time.monotonic(), version, movies)
+        self.__entries.move_to_end(user_id)
+        while len(self.__entries) > self.max_size:
+            evicted, _ = self.__entries.popitem(last=False)
+            self.__versions.pop(evicted, None)
+        return movies
+
+class AsyncDataProvider:
+    """Асинхронный аналог DataProvider для бота: запросы выполняются через собственный пул psycopg,
+    не блокируя цикл событий aiogram."""
+    def __init__(self, min_size: int = pool_min, max_size: int = pool_max):
+        self.session = DNSClientSession('9.9.9.9')
+        self.pool = AsyncConnectionPool(
+            make_conninfo(dbname=dbname, user=user, password=password, host=host),
+            min_size=min_size,
+            max_size=max_size,
+            timeout=pool_timeout,
+            check=AsyncConnectionPool.check_connection,
+            kwargs={'autocommit': True, 'row_factory': dict_row},
+            open=False
+        )
+        self.query_log = AsyncQueryLogBuffer(self.__flush_queries)
+        self.lookups = LookupCache()
+        self.__posters: PosterCache = None
+        self.__recommender: ContentRecommender = None
+        self.__recommender_built_at = 0.0
+        self.__recommender_lock = asyncio.Lock()
+        self.recommendations = RecommendationCache(self.compute_personal_recommendations)
+
+    async def open(self):
+        await self.pool.open()
+        self.query_log.start()
+
+    async def close(self):
+        await self.recommendations.close()
+        await self.query_log.close()
+        await self.pool.close()
+
+    # Каталог обложек создаётся при первом обращении, а не при запуске бота
+    @property
+    def posters(self) -> PosterCache:
+        if self.__posters is None:
+            self.__posters = PosterCache()
+        return self.__posters
+
+    async def db_request(self, query: str, get: bool = True, params = None):
+        async with self.pool.connection() as conn:
+            try:
+                cursor = await conn.execute(query, params)
+            except psycopg.errors.UniqueViolation:
+                return [] if get else None
+            if get:
+                return await cursor.fetchall()
+
+    async def get_image_bin(self, image_path: str):
+        cached = await asyncio.to_thread(self.posters.get, image_path)
+        if cached is not None:
+            return cached
+        response = await asyncio.to_thread(self.session.get, image_path, stream=True, timeout=20)
+        if response.ok:
+            await asyncio.to_thread(self.posters.put, image_path, response.content)
+        return response.content
+
+    async def search_movies(self, **filters) -> list[dict]:
+        query, params = search_movies_query(**filters)
+        rows = await self.db_request(query, params=params)
+        return [movie_from_row(row) for row in rows]
+
+    async def search_movies_page(self, page_size: int = 10, cursor: str = None, **filters) -> tuple[list[dict], str | None]:
+        query, params = search_movies_page_query(page_size, cursor, **filters)
+        rows = await self.db_request(query, params=params)
+        return movies_page_from_rows(rows, page_size, filters.get('order_by'))
+
+    async def get_movies_from_list(self, user_id: int, list_name: str) -> list[dict]:
+        query, params = movies_from_list_query(user_id, list_name)
+        rows = await self.db_request(query, params=params)
+        return [movie_from_row(row) for row in rows]
+
+    async def lookup(self, table: str, ids: list[int] = ()) -> dict[int, dict]:
+        values = self.lookups.get(table)
+        if values is None:
+            values = self.lookups.put(table, await self.db_request(lookup_queries[table]))
+        missing = self.lookups.missing(table, ids)
+        if missing:
+            values = self.lookups.add(table, missing, await self.db_request(lookup_by_ids_query(table), params=(missing,)))
+        return values
+
+    async def warm_up_lookups(self):
+        for table in lookup_queries:
+            await self.lookup(table)
+
+    async def get_actor_names(self, actor_ids: list[int]) -> list[str]:
+        if not actor_ids:
+            return []
+        return lookup_names(await self.lookup('actors', actor_ids), actor_ids)
+
+    async def get_director_name(self, director_id: int) -> str:
+        if director_id:
+            return (await self.lookup('directors', [director_id])).get(director_id, {}).get('name')
+
+    async def get_country_name(self, country_id: int = None, alpha2: str = None):
+        if country_id:
+            return (await self.lookup('countries', [country_id])).get(country_id, {}).get('name')
+        elif alpha2:
+            countries = await self.lookup('countries')
+            return next((country['id'] for country in countries.values() if country['alpha2'] == alpha2), None)
+
+    async def get_genre_names(self, genre_ids: list[int]) -> list[str]:
+        if not genre_ids:
+            return []
+        return lookup_names(await self.lookup('genres', genre_ids), genre_ids)
+
+    async def get_keyword_names(self, keyword_ids: list[int]) -> list[str]:
+        if not keyword_ids:
+            return []
+        return lookup_names(await self.lookup('keywords', keyword_ids), keyword_ids)
+
+    async def add_to_list(self, user_id: int, movie_id: int, list_name: str):
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                await conn.execute(profile_lock_query, (user_id,))
+                cursor = await conn.execute(f"INSERT INTO {list_table(list_name)} (user_id, movie_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (user_id, movie_id))
+                added = cursor.rowcount > 0
+                if list_name == 'favorite_movies' and added:
+                    for statement, params in profile_delta_statements(user_id, movie_id, 1):
+                        await conn.execute(statement, params)
+        if list_name == 'favorite_movies' and added:
+            await self.invalidate_recommendations(user_id)
+
+    async def remove_from_list(self, user_id: int, movie_id: int, list_name: str):
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                await conn.execute(profile_lock_query, (user_id,))
+                cursor = await conn.execute(f"DELETE FROM {list_table(list_name)} WHERE user_id = %s AND movie_id = %s", (user_id, movie_id))
+                removed = cursor.rowcount > 0
+                if list_name == 'favorite_movies' and removed:
+                    for statement, params in profile_delta_statements(user_id, movie_id, -1):
+                        await conn.execute(statement, params)
+        if list_name == 'favorite_movies' and removed:
+            await self.invalidate_recommendations(user_id)
+
+    async def is_in_list(self, user_id: int, movie_id: int, list_name: str) -> bool:
+        result = await self.db_request(f"SELECT 1 FROM {list_table(list_name)} WHERE user_id = %s AND movie_id = %s", params=(user_id, movie_id))
+        return bool(result)
+
+    async def get_params_by_page(self, param_name: str, after: list = None, page_len: int = 10) -> tuple[list[dict], list | None]:
+        query, params = params_page_query(param_name, after, page_len)
+        return params_page(await self.db_request(query, params=params), page_len)
+
+    async def suggest(self, table: str, text: str, limit: int = 10) -> list[dict]:
+        query, params = suggest_query(table, text, limit)
+        return await self.db_request(query, params=params)
+
+    async def set_movie_score(self, user_id: int, movie_id: int, score: int):
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                await conn.execute(profile_lock_query, (user_id,))
+                cursor = await conn.execute(old_score_query, (user_id, movie_id))
+                old_score = await cursor.fetchone()
+                await conn.execute(set_movie_score_query, (user_id, movie_id, score))
+                delta = score_weight(score) - score_weight(old_score['score'] if old_score else None)
+                for statement, params in profile_delta_statements(user_id, movie_id, delta):
+                    await conn.execute(statement, params)
+        await self.invalidate_recommendations(user_id)
+
+    async def get_movie_score(self, movie_id: int, user_id: int):
+        result = await self.db_request("SELECT score FROM movies_scores WHERE user_id = %s AND movie_id = %s", params=(user_id, movie_id))
+        if bool(result):
+            return result[0].get('score')
+        return 0
+
+    async def get_movie_rating(self, movie_id: int):
+        result = await self.db_request("SELECT rating FROM movies WHERE id = %s", params=(movie_id,))
+        if bool(result):
+            return result[0].get('rating')
+        return 0
+
+    async def update_query(self, user_id, film_name, lower_date, upper_date, film_release_country, director, date, actors, genres, genres_no, keywords, keywords_no):
+        self.query_log.add(query_record(user_id, film_name, lower_date, upper_date, film_release_country, director, date,
+                                        actors, genres, genres_no, keywords, keywords_no))
+
+    async def __flush_queries(self, records: list[dict]):
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                cursor = await conn.execute(query_ids_query, (len(records),))
+                query_ids = [row['id'] for row in await cursor.fetchall()]
+                queries, links = query_log_rows(records, query_ids)
+                async with conn.cursor() as cursor:
+                    for columns, rows in queries.items():
+                        async with cursor.copy(f"COPY queries ({', '.join(columns)}) FROM STDIN") as copy:
+                            for row in rows:
+                                await copy.write_row(row)
+                    for table, column, _ in query_links:
+                        if links[table]:
+                            async with cursor.copy(f"COPY {table} (query_id, {column}) FROM STDIN") as copy:
+                                for row in links[table]:
+                                    await copy.write_row(row)
+                    for statement in query_rollup_by_ids:
+                        await cursor.execute(statement, {'ids': query_ids})
+
+    async def content_recommender(self) -> ContentRecommender:
+        async with self.__recommender_lock:
+            if self.__recommender is None or time.monotonic() - self.__recommender_built_at > recommender_ttl:
+                movies = await self.db_request(recommender_movies_query)
+                relations = {feature_type: await self.db_request(query) for feature_type, query in recommender_relation_queries.items()}
+                # Построение матрицы занимает заметное время, поэтому выполняется вне цикла событий
+                self.__recommender = await asyncio.to_thread(ContentRecommender.from_rows, movies, relations)
+                self.__recommender_built_at = time.monotonic()
+            return self.__recommender
+
+    async def get_movies_by_ids(self, movie_ids: list[int]) -> list[dict]:
+        if not movie_ids:
+            return []
+        query, params = movies_by_ids_query(movie_ids)
+        return movies_in_order(await self.db_request(query, params=params), movie_ids)
+
+    async def similar_movies(self, movie_id: int, k: int = similar_movies_count) -> list[dict]:
+        rows = await self.db_request(movie_signature_query, params=(movie_id,))
+        if not rows:
+            return []
+        candidates = await self.db_request(similar_candidates_query, params={'movie_id': movie_id})
+        similar_ids = rank_similar(signature_from_bytes(rows[0]['signature']), [(row['movie_id'], row['signature']) for row in candidates], k)
+        return await self.get_movies_by_ids(similar_ids)
+
+    async def get_personal_recommendations(self, user_id: int, k: int = compilation_size) -> list[dict]:
+        # В кэше бота подборки размера compilation_size; более длинная считается напрямую
+        if k > compilation_size:
+            return await self.compute_personal_recommendations(user_id, k)
+        return (await self.recommendations.get(user_id))[:k]
+
+    async def invalidate_recommendations(self, user_id: int):
+        await self.db_request(invalidate_recommendations_query, False, (user_id,))
+        self.recommendations.invalidate(user_id)
+
+    async def compute_personal_recommendations(self, user_id: int, k: int = compilation_size) -> list[dict]:
+        """Подборка, заранее посчитанная recommend_batch.py, или расчёт на месте с сохранением результата.
+        Сохранённая подборка короче k считается заново."""
+        rows = await self.db_request(precomputed_recommendations_query, params=(user_id,))
+        if rows and len(rows[0]['movie_ids']) >= k:
+            return await self.get_movies_by_ids(rows[0]['movie_ids'][:k])
+
+        recommender = await self.content_recommender()
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                cursor = await conn.execute(preferences_query, (user_id, user_id))
+                movie_ids = [row['movie_id'] for row in await cursor.fetchall()]
+                recommended_ids = []
+                if movie_ids:
+                    cursor = await conn.execute(user_profile_query, (user_id,))
+                    profile = user_profile(recommender, await cursor.fetchall(), movie_ids)
+                    cursor = await conn.execute(neighbours_query, (movie_ids,))
+                    neighbours = {row['neighbour_id']: row['score'] for row in await cursor.fetchall()}
+                    recommended_ids = recommender.recommend(profile, k, movie_ids, neighbours, neighbours_weight)
+                await conn.execute(store_recommendation_query, (user_id, recommended_ids))
+        return await self.get_movies_by_ids(recommended_ids)
@@ -0,0 +1,95 @@
+"""Сравнение старого запроса поиска (соединение всех связей + GROUP BY) с текущим
+search_movies_query на синтетическом каталоге во временной схеме.
+
+    python bench_search.py --movies 20000 --repeat 5
+"""
+from contextlib import closing
+from data_provider import dbname, user, password, host, search_movies_query
+import argparse, psycopg2, psycopg2.extras, statistics, time
+
+schema = 'bench_search'
+
+legacy_query = """
+    SELECT m.id, m.name, m.release_date, m.release_country, m.poster_link, m.rating, m.revenue, m.runtime, m.director, m.overview,
+        array_agg(DISTINCT a.id) AS actors,
+        array_agg(DISTINCT g.id) AS genres,
+        array_agg(DISTINCT k.id) AS keywords
+    FROM movies m
+    LEFT JOIN movies_actors ma ON m.id = ma.movie_id
+    LEFT JOIN actors a ON ma.actor_id = a.id
+    LEFT JOIN movies_genres mg ON m.id = mg.movie_id
+    LEFT JOIN genres g ON mg.genre_id = g.id
+    LEFT JOIN movies_keywords mk ON m.id = mk.movie_id
+    LEFT JOIN keywords k ON mk.keyword_id = k.id
+    WHERE m.id IN (SELECT movie_id FROM movies_genres WHERE genre_id = ANY(%s))
+    GROUP BY m.id
+    ORDER BY m.rating DESC
+"""
+
+def create_catalog(cursor, movies: int, actors: int, genres: int, keywords: int):
+    cursor.execute(f"""
+        DROP SCHEMA IF EXISTS {schema} CASCADE;
+        CREATE SCHEMA {schema};
+        SET search_path TO {schema};
+        CREATE TABLE actors (id serial PRIMARY KEY, name text, surname text);
+        CREATE TABLE genres (id serial PRIMARY KEY, name text);
+        CREATE TABLE keywords (id serial PRIMARY KEY, name text);
+        CREATE TABLE movies (id serial PRIMARY KEY, name text, release_date date, release_country int, poster_link text,
+                             rating real, revenue bigint, runtime int, director int, overview text);
+        CREATE TABLE movies_actors (movie_id int, actor_id int, PRIMARY KEY (movie_id, actor_id));
+        CREATE TABLE movies_genres (movie_id int, genre_id int, PRIMARY KEY (movie_id, genre_id));
+        CREATE TABLE movies_keywords (movie_id int, keyword_id int, PRIMARY KEY (movie_id, keyword_id));
+        CREATE INDEX ON movies_genres (genre_id);
+
+        INSERT INTO actors (name, surname) SELECT 'Имя' || i, 'Фамилия' || i FROM generate_series(1, {actors}) i;
+        INSERT INTO genres (name) SELECT 'жанр ' || i FROM generate_series(1, {genres}) i;
+        INSERT INTO keywords (name) SELECT 'слово ' || i FROM generate_series(1, {keywords}) i;
+        INSERT INTO movies (name, release_date, release_country, poster_link, rating, revenue, runtime, director, overview)
+        SELECT 'Фильм ' || i, DATE '1950-01-01' + (random() * 27000)::int, 1, 'https://example.org/' || i,
+               random() * 10, (random() * 1e9)::bigint, 80 + (random() * 100)::int, 1, repeat('описание ', 50)
+        FROM generate_series(1, {movies}) i;
+        INSERT INTO movies_actors SELECT DISTINCT m, 1 + (random() * ({actors} - 1))::int FROM generate_series(1, {movies}) m, generate_series(1, 30);
+        INSERT INTO movies_genres SELECT DISTINCT m, 1 + (random() * ({genres} - 1))::int FROM generate_series(1, {movies}) m, generate_series(1, 4);
+        INSERT INTO movies_keywords SELECT DISTINCT m, 1 + (random() * ({keywords} - 1))::int FROM generate_series(1, {movies}) m, generate_series(1, 25);
+        ANALYZE;
+    """)
+
+def measure(cursor, query: str, params, repeat: int) -> tuple[float, int]:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        cursor.execute(query, params)
+        rows = cursor.fetchall()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), len(rows)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--movies', type=int, default=20000)
+    parser.add_argument('--actors', type=int, default=50000)
+    parser.add_argument('--genres', type=int, default=20)
+    parser.add_argument('--keywords', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--keep', action='store_true', help='не удалять схему с каталогом после замеров')
+    args = parser.parse_args()
+
+    with closing(psycopg2.connect(dbname=dbname, user=user, password=password, host=host)) as conn:
+        conn.autocommit = True
+        with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+            create_catalog(cursor, args.movies, args.actors, args.genres, args.keywords)
+            try:
+                # Широкий запрос "все фильмы жанра по рейтингу"
+                genre_ids = [1]
+                query, params = search_movies_query(genres_included=genre_ids, order_by='rating', order_dir='DESC')
+                legacy_time, legacy_rows = measure(cursor, legacy_query, (genre_ids,), args.repeat)
+                current_time, current_rows = measure(cursor, query, params, args.repeat)
+                print(f'каталог: {args.movies} фильмов, найдено {current_rows} (старый запрос: {legacy_rows})')
+                print(f'соединение + GROUP BY: {legacy_time * 1000:.1f} мс')
+                print(f'подзапросы ARRAY():    {current_time * 1000:.1f} мс')
+                print(f'ускорение: x{legacy_time / current_time:.1f}')
+            finally:
+                if not args.keep:
+                    cursor.execute(f'DROP SCHEMA {schema} CASCADE')
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,4 @@
-from data_provider import DataProvider
+from async_data_provider import AsyncDataProvider
 from bot import bot
 from PIL import Image
 import io, re
@@ -24,7 +24,9 @@ PARAMETER_TRANSLATIONS = {
 }
 
 router = Router()
-data_provider = DataProvider()
+data_provider = AsyncDataProvider()
+
+search_page_size = 10
 
 sort_by: dict[str, str] = {'rating': 'Рейтинг', 'release_date': 'Дата выхода', 'revenue': 'Сумма сборов'}
 sort_in: dict[str, str] = {'DESC': 'по убыванию', 'ASC': 'по возрастанию'}
@@ -71,8 +73,8 @@ async def delete_message(message: Message):
 @router.message(CommandStart())
 async def command_start_handler(message: Message, state: FSMContext):
         user_id = message.from_user.id
-        if not data_provider.db_request(f'SELECT * FROM users WHERE id = {user_id}'):
-            data_provider.db_request(f'INSERT INTO users VALUES ({user_id})')
+        if not await data_provider.db_request('SELECT * FROM users WHERE id = %s', params=(user_id,)):
+            await data_provider.db_request('INSERT INTO users VALUES (%s)', False, (user_id,))
         data = await state.get_data()
         message_id = data.get('menu_message_id')
         if message_id is None:
@@ -265,7 +267,7 @@ async def select_parameter(call: CallbackQuery, state: FSMContext):
     try:
         param_type = call.data.split('_')[1]
         
-        await state.update_data(param_type=param_type)
+        await state.update_data(param_type=param_type, param_cursors=[None], param_next_cursor=None)
         await state.set_state(States.enter_param)
 
         await show_parameter_page(call, state)
@@ -335,42 +337,65 @@ async def enter_parameter_value(message: Message, state: FSMContext):
         menu_message_id = data.get('menu_message_id')
         param_value = message.text
         await bot.delete_message(user_id, menu_message_id)
-        items = data_provider.get_params_by_page(param_type.split('-')[0], get_all=True)
-
-        exists = param_value in [item.get('name') for item in items]
-        if exists:
-            item = next(({'id': item['id'], 'name': item['name']} for item in items if item['name'] == param_value), None)
-            if item:
-                await select_item(param_type, {item['id']: item['name']}, state)
-                await show_parameter_page(message, state, param_value)
-        else:
-            relevant_items = []
+        items = await data_provider.suggest(param_type.split('-')[0], param_value)
+
+        # Точное совпадение suggest возвращает первым
+        if items and items[0]['name'] == param_value:
+            item = items[0]
+            await select_item(param_type, {item['id']: item['name']}, state)
+            await show_parameter_page(message, state, param_value)
+        elif items:
+            buttons = []
             for item in items:
-                if param_value.lower() in item['name'].lower():
-                    relevant_items.append(item)
-
-            if relevant_items:
-                buttons = []
-                for item in relevant_items:
-                    buttons.append([
-                        InlineKeyboardButton(
-                            text=item['name'],
-                            callback_data=f"select_{param_type}_{item['id']}_{item['name']}"
-                        )
-                    ])
-                buttons.append([InlineKeyboardButton(text='↩️ Вернуться к выбору параметра', callback_data='search')])
-
-                markup = InlineKeyboardMarkup(inline_keyboard=buttons)
-                await send_message(
-                    user_id,
-                    f'Найдены следующие варианты для параметра "{PARAMETER_TRANSLATIONS.get(param_type, param_type)}":',
-                    markup
-                )
-            else:
-                await send_message(user_id, "Указанное значение не найдено.")
+                buttons.append([
+                    InlineKeyboardButton(
+                        text=item['name'],
+                        callback_data=f"select_{param_type}_{item['id']}_{item['name']}"
+                    )
+                ])
+            buttons.append([InlineKeyboardButton(text='↩️ Вернуться к выбору параметра', callback_data='search')])
+
+            markup = InlineKeyboardMarkup(inline_keyboard=buttons)
+            await send_message(
+                user_id,
+                f'Найдены следующие варианты для параметра "{PARAMETER_TRANSLATIONS.get(param_type, param_type)}":',
+                markup
+            )
+        else:
+            await send_message(user_id, "Указанное значение не найдено.")
     except Exception:
         await handle_error(message, state)
 
+def get_search_filters(search_params: dict) -> dict:
+    director_dict = search_params.get('director', {})
+    country_dict = search_params.get('country', {})
+    return {
+        'genres_included': list(search_params.get('genres', {}).keys()),
+        'genres_excluded': list(search_params.get('genres-no', {}).keys()),
+        'keywords_included': list(search_params.get('keywords', {}).keys()),
+        'keywords_excluded': list(search_params.get('keywords-no', {}).keys()),
+        'actors': list(search_params.get('actors', {}).keys()),
+        'director': next(iter(director_dict.keys()), None) if director_dict else None,
+        'title_part': search_params.get('name'),
+        'country': next(iter(country_dict.keys()), None) if country_dict else None,
+        'release_date_gte': search_params.get('date_gte', '1895-12-28'),
+        'release_date_lte': search_params.get('date_lte', '2026-12-12'),
+        'order_by': search_params.get('sort_by', 'id'),
+        'order_dir': search_params.get('sort_in', 'DESC')
+    }
+
+async def set_movies(state: FSMContext, movies: list[dict], current_index: int = 0, page_cursors: list = None, next_cursor: str = None, search_filters: dict = None):
+    """Сохраняет текущую страницу фильмов. Для результатов поиска также запоминаются фильтры и курсоры
+    загруженных страниц, чтобы подгружать соседние страницы по требованию."""
+    await state.update_data(
+        movies=movies,
+        current_index=current_index,
+        movie_photos={},
+        page_cursors=page_cursors or [],
+        next_cursor=next_cursor,
+        search_filters=search_filters
+    )
+
 @router.callback_query(F.data == 'start_search')
 async def start_search(call: CallbackQuery, state: FSMContext):
     await delete_message(call.message)
@@ -378,50 +403,28 @@ async def start_search(call: CallbackQuery, state: FSMContext):
         user_id = call.from_user.id
         data = await state.get_data()
         search_params = data.get('search_params', {})
+        search_filters = get_search_filters(search_params)
 
-        genres_included = list(search_params.get('genres', {}).keys())
-        genres_excluded = list(search_params.get('genres-no', {}).keys())
-        keywords_included = list(search_params.get('keywords', {}).keys())
-        keywords_excluded = list(search_params.get('keywords-no', {}).keys())
-        actors = list(search_params.get('actors', {}).keys())
-        director_dict = search_params.get('director', {})
-        director = next(iter(director_dict.keys()), None) if director_dict else None
-        country_dict = search_params.get('country', {})
-        country = next(iter(country_dict.keys()), None) if country_dict else None
-
-        movies = data_provider.search_movies(
-            genres_included=genres_included,
-            genres_excluded=genres_excluded,
-            keywords_included=keywords_included,
-            keywords_excluded=keywords_excluded,
-            actors=actors,
-            director=director,
-            title_part=search_params.get('name'),
-            country=country,
-            release_date_gte=search_params.get('date_gte', '1895-12-28'),
-            release_date_lte=search_params.get('date_lte', '2026-12-12'),
-            order_by=search_params.get('sort_by', 'id'),
-            order_dir=search_params.get('sort_in', 'DESC')
-        )
+        movies, next_cursor = await data_provider.search_movies_page(search_page_size, **search_filters)
 
         current_date = datetime.datetime.now().strftime('%Y-%m-%d')
-        data_provider.update_query(
+        await data_provider.update_query(
             user_id,
-            search_params.get('name', None),
-            search_params.get('date_gte', '1895-12-28'),
-            search_params.get('date_lte', '2026-12-12'),
-            country,
-            director,
+            search_filters['title_part'],
+            search_filters['release_date_gte'],
+            search_filters['release_date_lte'],
+            search_filters['country'],
+            search_filters['director'],
             current_date,
-            actors,
-            genres_included,
-            genres_excluded,
-            keywords_included,
-            keywords_excluded
+            search_filters['actors'],
+            search_filters['genres_included'],
+            search_filters['genres_excluded'],
+            search_filters['keywords_included'],
+            search_filters['keywords_excluded']
         )
 
         if movies:
-            await state.update_data(movies=movies, current_index=0)
+            await set_movies(state, movies, page_cursors=[None], next_cursor=next_cursor, search_filters=search_filters)
             await show_movie(user_id, state)
         else:
             menu_message_id = data.get(menu_message_id)
@@ -434,14 +437,21 @@ async def start_search(call: CallbackQuery, state: FSMContext):
     except Exception:
         await handle_error(call, state)
 
-async def get_movie_markup(movie_id: int, movie_index: int, movies_len: int, user_id: int, show_details: bool = False):
-    is_favorite = data_provider.is_in_list(user_id, movie_id, 'favorite_movies')
-    is_watchlist = data_provider.is_in_list(user_id, movie_id, 'watchlist')
+def get_navigation(data: dict) -> tuple[bool, bool]:
+    movies = data.get('movies', [])
+    current_index = data.get('current_index', 0)
+    has_prev = current_index > 0 or len(data.get('page_cursors') or []) > 1
+    has_next = current_index < len(movies) - 1 or bool(data.get('next_cursor'))
+    return has_prev, has_next
+
+async def get_movie_markup(movie_id: int, has_prev: bool, has_next: bool, user_id: int, show_details: bool = False):
+    is_favorite = await data_provider.is_in_list(user_id, movie_id, 'favorite_movies')
+    is_watchlist = await data_provider.is_in_list(user_id, movie_id, 'watchlist')
     
     inline_keyboard_first = []
-    if movie_index > 0:
+    if has_prev:
         inline_keyboard_first.append(InlineKeyboardButton(text='⬅️ Предыдущий', callback_data='prev_movie'))
-    if movie_index < movies_len:
+    if has_next:
         inline_keyboard_first.append(InlineKeyboardButton(text='Следующий ➡️', callback_data='next_movie'))
 
     markup = InlineKeyboardMarkup(inline_keyboard=[
@@ -463,6 +473,7 @@ async def get_movie_markup(movie_id: int, movie_index: int, movies_len: int, use
             ),
         ],
         [InlineKeyboardButton(text='⭐ Поставить оценку', callback_data=f"rate_movie_{movie_id}")],
+        [InlineKeyboardButton(text='🔎 Похожие фильмы', callback_data=f"similar_{movie_id}")],
         [InlineKeyboardButton(text='↩️ Вернуться в меню', callback_data=f'menu')]
     ])
     return markup
@@ -478,41 +489,46 @@ async def show_movie(user_id: int, state: FSMContext, show_details: bool = False
         return
 
     movie: dict = movies[current_index]
-    rating = str(movie['rating'] if not update_score else data_provider.get_movie_rating(movie.get('id')))
-    score = data_provider.get_movie_score(movie.get('id'), user_id)
+    rating = str(movie['rating'] if not update_score else await data_provider.get_movie_rating(movie.get('id')))
+    score = await data_provider.get_movie_score(movie.get('id'), user_id)
     if score:
         rating += f' (ваша оценка: {score})'
+    country_name = await data_provider.get_country_name(movie['release_country'])
+    director_name = await data_provider.get_director_name(movie['director'])
     text = (
         f"🎬 <b>{movie['name']}</b>\n"
         f"📅 Дата выхода: {movie['release_date']}\n"
-        f"🌍 Страна: {data_provider.get_country_name(movie['release_country'])}\n"
-        f"🎥 Режиссёр: {data_provider.get_director_name(movie['director'])}\n"
+        f"🌍 Страна: {country_name}\n"
+        f"🎥 Режиссёр: {director_name}\n"
         f"⭐ Рейтинг: {rating}\n"
         f"📝 Описание: {movie['overview']}"
     )
     
     if show_details:
+        actor_names = await data_provider.get_actor_names(movie['actors'])
+        genre_names = await data_provider.get_genre_names(movie['genres'])
+        keyword_names = await data_provider.get_keyword_names(movie['keywords'])
         text = (
-            f"\n👤 Актёры: {', '.join(data_provider.get_actor_names(movie['actors']))}\n"
-            f"🎭 Жанры: {', '.join(data_provider.get_genre_names(movie['genres']))}\n"
-            f"🔑 Ключевые слова: {', '.join(data_provider.get_keyword_names(movie['keywords']))}\n"
+            f"\n👤 Актёры: {', '.join(actor_names)}\n"
+            f"🎭 Жанры: {', '.join(genre_names)}\n"
+            f"🔑 Ключевые слова: {', '.join(keyword_names)}\n"
             f"💵 Сумма сборов: {movie['revenue']}\n"
         )
 
-    markup = await get_movie_markup(movie.get('id'), current_index, len(movies) - 1, user_id, show_details)
+    markup = await get_movie_markup(movie.get('id'), *get_navigation(data), user_id, show_details)
 
-    movie_photos: list = data.get('movie_photos', [])
-    if current_index < len(movie_photos) and movie_photos:
-        photo = movie_photos[current_index]
+    movie_photos: dict = data.get('movie_photos', {})
+    if movie.get('id') in movie_photos:
+        photo = movie_photos[movie.get('id')]
         file_bin = None
     else:
-        file_bin = data_provider.get_image_bin(movie.get('poster_link'))
+        file_bin = await data_provider.get_image_bin(movie.get('poster_link'))
         if file_bin:
             file_bin = await compress_image(file_bin)
 
     if file_bin:
         photo = BufferedInputFile(file_bin.getvalue(), filename='photo.png')
-        movie_photos.append(photo)
+        movie_photos[movie.get('id')] = photo
         await state.update_data(movie_photos=movie_photos)
 
     if 'movie_message_id' not in data:
@@ -571,7 +587,7 @@ async def set_score(call: CallbackQuery, state: FSMContext):
         user_id = call.from_user.id
         movie_id = int(call.data.split('_')[2])
         score = int(call.data.split('_')[3])
-        data_provider.set_movie_score(user_id, movie_id, score)
+        await data_provider.set_movie_score(user_id, movie_id, score)
         data = await state.get_data()
 
         await show_movie(user_id, state, show_details=data.get('show_details', False), update_score=True)
@@ -598,14 +614,15 @@ async def toggle_details(call: CallbackQuery, state: FSMContext):
 async def show_parameter_page(action: CallbackQuery | Message, state: FSMContext, last_value: str = None):
     data = await state.get_data()
     param_type = data.get('param_type')
-    param_page = data.get('param_page', 0)
+    param_cursors = data.get('param_cursors') or [None]
     search_params = data.get('search_params', {})
     param_type_common = param_type.split('-')[0]
     param_name = PARAMETER_TRANSLATIONS.get(param_type_common, param_type)
     if len(param_type.split('-')) > 1:
         param_name = "нежелательные " + param_name.lower()
 
-    items = data_provider.get_params_by_page(param_type_common, param_page)
+    items, next_cursor = await data_provider.get_params_by_page(param_type_common, param_cursors[-1])
+    await state.update_data(param_next_cursor=next_cursor)
 
     buttons = []
     for item in items:
@@ -620,9 +637,9 @@ async def show_parameter_page(action: CallbackQuery | Message, state: FSMContext
         ])
 
     navigation_buttons = []
-    if param_page > 0:
+    if len(param_cursors) > 1:
         navigation_buttons.append(InlineKeyboardButton(text='⬅️ Предыдущая страница', callback_data=f"prev_page_{param_type}"))
-    if len(items) == 10:
+    if next_cursor:
         navigation_buttons.append(InlineKeyboardButton(text='Следующая страница ➡️', callback_data=f"next_page_{param_type}"))
     buttons.append(navigation_buttons)
     buttons.append([InlineKeyboardButton(text='Завершить выбор', callback_data='finish_selection')])
@@ -671,10 +688,9 @@ async def select_item(param_type: str, item: dict, state: FSMContext):
 async def prev_page(call: CallbackQuery, state: FSMContext):
     try:
         data = await state.get_data()
-        param_page = data.get('param_page', 0)
-        if param_page > 0:
-            param_page -= 1
-            await state.update_data(param_page=param_page)
+        param_cursors = data.get('param_cursors') or [None]
+        if len(param_cursors) > 1:
+            await state.update_data(param_cursors=param_cursors[:-1])
             await show_parameter_page(call, state)
     except Exception:
         await handle_error(call, state)
@@ -683,10 +699,11 @@ async def prev_page(call: CallbackQuery, state: FSMContext):
 async def next_page(call: CallbackQuery, state: FSMContext):
     try:
         data = await state.get_data()
-        param_page = data.get('param_page', 0)
-        param_page += 1
-        await state.update_data(param_page=param_page)
-        await show_parameter_page(call, state)
+        param_cursors = data.get('param_cursors') or [None]
+        next_cursor = data.get('param_next_cursor')
+        if next_cursor:
+            await state.update_data(param_cursors=param_cursors + [next_cursor])
+            await show_parameter_page(call, state)
     except Exception:
         await handle_error(call, state)
 
@@ -707,15 +724,13 @@ async def toggle_list(call: CallbackQuery, state: FSMContext):
             list_name += '_movies'
         movie_id = int(call.data.split('_')[2])
         data = await state.get_data()
-        current_index = data.get('current_index', 0)
-        movies = data.get('movies', [])
 
-        if data_provider.is_in_list(user_id, movie_id, list_name):
-            data_provider.remove_from_list(user_id, movie_id, list_name)
+        if await data_provider.is_in_list(user_id, movie_id, list_name):
+            await data_provider.remove_from_list(user_id, movie_id, list_name)
         else:
-            data_provider.add_to_list(user_id, movie_id, list_name)
+            await data_provider.add_to_list(user_id, movie_id, list_name)
 
-        markup = await get_movie_markup(movie_id, current_index, len(movies) - 1, user_id)
+        markup = await get_movie_markup(movie_id, *get_navigation(data), user_id)
         await bot.edit_message_reply_markup(
             chat_id=user_id,
             message_id=call.message.message_id,
@@ -731,11 +746,19 @@ async def next_movie(call: CallbackQuery, state: FSMContext):
         data = await state.get_data()
         movies = data.get('movies', [])
         current_index = data.get('current_index', 0)
+        next_cursor = data.get('next_cursor')
 
         if current_index < len(movies) - 1:
             current_index += 1
             await state.update_data(current_index=current_index)
             await show_movie(user_id, state)
+        elif next_cursor:
+            search_filters = data.get('search_filters')
+            movies, following_cursor = await data_provider.search_movies_page(search_page_size, next_cursor, **search_filters)
+            if movies:
+                page_cursors = data.get('page_cursors', []) + [next_cursor]
+                await set_movies(state, movies, 0, page_cursors, following_cursor, search_filters)
+                await show_movie(user_id, state)
     except Exception:
         await handle_error(call, state)
 
@@ -745,11 +768,19 @@ async def prev_movie(call: CallbackQuery, state: FSMContext):
         user_id = call.from_user.id
         data = await state.get_data()
         current_index = data.get('current_index', 0)
+        page_cursors = data.get('page_cursors', [])
 
         if current_index > 0:
             current_index -= 1
             await state.update_data(current_index=current_index)
             await show_movie(user_id, state)
+        elif len(page_cursors) > 1:
+            page_cursors = page_cursors[:-1]
+            search_filters = data.get('search_filters')
+            movies, next_cursor = await data_provider.search_movies_page(search_page_size, page_cursors[-1], **search_filters)
+            if movies:
+                await set_movies(state, movies, len(movies) - 1, page_cursors, next_cursor, search_filters)
+                await show_movie(user_id, state)
     except Exception:
         await handle_error(call, state)
 
@@ -758,9 +789,9 @@ async def show_favorite_movies(call: CallbackQuery, state: FSMContext):
     await delete_message(call.message)
     try:
         user_id = call.from_user.id
-        movies = data_provider.get_movies_from_list(user_id, 'favorite_movies')
+        movies = await data_provider.get_movies_from_list(user_id, 'favorite_movies')
         if movies:
-            await state.update_data(movies=movies, current_index=0)
+            await set_movies(state, movies)
             await show_movie(user_id, state)
         else:
             await send_message(user_id, "У вас пока нет понравившихся фильмов.")
@@ -772,26 +803,42 @@ async def show_favorite_movies(call: CallbackQuery, state: FSMContext):
     await delete_message(call.message)
     try:
         user_id = call.from_user.id
-        movies = data_provider.get_movies_from_list(user_id, 'watchlist')
+        movies = await data_provider.get_movies_from_list(user_id, 'watchlist')
         if movies:
-            await state.update_data(movies=movies, current_index=0)
+            await set_movies(state, movies)
             await show_movie(user_id, state)
         else:
             await send_message(user_id, "У вас нет фильмов в списке отложенного.")
     except Exception:
         await handle_error(call, state)
 
+@router.callback_query(F.data.startswith('similar_'))
+async def show_similar_movies(call: CallbackQuery, state: FSMContext):
+    try:
+        user_id = call.from_user.id
+        movie_id = int(call.data.split('_')[1])
+        similar_movies = await data_provider.similar_movies(movie_id)
+
+        if not similar_movies:
+            await send_message(user_id, "Похожие фильмы не найдены.")
+            return
+
+        await set_movies(state, similar_movies)
+        await show_movie(user_id, state)
+    except Exception:
+        await handle_error(call, state)
+
 @router.callback_query(F.data == 'compilation')
 async def show_compilation(call: CallbackQuery, state: FSMContext):
     try:
         user_id = call.from_user.id
-        recommended_movies = data_provider.get_personal_recommendations(user_id)
+        recommended_movies = await data_provider.get_personal_recommendations(user_id)
         
         if not recommended_movies:
             await send_message(user_id, "У нас недостаточно данных для формирования персональной подборки. Пожалуйста, оцените несколько фильмов или добавьте их в избранное.")
             return
 
-        await state.update_data(movies=recommended_movies, current_index=0)
+        await set_movies(state, recommended_movies)
         await show_movie(user_id, state)
     except Exception:
         await handle_error(call, state)
\ No newline at end of file
@@ -1,12 +1,21 @@
-import asyncio
+import asyncio, sys
 from bot import bot
 from bot import dp
-from bot_handlers import router
+from bot_handlers import router, data_provider
 
 async def main():
     dp.include_router(router)
-    await bot.delete_webhook(drop_pending_updates=True)
-    await dp.start_polling(bot)
+    await data_provider.open()
+    await data_provider.warm_up_lookups()
+    await data_provider.content_recommender()
+    try:
+        await bot.delete_webhook(drop_pending_updates=True)
+        await dp.start_polling(bot)
+    finally:
+        await data_provider.close()
 
 if __name__ == "__main__":
+    # Асинхронный драйвер psycopg не работает с ProactorEventLoop, который используется в Windows по умолчанию
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     asyncio.run(main())
\ No newline at end of file
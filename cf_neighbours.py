@@ -0,0 +1,68 @@
+"""Расчёт соседей фильмов для совместной фильтрации по таблице movies_scores.
+
+Пересчитываются только фильмы, оценённые пользователями, у которых с прошлого запуска изменились оценки:
+от их оценок зависят и среднее пользователя, и сходство всех оценённых им фильмов. Кроме них пересчитываются
+фильмы, среди сохранённых соседей которых есть изменившиеся: у тех поменялась норма. Момент запуска
+сохраняется в recommender_state, поэтому оценки, поставленные во время расчёта, попадут в следующий.
+
+    python cf_neighbours.py
+    python cf_neighbours.py --full --top-n 30
+"""
+from data_provider import DataProvider, stream_chunk_size
+from recommender import item_neighbours
+import argparse, numpy as np, psycopg2.extras
+
+state_name = 'movie_neighbours'
+
+def load_scores(data_provider: DataProvider) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    user_ids, movie_ids, scores = [], [], []
+    for rows in data_provider.stream_request("SELECT user_id, movie_id, score FROM movies_scores", chunk_size=stream_chunk_size * 100):
+        for row in rows:
+            user_ids.append(row['user_id'])
+            movie_ids.append(row['movie_id'])
+            scores.append(row['score'])
+    return np.array(user_ids, dtype=np.int64), np.array(movie_ids, dtype=np.int64), np.array(scores, dtype=np.float32)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--full', action='store_true', help='пересчитать соседей всех фильмов')
+    parser.add_argument('--top-n', type=int, default=20, help='сколько соседей хранить для фильма')
+    parser.add_argument('--chunk-size', type=int, default=512, help='сколько фильмов обрабатывать за одно умножение')
+    args = parser.parse_args()
+
+    data_provider = DataProvider(minconn=1, maxconn=1)
+    try:
+        started_at = data_provider.db_request("SELECT now() AS now")[0]['now']
+        state = data_provider.db_request("SELECT updated_at FROM recommender_state WHERE name = %s", params=(state_name,))
+        if args.full or not state:
+            targets = [row['movie_id'] for row in data_provider.db_request("SELECT DISTINCT movie_id FROM movies_scores")]
+        else:
+            targets = [row['movie_id'] for row in data_provider.db_request("""
+                WITH changed AS (
+                    SELECT DISTINCT movie_id FROM movies_scores
+                    WHERE user_id IN (SELECT user_id FROM movies_scores WHERE updated_at > %s)
+                )
+                SELECT movie_id FROM changed
+                UNION
+                SELECT movie_id FROM movie_neighbours WHERE neighbour_id IN (SELECT movie_id FROM changed)
+            """, params=(state[0]['updated_at'],))]
+
+        if targets:
+            user_ids, movie_ids, scores = load_scores(data_provider)
+            neighbours = item_neighbours(user_ids, movie_ids, scores, targets, args.top_n, args.chunk_size)
+        else:
+            neighbours = []
+
+        with data_provider.transaction() as cursor:
+            cursor.execute("DELETE FROM movie_neighbours WHERE movie_id = ANY(%s)", (targets,))
+            psycopg2.extras.execute_values(cursor, "INSERT INTO movie_neighbours (movie_id, neighbour_id, similarity) VALUES %s", neighbours, page_size=1000)
+            cursor.execute("""
+                INSERT INTO recommender_state (name, updated_at) VALUES (%s, %s)
+                ON CONFLICT (name) DO UPDATE SET updated_at = EXCLUDED.updated_at
+            """, (state_name, started_at))
+        print(f'Пересчитано фильмов: {len(targets)}, сохранено соседей: {len(neighbours)}')
+    finally:
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()
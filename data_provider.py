@@ -1,223 +1,1172 @@
 from dns_client.adapters.requests import DNSClientSession
-from contextlib import closing
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from contextlib import contextmanager
 from psycopg2 import sql
-from urllib.parse import quote
-import psycopg2, psycopg2.extras, re, requests, xml.etree.ElementTree as ET
+from psycopg2.pool import ThreadedConnectionPool
+from urllib.parse import urlencode
+import base64, datetime, decimal, hashlib, json, mmap, os, psycopg2, psycopg2.extras, re, requests, sqlite3, tempfile, threading, time, traceback, uuid, xml.etree.ElementTree as ET
 from decouple import config
-
-base_url = "https://api.themoviedb.org/3!/movie?"
-headers = {
-    "accept": "application/json",
-    "Authorization": f"Bearer {config('API_TOKEN')}"
-}
+from recommender import ContentRecommender
+from similarity import MinHasher, rank_similar, signature_from_bytes, signature_to_bytes
+from tmdb_client import SharedClient, parse_credits
 
 dbname = config('DB_NAME')
 user = config('DB_USER')
 password = config('DB_PSWD')
 host = config('DB_HOST')
+pool_min = config('DB_POOL_MIN', default=1, cast=int)
+pool_max = config('DB_POOL_MAX', default=10, cast=int)
+pool_timeout = config('DB_POOL_TIMEOUT', default=30, cast=float)
+pool_check_idle = config('DB_POOL_CHECK_IDLE', default=30, cast=float)
+query_log_batch = config('QUERY_LOG_BATCH', default=100, cast=int)
+query_log_interval = config('QUERY_LOG_INTERVAL', default=5, cast=float)
+stream_chunk_size = config('STREAM_CHUNK_SIZE', default=50, cast=int)
+stats_timeout = config('STATS_TIMEOUT', default=10, cast=float)
+stats_workers = config('STATS_WORKERS', default=4, cast=int)
+recommender_ttl = config('RECOMMENDER_TTL', default=3600, cast=float)
+compilation_size = config('COMPILATION_SIZE', default=3, cast=int)
+neighbours_weight = config('NEIGHBOURS_WEIGHT', default=0.5, cast=float)
+recommendation_cache_ttl = config('RECOMMENDATION_CACHE_TTL', default=3600, cast=float)
+recommendation_cache_size = config('RECOMMENDATION_CACHE_SIZE', default=10000, cast=int)
+recommendation_workers = config('RECOMMENDATION_WORKERS', default=4, cast=int)
+lookup_cache_ttl = config('LOOKUP_CACHE_TTL', default=600, cast=float)
+# Кэши на диске лежат в каталоге пользователя, а не в текущем каталоге процесса; относительные пути раскрываются при запуске
+cache_dir = os.path.abspath(os.path.expanduser(config('CACHE_DIR', default=os.path.join('~', '.cache', 'rellcollator'))))
+response_cache_path = os.path.abspath(os.path.expanduser(config('RESPONSE_CACHE_PATH', default=os.path.join(cache_dir, 'tmdb_cache.sqlite3'))))
+response_cache_size = config('RESPONSE_CACHE_SIZE', default=200 * 1024 * 1024, cast=int)
+poster_cache_dir = os.path.abspath(os.path.expanduser(config('POSTER_CACHE_DIR', default=os.path.join(cache_dir, 'posters'))))
+poster_cache_size = config('POSTER_CACHE_SIZE', default=1024 * 1024 * 1024, cast=int)
+poster_cache_mmap = config('POSTER_CACHE_MMAP', default=False, cast=bool)
+# После изменения длины сигнатуры или числа полос индекс нужно пересобрать: python similarity_index.py
+minhash_permutations = config('MINHASH_PERMUTATIONS', default=128, cast=int)
+lsh_bands = config('LSH_BANDS', default=32, cast=int)
+similar_movies_count = config('SIMILAR_MOVIES_COUNT', default=10, cast=int)
+
+movie_lists = ('favorite_movies', 'watchlist')
+max_score = 10
+# Оценка, которая не сдвигает профиль: выше неё признаки фильма притягивают подборку, ниже - отталкивают
+neutral_score = (max_score + 1) / 2
+sort_columns = ('id', 'rating', 'release_date', 'revenue')
+sort_directions = ('ASC', 'DESC')
+# Чем заменяются пустые значения при сортировке: кортеж с NULL не сравнивается, и такие фильмы пропадали бы
+# при переходе по курсору. Пустые идут в конце по убыванию и в начале по возрастанию
+sort_null_values = {'rating': -1, 'revenue': -1, 'release_date': datetime.date.min}
+
+movie_relations = (
+    ('movies_actors', 'actor_id', 'actors'),
+    ('movies_genres', 'genre_id', 'genres'),
+    ('movies_keywords', 'keyword_id', 'keywords'),
+)
+
+# Столбцы имени, по которым с TMDB сопоставляются записи справочников, заведённые без tmdb_id
+tmdb_name_columns = {
+    'genres': ('name',),
+    'keywords': ('name',),
+    'actors': ('name', 'surname'),
+    'directors': ('name', 'surname'),
+}
+
+query_columns = ('user_id', 'movie_name', 'lower_date', 'upper_date', 'movie_release_country', 'director', 'date')
+query_links = (
+    ('query_actors', 'actor_id', 'actors'),
+    ('query_genres', 'genre_id', 'genres'),
+    ('query_genres_no', 'genre_id', 'genres_no'),
+    ('query_keywords', 'keyword_id', 'keywords'),
+    ('query_keywords_no', 'keyword_id', 'keywords_no'),
+)
+# Идентификаторы для пачки запросов выделяются заранее, чтобы связать строки query_* без RETURNING
+query_ids_query = "SELECT nextval(pg_get_serial_sequence('queries', 'id')) AS id FROM generate_series(1, %s)"
+
+# Справочники, имена из которых кэшируются в памяти процесса (LookupCache)
+lookup_queries = {
+    'actors': "SELECT id, (name || ' ' || surname) AS name FROM actors",
+    'directors': "SELECT id, (name || ' ' || surname) AS name FROM directors",
+    'countries': "SELECT id, name, alpha2 FROM countries",
+    'genres': "SELECT id, name FROM genres",
+    'keywords': "SELECT id, name FROM keywords",
+}
+
+def lookup_by_ids_query(table: str) -> str:
+    return f"SELECT * FROM ({lookup_queries[table]}) t WHERE id = ANY(%s)"
+
+movie_columns = 'm.id, m.name, m.release_date, m.release_country, m.poster_link, m.rating, m.revenue, m.runtime, m.director, m.overview'
+# Связи фильма собираются отдельными подзапросами, а не соединением всех таблиц сразу:
+# иначе до группировки получается актёры x жанры x ключевые слова строк на каждый фильм
+movie_relation_columns = """ARRAY(SELECT DISTINCT ma.actor_id FROM movies_actors ma WHERE ma.movie_id = m.id ORDER BY ma.actor_id) AS actors,
+        ARRAY(SELECT DISTINCT mg.genre_id FROM movies_genres mg WHERE mg.movie_id = m.id ORDER BY mg.genre_id) AS genres,
+        ARRAY(SELECT DISTINCT mk.keyword_id FROM movies_keywords mk WHERE mk.movie_id = m.id ORDER BY mk.keyword_id) AS keywords"""
+
+def list_table(list_name: str) -> str:
+    if list_name not in movie_lists:
+        raise ValueError(f'Неизвестный список: {list_name}')
+    return list_name
+
+def search_movies_query(
+    genres_included=None, genres_excluded=None, keywords_included=None, 
+    keywords_excluded=None, actors=None, director=None, title_part=None, 
+    country=None, release_date_gte=None, release_date_lte=None,
+    order_by=None, order_dir=None, after=None, limit=None) -> tuple[str, list]:
+    """Собирает запрос поиска фильмов, общий для синхронного и асинхронного провайдеров.
+    after - ключ сортировки (значение, id) последнего фильма предыдущей страницы."""
+    query = f"""
+    SELECT {movie_columns},
+        {movie_relation_columns}
+    FROM movies m
+    WHERE 1=1
+    """
+
+    conditions = []
+    params = []
+
+    if genres_included:
+        conditions.append("m.id IN (SELECT movie_id FROM movies_genres WHERE genre_id = ANY(%s))")
+        params.append(list(genres_included))
+    if genres_excluded:
+        conditions.append("m.id NOT IN (SELECT movie_id FROM movies_genres WHERE genre_id = ANY(%s))")
+        params.append(list(genres_excluded))
+    if keywords_included:
+        conditions.append("m.id IN (SELECT movie_id FROM movies_keywords WHERE keyword_id = ANY(%s))")
+        params.append(list(keywords_included))
+    if keywords_excluded:
+        conditions.append("m.id NOT IN (SELECT movie_id FROM movies_keywords WHERE keyword_id = ANY(%s))")
+        params.append(list(keywords_excluded))
+    if actors:
+        conditions.append("m.id IN (SELECT movie_id FROM movies_actors WHERE actor_id = ANY(%s))")
+        params.append(list(actors))
+    if director:
+        conditions.append("m.director = %s")
+        params.append(director)
+    if title_part:
+        conditions.append("m.name ILIKE %s")
+        params.append(f'%{title_part}%')
+    if country:
+        conditions.append("m.release_country = %s")
+        params.append(country)
+    if release_date_gte and release_date_lte:
+        conditions.append("m.release_date BETWEEN %s AND %s")
+        params.extend([release_date_gte, release_date_lte])
+
+    order_by = order_by if order_by in sort_columns else 'id'
+    order_dir = order_dir if order_dir in sort_directions else 'DESC'
+    sort_key, sort_params = (f"coalesce(m.{order_by}, %s)", [sort_null_values[order_by]]) if order_by in sort_null_values else (f"m.{order_by}", [])
+    if after is not None:
+        # Сравнение кортежей позволяет продолжить выборку с места остановки без OFFSET
+        conditions.append(f"({sort_key}, m.id) {'<' if order_dir == 'DESC' else '>'} (%s, %s)")
+        params.extend(sort_params + list(after))
+
+    if conditions:
+        query += " AND " + " AND ".join(conditions)
+
+    query += f" ORDER BY {sort_key} {order_dir}, m.id {order_dir}"
+    params.extend(sort_params)
+    if limit is not None:
+        query += " LIMIT %s"
+        params.append(limit)
+    return query, params
+
+def search_movies_page_query(page_size: int, cursor: str = None, **filters) -> tuple[str, list]:
+    """Запрос одной страницы результатов поиска. Выбирается на одну строку больше,
+    чтобы узнать, есть ли следующая страница."""
+    after = decode_cursor(cursor) if cursor else None
+    return search_movies_query(**filters, after=after, limit=page_size + 1)
+
+def movies_page_from_rows(rows: list, page_size: int, order_by: str = None) -> tuple[list[dict], str | None]:
+    """Превращает строки, выбранные search_movies_page_query, в страницу фильмов и курсор следующей страницы."""
+    movies = [movie_from_row(row) for row in rows[:page_size]]
+    next_cursor = None
+    if len(rows) > page_size:
+        last = rows[page_size - 1]
+        order_by = order_by if order_by in sort_columns else 'id'
+        value = last[order_by]
+        next_cursor = encode_cursor(sort_null_values[order_by] if value is None else value, last['id'])
+    return movies, next_cursor
+
+def encode_cursor(value, movie_id: int) -> str:
+    if isinstance(value, datetime.date):
+        value = value.isoformat()
+    elif isinstance(value, decimal.Decimal):
+        value = str(value)
+    return base64.urlsafe_b64encode(json.dumps([value, movie_id]).encode()).decode()
+
+def decode_cursor(cursor: str) -> tuple:
+    value, movie_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    return value, movie_id
+
+def movies_from_list_query(user_id: int, list_name: str) -> tuple[str, list]:
+    query = f"""
+    SELECT {movie_columns},
+        {movie_relation_columns}
+    FROM movies m
+    WHERE m.id IN (SELECT movie_id FROM {list_table(list_name)} WHERE user_id = %s)
+    """
+    return query, [user_id]
+
+param_tables = {
+    'actors': 'actors',
+    'director': 'directors',
+    'directors': 'directors',
+    'country': 'countries',
+    'countries': 'countries',
+    'genres': 'genres',
+    'keywords': 'keywords',
+}
+
+def param_table(param_name: str) -> str:
+    if param_name not in param_tables:
+        raise ValueError(f'Неизвестный параметр: {param_name}')
+    return param_tables[param_name]
+
+def param_name_expr(table: str) -> str:
+    # Выражение должно совпадать с выражением в индексах, иначе они не будут использоваться
+    if table in ('actors', 'directors'):
+        return "(name || ' ' || surname)"
+    return 'name'
+
+def escape_like(text: str) -> str:
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+def like_pattern(text: str) -> str:
+    return f'%{escape_like(text)}%'
+
+def params_page_query(param_name: str, after: list = None, page_len: int = 10) -> tuple[str, list]:
+    """Страница значений параметра, упорядоченных по (имя, id). after - ключ последнего значения
+    предыдущей страницы. Выбирается на одну строку больше, чтобы узнать, есть ли следующая страница."""
+    table = param_table(param_name)
+    name_expr = param_name_expr(table)
+    query = f"SELECT id, {name_expr} AS name FROM {table}"
+    params = []
+    if after:
+        query += f" WHERE ({name_expr}, id) > (%s, %s)"
+        params.extend(after)
+    query += f" ORDER BY {name_expr}, id LIMIT %s"
+    params.append(page_len + 1)
+    return query, params
+
+def params_page(rows: list, page_len: int) -> tuple[list[dict], list | None]:
+    items = rows[:page_len]
+    next_after = [items[-1]['name'], items[-1]['id']] if len(rows) > page_len else None
+    return items, next_after
+
+def suggest_query(table: str, text: str, limit: int = 10) -> tuple[str, list]:
+    """Подсказки по имени: сначала точное совпадение, затем совпадение по началу строки, затем по
+    триграммной похожести. Отбор по ILIKE и % обслуживается триграммными индексами."""
+    table = param_table(table)
+    name_expr = param_name_expr(table)
+    query = f"""
+    SELECT id, {name_expr} AS name
+    FROM {table}
+    WHERE {name_expr} ILIKE %s OR {name_expr} %% %s
+    ORDER BY {name_expr} = %s DESC,
+        lower({name_expr}) = lower(%s) DESC,
+        starts_with(lower({name_expr}), lower(%s)) DESC,
+        similarity({name_expr}, %s) DESC,
+        {name_expr}, id
+    LIMIT %s
+    """
+    return query, [like_pattern(text), text, text, text, text, text, limit]
+
+def exact_param_query(table: str, text: str) -> tuple[str, list]:
+    """Значение с точно таким именем без учёта регистра; при нескольких предпочитается совпадение с учётом регистра.
+    ILIKE без подстановочных символов обслуживается тем же триграммным индексом, что и подсказки."""
+    table = param_table(table)
+    name_expr = param_name_expr(table)
+    query = f"""
+    SELECT id, {name_expr} AS name
+    FROM {table}
+    WHERE {name_expr} ILIKE %s
+    ORDER BY {name_expr} = %s DESC, id
+    LIMIT 1
+    """
+    return query, [escape_like(text), text]
+
+def query_record(user_id, film_name, lower_date, upper_date, film_release_country, director, date, actors, genres, genres_no, keywords, keywords_no) -> dict:
+    return {
+        'query': (user_id, film_name, lower_date, upper_date, film_release_country, director, date),
+        'actors': list(actors or []),
+        'genres': list(genres or []),
+        'genres_no': list(genres_no or []),
+        'keywords': list(keywords or []),
+        'keywords_no': list(keywords_no or []),
+    }
+
+def query_log_rows(records: list[dict], query_ids: list[int]) -> tuple[dict[tuple[str, ...], list[tuple]], dict[str, list[tuple]]]:
+    """Раскладывает пачку записей журнала на строки для queries, сгруппированные по набору заполненных
+    столбцов, и строки таблиц query_*. Пустые поля не передаются, чтобы их заполнили значения по умолчанию."""
+    queries = {}
+    for query_id, record in zip(query_ids, records):
+        present = [(column, value) for column, value in zip(query_columns, record['query']) if value is not None]
+        columns = ('id', *(column for column, _ in present))
+        queries.setdefault(columns, []).append((query_id, *(value for _, value in present)))
+    links = {table: [] for table, _, _ in query_links}
+    for query_id, record in zip(query_ids, records):
+        for table, _, key in query_links:
+            links[table].extend((query_id, item_id) for item_id in record[key])
+    return queries, links
+
+def movie_from_row(row) -> dict:
+    return {
+        'id': row['id'],
+        'name': row['name'],
+        'release_date': row['release_date'],
+        'release_country': row['release_country'],
+        'poster_link': row['poster_link'],
+        'rating': round(row['rating'], 1),
+        'revenue': row['revenue'],
+        'runtime': row['runtime'],
+        'director': row['director'],
+        'overview': row['overview'],
+        'actors': row['actors'],
+        'genres': row['genres'],
+        'keywords': row['keywords']
+    }
+
+preferences_query = """
+    SELECT movie_id FROM movies_scores WHERE user_id = %s
+    UNION
+    SELECT movie_id FROM favorite_movies WHERE user_id = %s;
+"""
+
+# Каталог для ContentRecommender: рейтинги фильмов и связи с признаками по типам
+recommender_movies_query = "SELECT id, rating FROM movies"
+recommender_relation_queries = {
+    'genre': "SELECT movie_id, genre_id AS feature_id FROM movies_genres",
+    'keyword': "SELECT movie_id, keyword_id AS feature_id FROM movies_keywords",
+    'actor': "SELECT movie_id, actor_id AS feature_id FROM movies_actors",
+}
+
+# Оценки совместной фильтрации для кандидатов: сумма сходств с фильмами пользователя
+neighbours_query = """
+    SELECT neighbour_id, sum(similarity) AS score
+    FROM movie_neighbours
+    WHERE movie_id = ANY(%s)
+    GROUP BY neighbour_id
+"""
+# Ссылки на удаляемый фильм вне movie_relations: соседи совместной фильтрации и готовые подборки.
+# Подборка, ставшая короче запрошенной, пересчитывается при чтении
+movie_references_delete = (
+    "DELETE FROM movie_neighbours WHERE movie_id = %(movie_id)s OR neighbour_id = %(movie_id)s",
+    "UPDATE user_recommendations SET movie_ids = array_remove(movie_ids, %(movie_id)s) WHERE movie_ids @> ARRAY[%(movie_id)s]::integer[]",
+)
+# Признаки одного фильма (тип, id) - для сигнатуры похожих и изменения профилей пользователей
+movie_features_query = """
+    SELECT 'genre' AS feature_type, genre_id AS feature_id FROM movies_genres WHERE movie_id = %(movie_id)s
+    UNION ALL
+    SELECT 'keyword', keyword_id FROM movies_keywords WHERE movie_id = %(movie_id)s
+    UNION ALL
+    SELECT 'actor', actor_id FROM movies_actors WHERE movie_id = %(movie_id)s
+"""
+set_movie_score_query = """
+    INSERT INTO movies_scores (user_id, movie_id, score)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (user_id, movie_id) DO UPDATE
+    SET score = EXCLUDED.score, updated_at = now()
+"""
+
+old_score_query = "SELECT score FROM movies_scores WHERE user_id = %s AND movie_id = %s"
+user_profile_query = "SELECT feature_type, feature_id, weight FROM user_profiles WHERE user_id = %s"
+# Изменения профиля одного пользователя выполняются по очереди, чтобы параллельные оценки не потеряли приращение
+profile_lock_query = "SELECT pg_advisory_xact_lock(%s)"
+# Вес фильма делится на корень из числа его признаков: вектор фильма единичной длины, как строки матрицы
+# ContentRecommender, и фильм с большим составом не перевешивает остальные
+profile_delta_query = f"""
+    INSERT INTO user_profiles (user_id, feature_type, feature_id, weight)
+    SELECT %(user_id)s, feature_type, feature_id, %(delta)s / sqrt(count(*) OVER ())
+    FROM (SELECT DISTINCT feature_type, feature_id FROM ({movie_features_query}) f) features
+    ON CONFLICT (user_id, feature_type, feature_id) DO UPDATE SET weight = user_profiles.weight + EXCLUDED.weight
+"""
+profile_cleanup_query = f"""
+    DELETE FROM user_profiles
+    WHERE user_id = %(user_id)s AND abs(weight) < 1e-9
+        AND (feature_type, feature_id) IN ({movie_features_query})
+"""
+# Профили заданных пользователей с нуля - для первого заполнения и исправления расхождений (user_profiles.py)
+rebuild_profiles_statements = (
+    "SELECT pg_advisory_xact_lock(user_id) FROM unnest(%(users)s::bigint[]) AS user_id",
+    "DELETE FROM user_profiles WHERE user_id = ANY(%(users)s)",
+    f"""
+    WITH p AS (
+        SELECT user_id, movie_id, (score - {neutral_score}) / ({max_score} - {neutral_score}) AS weight
+        FROM movies_scores WHERE user_id = ANY(%(users)s)
+        UNION ALL
+        SELECT user_id, movie_id, 1 FROM favorite_movies WHERE user_id = ANY(%(users)s)
+    ), features AS (
+        SELECT movie_id, 'genre' AS feature_type, genre_id AS feature_id FROM movies_genres WHERE movie_id IN (SELECT movie_id FROM p)
+        UNION
+        SELECT movie_id, 'keyword', keyword_id FROM movies_keywords WHERE movie_id IN (SELECT movie_id FROM p)
+        UNION
+        SELECT movie_id, 'actor', actor_id FROM movies_actors WHERE movie_id IN (SELECT movie_id FROM p)
+    ), f AS (
+        SELECT movie_id, feature_type, feature_id, 1 / sqrt(count(*) OVER (PARTITION BY movie_id)) AS norm FROM features
+    )
+    INSERT INTO user_profiles (user_id, feature_type, feature_id, weight)
+    SELECT p.user_id, f.feature_type, f.feature_id, sum(p.weight * f.norm)
+    FROM p JOIN f ON f.movie_id = p.movie_id
+    GROUP BY p.user_id, f.feature_type, f.feature_id
+    HAVING abs(sum(p.weight * f.norm)) >= 1e-9
+    """,
+)
+
+def score_weight(score: int | None) -> float:
+    """Вес оценённого фильма в профиле: от -1 за минимальную оценку до 1 за максимальную; без оценки - 0."""
+    if score is None:
+        return 0
+    return (score - neutral_score) / (max_score - neutral_score)
+
+def profile_delta_statements(user_id: int, movie_id: int, delta: float) -> list[tuple[str, dict]]:
+    """Запросы, добавляющие delta к весу фильма в профиле пользователя (по delta / sqrt(n) каждому из n признаков).
+    Выполняются в транзакции после profile_lock_query."""
+    if not delta:
+        return []
+    params = {'user_id': user_id, 'movie_id': movie_id, 'delta': delta}
+    return [(profile_delta_query, params), (profile_cleanup_query, params)]
+
+def user_profile(recommender: ContentRecommender, profile_rows: list[dict], movie_ids: list[int]):
+    """Вектор профиля из сохранённых весов; пока профиль не заполнен - по понравившимся фильмам."""
+    if profile_rows:
+        return recommender.profile_from_features((row['feature_type'], row['feature_id'], row['weight']) for row in profile_rows)
+    return recommender.profile_from_movies(movie_ids)
+
+precomputed_recommendations_query = """
+    SELECT movie_ids FROM user_recommendations
+    WHERE user_id = %s AND computed_at > coalesce(invalidated_at, '-infinity')
+"""
+# now() - начало транзакции, в которой прочитаны предпочтения: сброс во время расчёта сделает подборку недействительной
+store_recommendation_query = """
+    INSERT INTO user_recommendations (user_id, movie_ids, computed_at) VALUES (%s, %s, now())
+    ON CONFLICT (user_id) DO UPDATE SET movie_ids = EXCLUDED.movie_ids, computed_at = EXCLUDED.computed_at
+"""
+invalidate_recommendations_query = """
+    INSERT INTO user_recommendations (user_id, invalidated_at) VALUES (%s, now())
+    ON CONFLICT (user_id) DO UPDATE SET invalidated_at = EXCLUDED.invalidated_at
+"""
+
+minhasher = MinHasher(minhash_permutations, lsh_bands)
+
+movie_signature_query = "SELECT signature FROM movie_signatures WHERE movie_id = %s"
+# Кандидаты в похожие - фильмы, совпавшие с данным хотя бы в одной полосе сигнатуры
+similar_candidates_query = """
+    SELECT s.movie_id, s.signature
+    FROM movie_signatures s
+    WHERE s.movie_id IN (
+        SELECT l.movie_id
+        FROM movie_lsh own
+        JOIN movie_lsh l ON l.band = own.band AND l.bucket = own.bucket
+        WHERE own.movie_id = %(movie_id)s AND l.movie_id <> %(movie_id)s
+    )
+"""
+
+def signature_statements(movie_id: int, features: Iterable[tuple[str, int]]) -> list[tuple[str, tuple]]:
+    """Запросы, заменяющие сигнатуру и корзины фильма по его текущим признакам (тип, id).
+    Фильм без признаков из индекса удаляется."""
+    statements = [
+        ("DELETE FROM movie_lsh WHERE movie_id = %s", (movie_id,)),
+        ("DELETE FROM movie_signatures WHERE movie_id = %s", (movie_id,)),
+    ]
+    signature = minhasher.signature(features)
+    if signature is not None:
+        buckets = minhasher.buckets(signature)
+        statements += [
+            ("INSERT INTO movie_signatures (movie_id, signature) VALUES (%s, %s)", (movie_id, signature_to_bytes(signature))),
+            ("INSERT INTO movie_lsh (band, bucket, movie_id) SELECT unnest(%s::smallint[]), unnest(%s::bigint[]), %s",
+             ([band for band, _ in buckets], [bucket for _, bucket in buckets], movie_id)),
+        ]
+    return statements
+
+# Обновление изменившихся в TMDB полей пачкой строк (tmdb_id, rating, revenue, runtime, overview); пустые значения не затирают сохранённые
+movies_update_query = """
+    UPDATE movies m SET
+        rating = coalesce(v.rating, m.rating),
+        revenue = coalesce(v.revenue, m.revenue),
+        runtime = coalesce(v.runtime, m.runtime),
+        overview = coalesce(nullif(v.overview, ''), m.overview)
+    FROM (VALUES %s) AS v (tmdb_id, rating, revenue, runtime, overview)
+    WHERE m.tmdb_id = v.tmdb_id
+"""
+movies_update_template = "(%s::integer, %s::numeric, %s::bigint, %s::integer, %s::text)"
+
+def movies_by_ids_query(movie_ids: list[int]) -> tuple[str, list]:
+    query = f"""
+    SELECT {movie_columns},
+        {movie_relation_columns}
+    FROM movies m
+    WHERE m.id = ANY(%s)
+    """
+    return query, [list(movie_ids)]
+
+def movies_in_order(rows: list, movie_ids: list[int]) -> list[dict]:
+    movies = {row['id']: movie_from_row(row) for row in rows}
+    return [movies[movie_id] for movie_id in movie_ids if movie_id in movies]
+
+stats_windows = ('day', 'week', 'month')
+stats_dimensions = ('actors', 'keywords', 'genres', 'directors')
+stats_top = 3
+
+def query_rollup_statements(condition: str) -> tuple[str, str]:
+    """Запросы, добавляющие к дневным агрегатам поисковые запросы, отобранные условием condition
+    (по алиасу q таблицы queries). Используются при записи журнала и при пересборке агрегатов."""
+    counts = f"""
+    INSERT INTO query_counts_daily (day, cnt)
+    SELECT q.date::date, count(*) FROM queries q WHERE {condition} GROUP BY 1
+    ON CONFLICT (day) DO UPDATE SET cnt = query_counts_daily.cnt + EXCLUDED.cnt
+    """
+    stats = f"""
+    INSERT INTO query_stats_daily (day, dimension, item_id, cnt)
+    SELECT day, dimension, item_id, count(*) FROM (
+        SELECT q.date::date AS day, 'actors' AS dimension, qa.actor_id AS item_id
+        FROM queries q JOIN query_actors qa ON qa.query_id = q.id WHERE {condition}
+        UNION ALL
+        SELECT q.date::date, 'keywords', qk.keyword_id
+        FROM queries q JOIN query_keywords qk ON qk.query_id = q.id WHERE {condition}
+        UNION ALL
+        SELECT q.date::date, 'genres', qg.genre_id
+        FROM queries q JOIN query_genres qg ON qg.query_id = q.id WHERE {condition}
+        UNION ALL
+        SELECT q.date::date, 'directors', q.director
+        FROM queries q WHERE q.director IS NOT NULL AND {condition}
+    ) hits
+    GROUP BY day, dimension, item_id
+    ON CONFLICT (day, dimension, item_id) DO UPDATE SET cnt = query_stats_daily.cnt + EXCLUDED.cnt
+    """
+    return counts, stats
+
+# Агрегаты пополняются при каждой записи журнала (параметр ids) и пересобираются за период (date_from, date_to).
+# Дни из query_rollup_folded при пересборке пропускаются: их сырой журнал уже удалён (или удаляется) retention.py,
+# и пересчёт по нему затёр бы агрегаты
+query_rollup_by_ids = query_rollup_statements('q.id = ANY(%(ids)s)')
+query_rollup_by_dates = query_rollup_statements(
+    'q.date >= %(date_from)s AND q.date < %(date_to)s AND q.date::date NOT IN (SELECT day FROM query_rollup_folded)'
+)
+query_rollup_lock = "LOCK TABLE query_counts_daily, query_stats_daily IN EXCLUSIVE MODE"
+query_rollup_clear = tuple(f"""
+    DELETE FROM {table} WHERE day >= %(date_from)s AND day < %(date_to)s
+        AND day NOT IN (SELECT day FROM query_rollup_folded)
+""" for table in ('query_counts_daily', 'query_stats_daily'))
+
+stats_queries_query = """
+    SELECT
+        coalesce(sum(cnt), 0) AS query_month,
+        coalesce(sum(cnt) FILTER (WHERE day > CURRENT_DATE - '1 week'::interval), 0) AS query_week,
+        coalesce(sum(cnt) FILTER (WHERE day > CURRENT_DATE - '1 day'::interval), 0) AS query_day
+    FROM query_counts_daily
+    WHERE day > CURRENT_DATE - '1 month'::interval
+"""
+# Популярные параметры поиска за день, неделю и месяц по дневным агрегатам: объём работы
+# зависит от числа дней и различных параметров, а не от числа запросов. Имена подставляет провайдер
+stats_top_query = f"""
+    WITH counts AS (
+        SELECT item_id,
+            sum(cnt) FILTER (WHERE day > CURRENT_DATE - '1 day'::interval) AS day,
+            sum(cnt) FILTER (WHERE day > CURRENT_DATE - '1 week'::interval) AS week,
+            sum(cnt) AS month
+        FROM query_stats_daily
+        WHERE dimension = %s AND day > CURRENT_DATE - '1 month'::interval
+        GROUP BY item_id
+    ),
+    ranked AS (
+        SELECT item_id, coalesce(day, 0) AS day, coalesce(week, 0) AS week, month,
+            row_number() OVER (ORDER BY day DESC NULLS LAST, item_id) AS day_rank,
+            row_number() OVER (ORDER BY week DESC NULLS LAST, item_id) AS week_rank,
+            row_number() OVER (ORDER BY month DESC, item_id) AS month_rank
+        FROM counts
+    )
+    SELECT * FROM ranked
+    WHERE (day_rank <= {stats_top} AND day > 0) OR (week_rank <= {stats_top} AND week > 0) OR month_rank <= {stats_top}
+"""
+# Независимые разделы статистики: get_stats выполняет их параллельно и отдаёт по мере готовности
+stats_sections = {
+    'users': ("SELECT count(*) AS usr_cnt FROM users", None),
+    'lists': ("SELECT (SELECT count(*) FROM favorite_movies) AS favorite, (SELECT count(*) FROM watchlist) AS watchlist", None),
+    'queries': (stats_queries_query, None),
+    **{dimension: (stats_top_query, (dimension,)) for dimension in stats_dimensions},
+}
+
+def empty_stats() -> dict[str, int | dict]:
+    stats = {key: 0 for key in ('usr_cnt', 'query_month', 'query_week', 'query_day', 'favorite', 'watchlist')}
+    for window in stats_windows:
+        stats[f'user_queries_{window}'] = {dimension: [] for dimension in stats_dimensions}
+    return stats
+
+def stats_section(name: str, rows: list[dict]) -> dict[str, int | dict]:
+    """Часть словаря статистики, которую даёт раздел name. Строки разделов параметров должны содержать name."""
+    if name not in stats_dimensions:
+        return dict(rows[0])
+    section = {}
+    for window in stats_windows:
+        top = sorted((row for row in rows if row[f'{window}_rank'] <= stats_top and row[window] > 0), key=lambda row: row[f'{window}_rank'])
+        section[f'user_queries_{window}'] = {name: [row['name'] for row in top]}
+    return section
+
+def merge_stats(stats: dict, section: dict):
+    for key, value in section.items():
+        if isinstance(value, dict):
+            stats[key].update(value)
+        else:
+            stats[key] = value
+
+class ConnectionPool:
+    """Потокобезопасный пул соединений с проверкой их работоспособности при выдаче."""
+    def __init__(self, minconn: int = pool_min, maxconn: int = pool_max, timeout: float = pool_timeout, check_idle: float = pool_check_idle):
+        self.timeout = timeout
+        self.check_idle = check_idle
+        self.maxconn = maxconn
+        self.__last_used: dict[int, float] = {}
+        self.__pool = ThreadedConnectionPool(minconn, maxconn, dbname=dbname, user=user, password=password, host=host)
+        # При старте открывается minconn соединений, но возвращённые в пул сверх minconn ThreadedConnectionPool закрывает;
+        # чтобы соединения переиспользовались, он хранит все открытые, до maxconn
+        self.__pool.minconn = maxconn
+        # ThreadedConnectionPool не ждёт освобождения соединения, а сразу бросает PoolError,
+        # поэтому число одновременных выдач ограничивается семафором
+        self.__slots = threading.BoundedSemaphore(maxconn)
+
+    @contextmanager
+    def connection(self):
+        if not self.__slots.acquire(timeout=self.timeout):
+            raise psycopg2.pool.PoolError('connection pool exhausted')
+        try:
+            conn = self.__checkout()
+            try:
+                yield conn
+            finally:
+                self.__putconn(conn)
+        finally:
+            self.__slots.release()
+
+    def close(self):
+        self.__pool.closeall()
+        self.__last_used.clear()
+
+    def __checkout(self):
+        # Соединение, разорванное сервером, выбрасывается, а замена проверяется так же: в пуле могут лежать
+        # и другие разорванные соединения. Каждый проход закрывает одно из них, так что попыток не больше maxconn + 1
+        for _ in range(self.maxconn + 1):
+            conn = self.__pool.getconn()
+            # Проверяем только соединения, простоявшие дольше check_idle, чтобы не тратить лишний запрос
+            idle = time.monotonic() - self.__last_used.get(id(conn), 0)
+            if (idle < self.check_idle and not conn.closed) or self.__is_alive(conn):
+                return conn
+            self.__putconn(conn)
+        raise psycopg2.OperationalError('no live connection to the database')
+
+    def __putconn(self, conn):
+        self.__last_used[id(conn)] = time.monotonic()
+        self.__pool.putconn(conn, close=conn.closed)
+        # Закрытое соединение (разорванное или закрытое пулом из-за неизвестного состояния транзакции) больше не выдаётся;
+        # его отметку нужно убрать, иначе новое соединение с тем же id() считалось бы недавно проверенным
+        if conn.closed:
+            self.__last_used.pop(id(conn), None)
+
+    def __is_alive(self, conn) -> bool:
+        if conn.closed:
+            return False
+        try:
+            conn.autocommit = True
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            return True
+        except psycopg2.Error:
+            conn.close()
+            return False
+
+class QueryLogBuffer:
+    """Буфер отложенной записи журнала поиска: записи копятся в памяти и сбрасываются
+    в базу пачками по заполнении буфера или по таймеру в отдельном потоке."""
+    def __init__(self, flush, max_size: int = query_log_batch, interval: float = query_log_interval):
+        self.max_size = max_size
+        self.interval = interval
+        self.__flush = flush
+        self.__records: list[dict] = []
+        self.__lock = threading.Lock()
+        self.__wakeup = threading.Event()
+        self.__closed = False
+        self.__thread = None
+
+    def add(self, record: dict):
+        with self.__lock:
+            if self.__closed:
+                raise RuntimeError('Журнал запросов уже закрыт')
+            self.__records.append(record)
+            if self.__thread is None:
+                self.__thread = threading.Thread(target=self.__run, name='query-log', daemon=True)
+                self.__thread.start()
+            if len(self.__records) >= self.max_size:
+                self.__wakeup.set()
+
+    def close(self):
+        with self.__lock:
+            self.__closed = True
+            thread = self.__thread
+        self.__wakeup.set()
+        if thread is not None:
+            thread.join()
+        self.drain()
+
+    def drain(self):
+        with self.__lock:
+            records, self.__records = self.__records, []
+        if not records:
+            return
+        try:
+            self.__flush(records)
+        except Exception:
+            print(traceback.format_exc())
+            # Не теряем записи при временной недоступности базы, но и не копим их бесконечно
+            with self.__lock:
+                self.__records = (records + self.__records)[-self.max_size * 10:]
+
+    def __run(self):
+        while not self.__closed:
+            self.__wakeup.wait(self.interval)
+            self.__wakeup.clear()
+            self.drain()
+
+class LookupCache:
+    """Справочники имён в памяти процесса: таблица загружается целиком и живёт ttl секунд
+    или до вызова invalidate. Загрузку выполняет провайдер, поэтому кэш общий для обоих драйверов.
+    Неизвестные id догружаются по одному (add), а id, которых нет и в базе, запоминаются до истечения ttl."""
+    def __init__(self, ttl: float = lookup_cache_ttl):
+        self.ttl = ttl
+        self.__tables: dict[str, tuple[float, dict[int, dict]]] = {}
+        self.__misses: dict[str, set[int]] = {}
+
+    def get(self, table: str) -> dict[int, dict] | None:
+        cached = self.__tables.get(table)
+        if cached is None or time.monotonic() - cached[0] > self.ttl:
+            return None
+        return cached[1]
+
+    def put(self, table: str, rows: list[dict]) -> dict[int, dict]:
+        values = {row['id']: row for row in rows}
+        self.__tables[table] = (time.monotonic(), values)
+        self.__misses[table] = set()
+        return values
+
+    def missing(self, table: str, ids: list[int]) -> list[int]:
+        values = self.get(table) or {}
+        misses = self.__misses.get(table, set())
+        return [id for id in dict.fromkeys(ids) if id is not None and id not in values and id not in misses]
+
+    def add(self, table: str, ids: list[int], rows: list[dict]) -> dict[int, dict]:
+        """Дополняет загруженную таблицу строками по запрошенным ids; срок жизни таблицы не продлевается.
+        Словарь заменяется новым, чтобы не менять его под читающими потоками."""
+        cached = self.__tables.get(table)
+        values = {**(cached[1] if cached else {}), **{row['id']: row for row in rows}}
+        if cached is None:
+            # Таблицу сбросили во время запроса: неполный справочник не сохраняется
+            return values
+        self.__tables[table] = (cached[0], values)
+        self.__misses[table] = self.__misses.get(table, set()) | {id for id in ids if id not in values}
+        return values
+
+    def invalidate(self, *tables: str):
+        for table in tables or list(self.__tables):
+            self.__tables.pop(table, None)
+            self.__misses.pop(table, None)
+
+# Сколько секунд ответ TMDB считается свежим, по видам запросов; 0 - не кэшировать
+response_cache_ttls = {
+    'search': 24 * 3600,
+    'details': 24 * 3600,
+    'credits': 7 * 24 * 3600,
+    'keywords': 7 * 24 * 3600,
+    'changes': 0,
+}
+
+def response_endpoint(path: str) -> str:
+    parts = path.strip('/').split('/')
+    if parts[0] == 'search':
+        return 'search'
+    if parts[0] == 'movie' and len(parts) == 2:
+        return 'changes' if parts[1] == 'changes' else 'details'
+    return parts[-1]
+
+class ResponseCache:
+    """Ответы TMDB на диске (sqlite), общие для всех процессов на машине. Ключ - путь запроса и отсортированные
+    параметры, включая язык. Устаревший ответ с ETag или Last-Modified перепроверяется условным запросом,
+    при превышении max_size удаляются давно не читанные ответы. stats - счётчики попаданий и промахов."""
+    evict_every = 100
+
+    def __init__(self, path: str = response_cache_path, max_size: int = response_cache_size, ttls: dict[str, float] = response_cache_ttls):
+        self.max_size = max_size
+        self.ttls = ttls
+        self.stats = dict.fromkeys(('hits', 'misses', 'revalidated', 'stored', 'evicted'), 0)
+        self.__lock = threading.Lock()
+        self.__puts = 0
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.__db = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.__db.execute("PRAGMA journal_mode=WAL")
+        self.__db.execute("""CREATE TABLE IF NOT EXISTS responses (
+            key TEXT PRIMARY KEY,
+            body TEXT NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            stored_at REAL NOT NULL,
+            accessed_at REAL NOT NULL,
+            size INTEGER NOT NULL
+        )""")
+        self.__db.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at_idx ON responses (accessed_at)")
+
+    @staticmethod
+    def key(path: str, params: dict) -> str:
+        return f"{path.strip('/').lower()}?{urlencode(sorted((name.lower(), str(value)) for name, value in params.items()))}"
+
+    def ttl(self, path: str) -> float:
+        return self.ttls.get(response_endpoint(path), 0)
+
+    def get(self, path: str, params: dict) -> dict | None:
+        """Сохранённый ответ: body, etag, last_modified и fresh - можно ли отдать его без запроса."""
+        if not self.ttl(path):
+            return None
+        key = self.key(path, params)
+        with self.__lock:
+            row = self.__db.execute("SELECT body, etag, last_modified, stored_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.stats['misses'] += 1
+                return None
+            fresh = time.time() - row[3] < self.ttl(path)
+            if fresh:
+                self.stats['hits'] += 1
+                self.__db.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            elif not (row[1] or row[2]):
+                self.stats['misses'] += 1
+                return None
+        return {'body': json.loads(row[0]), 'etag': row[1], 'last_modified': row[2], 'fresh': fresh}
+
+    def revalidated(self, path: str, params: dict):
+        """Сервер ответил 304: сохранённый ответ снова свежий."""
+        now = time.time()
+        with self.__lock:
+            self.stats['revalidated'] += 1
+            self.__db.execute("UPDATE responses SET stored_at = ?, accessed_at = ? WHERE key = ?", (now, now, self.key(path, params)))
+
+    def put(self, path: str, params: dict, body: dict, etag: str = None, last_modified: str = None):
+        if not self.ttl(path):
+            return
+        data = json.dumps(body, ensure_ascii=False)
+        now = time.time()
+        with self.__lock:
+            self.__db.execute(
+                "INSERT OR REPLACE INTO responses (key, body, etag, last_modified, stored_at, accessed_at, size) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (self.key(path, params), data, etag, last_modified, now, now, len(data.encode()))
+            )
+            self.stats['stored'] += 1
+            self.__puts += 1
+            # Размер проверяется не на каждой записи: при массовой загрузке подсчёт по всей таблице заметен
+            if self.__puts >= self.evict_every:
+                self.__puts = 0
+                self.__evict()
+
+    def clear(self):
+        with self.__lock:
+            self.__db.execute("DELETE FROM responses")
+
+    def close(self):
+        with self.__lock:
+            self.__db.close()
+
+    def __evict(self):
+        cursor = self.__db.execute("""
+            DELETE FROM responses WHERE key IN (
+                SELECT key FROM (SELECT key, sum(size) OVER (ORDER BY accessed_at DESC, key) AS total FROM responses)
+                WHERE total > ?
+            )
+        """, (self.max_size,))
+        self.stats['evicted'] += cursor.rowcount
+
+class PosterCache:
+    """Обложки на диске, общие для бота и приложения: файл называется по sha256 ссылки, время изменения файла
+    служит отметкой последнего чтения. Файл пишется во временный и подменяется os.replace, поэтому читатели
+    других потоков и процессов видят либо старую версию, либо новую целиком. При превышении max_size
+    удаляются давно не читанные файлы. С use_mmap файл читается через отображение в память, которое
+    закрывается сразу после копирования."""
+    # Как часто оценка размера каталога уточняется полным обходом: в каталог пишут и другие процессы
+    scan_interval = 60
+    # Временные файлы старше этого срока оставлены упавшими процессами и удаляются при обходе
+    stale_tmp_age = 3600
+
+    def __init__(self, directory: str = poster_cache_dir, max_size: int = poster_cache_size, use_mmap: bool = poster_cache_mmap):
+        self.directory = directory
+        self.max_size = max_size
+        self.use_mmap = use_mmap
+        self.__lock = threading.Lock()
+        # Размер каталога: записи этого процесса плюс периодический обход, который учитывает и чужие записи
+        self.__size: int = None
+        self.__scanned_at = 0.0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, url: str) -> str:
+        digest = hashlib.sha256(url.strip().encode()).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def get(self, url: str) -> bytes | None:
+        path = self.path(url)
+        try:
+            with open(path, 'rb') as file:
+                if self.use_mmap:
+                    with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                        data = mapped[:]
+                else:
+                    data = file.read()
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return data
+
+    def put(self, url: str, data: bytes):
+        if not data:
+            return
+        path = self.path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        file = tempfile.NamedTemporaryFile(dir=os.path.dirname(path), prefix='.tmp-', delete=False)
+        try:
+            with file:
+                file.write(data)
+            os.replace(file.name, path)
+        finally:
+            # После os.replace временного файла уже нет; при ошибке записи недописанный файл удаляется
+            try:
+                os.remove(file.name)
+            except FileNotFoundError:
+                pass
+        with self.__lock:
+            if self.__size is None or time.monotonic() - self.__scanned_at > self.scan_interval:
+                self.__size = self.__scan()[1]
+            else:
+                self.__size += len(data)
+            if self.__size > self.max_size:
+                self.__evict()
+
+    def __scan(self) -> tuple[list[tuple[float, int, str]], int]:
+        files = []
+        now = time.time()
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:
+                    continue
+                # Недописанные файлы других записей не трогаются, брошенные - удаляются
+                if name.startswith('.tmp-'):
+                    if now - stat.st_mtime > self.stale_tmp_age:
+                        try:
+                            os.remove(os.path.join(root, name))
+                        except FileNotFoundError:
+                            pass
+                    continue
+                files.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+        self.__scanned_at = time.monotonic()
+        return files, sum(size for _, size, _ in files)
+
+    def __evict(self):
+        # Удаление идёт с запасом до 90% лимита, чтобы обход каталога не повторялся на каждой записи
+        files, size = self.__scan()
+        for _, file_size, path in sorted(files):
+            if size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        self.__size = size
+
+def lookup_names(values: dict[int, dict], ids: list[int]) -> list[str]:
+    return [values[id]['name'] for id in ids if id in values]
 
 class DataProvider:
-    def __init__(self):
+    def __init__(self, minconn: int = pool_min, maxconn: int = pool_max):
         self.session = DNSClientSession('9.9.9.9')
+        self.pool = ConnectionPool(minconn, maxconn)
+        self.query_log = QueryLogBuffer(self.__flush_queries)
+        self.lookups = LookupCache()
+        self.__responses: ResponseCache = None
+        self.__tmdb: SharedClient = None
+        self.__posters: PosterCache = None
+        self.__caches_lock = threading.Lock()
+        self.__recommender: ContentRecommender = None
+        self.__recommender_built_at = 0.0
+        self.__recommender_lock = threading.Lock()
+
+    def close(self):
+        self.query_log.close()
+        if self.__tmdb:
+            self.__tmdb.close()
+        if self.__responses:
+            self.__responses.close()
+        self.pool.close()
+
+    # Кэш ответов, клиент TMDB и кэш обложек создаются при первом обращении: скриптам, которые работают только с базой,
+    # файлы кэшей не нужны
+    @property
+    def responses(self) -> ResponseCache:
+        with self.__caches_lock:
+            if self.__responses is None:
+                self.__responses = ResponseCache()
+            return self.__responses
 
+    @property
+    def tmdb(self) -> SharedClient:
+        responses = self.responses
+        with self.__caches_lock:
+            if self.__tmdb is None:
+                self.__tmdb = SharedClient(cache=responses)
+            return self.__tmdb
+
+    @property
+    def posters(self) -> PosterCache:
+        with self.__caches_lock:
+            if self.__posters is None:
+                self.__posters = PosterCache()
+            return self.__posters
+
+    # Запросы к TMDB выполняет общий клиент tmdb_client на фоновом цикле событий; вызывать их можно из любого потока
     def details(self, fid: int) -> dict:
-        request = f'{base_url[:-1].replace('!', '')}/{fid}?language=ru-RU'
-        return self.session.get(request, headers=headers).json()
-
-    def search(self, name: str):
-        request = base_url.replace('!', '/search')
-        name = quote(name, encoding='utf-8').replace('25', '')
-        request += f"query={name}&include_adult=false&language=ru-RU&page=1"
-        return self.session.get(url=request, headers=headers).json()['results'][0]
+        return self.tmdb.run(lambda client: client.details(fid))
+
+    def search(self, name: str) -> dict | None:
+        return self.tmdb.run(lambda client: client.search(name))
+
+    def find_movie(self, name: str) -> tuple[dict, dict, dict] | None:
+        """Результат поиска, подробности и титры фильма по названию; подробности и титры запрашиваются одновременно."""
+        return self.tmdb.run(lambda client: client.find_movie(name))
+
+    def match_tmdb_ids(self, table: str, rows: list[tuple]) -> dict[int, int]:
+        """id каталога для строк справочника из TMDB (tmdb_id, имя[, фамилия]): по tmdb_id, а среди записей
+        без tmdb_id - по имени. Строки, которых нет в справочнике, в результат не попадают."""
+        if not rows:
+            return {}
+        name_expr = param_name_expr(table)
+        names = [' '.join(row[1:len(tmdb_name_columns[table]) + 1]) for row in rows]
+        found = self.db_request(f"""
+            SELECT id, tmdb_id, {name_expr} AS name FROM {table}
+            WHERE tmdb_id = ANY(%s) OR (tmdb_id IS NULL AND {name_expr} = ANY(%s))
+            ORDER BY id
+        """, params=([row[0] for row in rows], names))
+        by_tmdb_id = {item['tmdb_id']: item['id'] for item in found if item['tmdb_id'] is not None}
+        by_name = {}
+        for item in found:
+            if item['tmdb_id'] is None:
+                by_name.setdefault(item['name'], item['id'])
+        ids = {}
+        for row, name in zip(rows, names):
+            item_id = by_tmdb_id.get(row[0]) or by_name.get(name)
+            if item_id is not None:
+                ids[row[0]] = item_id
+        return ids
     
     def get_image_bin(self, image_path: str):
-        url = image_path
-        response = self.session.get(url, stream=True, timeout=20)
+        cached = self.posters.get(image_path)
+        if cached is not None:
+            return cached
+        response = self.session.get(image_path, stream=True, timeout=20)
+        if response.ok:
+            self.posters.put(image_path, response.content)
         return response.content
 
-    def search_movies(self, 
-        genres_included=None, genres_excluded=None, keywords_included=None, 
-        keywords_excluded=None, actors=None, director=None, title_part=None, 
-        country=None, release_date_gte=None, release_date_lte=None,
-        order_by=None, order_dir=None):
-
-        query = sql.SQL("""
-        SELECT m.id, m.name, m.release_date, m.release_country, m.poster_link, m.rating, m.revenue, m.runtime, m.director, m.overview,
-            array_agg(DISTINCT a.id) AS actors,
-            array_agg(DISTINCT g.id) AS genres,
-            array_agg(DISTINCT k.id) AS keywords
-        FROM movies m
-        LEFT JOIN movies_actors ma ON m.id = ma.movie_id
-        LEFT JOIN actors a ON ma.actor_id = a.id
-        LEFT JOIN movies_genres mg ON m.id = mg.movie_id
-        LEFT JOIN genres g ON mg.genre_id = g.id
-        LEFT JOIN movies_keywords mk ON m.id = mk.movie_id
-        LEFT JOIN keywords k ON mk.keyword_id = k.id
-        WHERE 1=1
-        """)
+    def search_movies(self, **filters) -> list[dict]:
+        query, params = search_movies_query(**filters)
+        rows = self.db_request(query, params=params)
+        return [movie_from_row(row) for row in rows]
 
-        conditions = []
-        params = []
-
-        if genres_included:
-            conditions.append(sql.SQL("m.id IN (SELECT movie_id FROM movies_genres WHERE genre_id IN %s)"))
-            params.append(tuple(genres_included))
-        if genres_excluded:
-            conditions.append(sql.SQL("m.id NOT IN (SELECT movie_id FROM movies_genres WHERE genre_id IN %s)"))
-            params.append(tuple(genres_excluded))
-        if keywords_included:
-            conditions.append(sql.SQL("m.id IN (SELECT movie_id FROM movies_keywords WHERE keyword_id IN %s)"))
-            params.append(tuple(keywords_included))
-        if keywords_excluded:
-            conditions.append(sql.SQL("m.id NOT IN (SELECT movie_id FROM movies_keywords WHERE keyword_id IN %s)"))
-            params.append(tuple(keywords_excluded))
-        if actors:
-            conditions.append(sql.SQL("m.id IN (SELECT movie_id FROM movies_actors WHERE actor_id IN %s)"))
-            params.append(tuple(actors))
-        if director:
-            conditions.append(sql.SQL("m.director = %s"))
-            params.append(director)
-        if title_part:
-            conditions.append(sql.SQL("m.name ILIKE %s"))
-            params.append(f'%{title_part}%')
-        if country:
-            conditions.append(sql.SQL("m.release_country = %s"))
-            params.append(country)
-        if release_date_gte and release_date_lte:
-            conditions.append(sql.SQL("m.release_date BETWEEN %s AND %s"))
-            params.extend([release_date_gte, release_date_lte])
-
-        if conditions:
-            query += sql.SQL(" AND ") + sql.SQL(" AND ").join(conditions)
-
-        query += sql.SQL(" GROUP BY m.id")
-        query += sql.SQL(f" ORDER BY m.{order_by} {order_dir}")
+    def iter_search_movies(self, chunk_size: int = stream_chunk_size, **filters) -> Iterator[list[dict]]:
+        query, params = search_movies_query(**filters)
+        for rows in self.stream_request(query, params, chunk_size):
+            yield [movie_from_row(row) for row in rows]
 
+    def search_movies_page(self, page_size: int = 10, cursor: str = None, **filters) -> tuple[list[dict], str | None]:
+        query, params = search_movies_page_query(page_size, cursor, **filters)
         rows = self.db_request(query, params=params)
-
-        movies: list[dict] = []
-        for row in rows:
-            movie = {
-                'id': row['id'],
-                'name': row['name'],
-                'release_date': row['release_date'],
-                'release_country': row['release_country'],
-                'poster_link': row['poster_link'],
-                'rating': round(row['rating'], 1),
-                'revenue': row['revenue'],
-                'runtime': row['runtime'],
-                'director': row['director'],
-                'overview': row['overview'],
-                'actors': row['actors'],
-                'genres': row['genres'],
-                'keywords': row['keywords']
-            }
-            movies.append(movie)
-        return movies
+        return movies_page_from_rows(rows, page_size, filters.get('order_by'))
     
+    def lookup(self, table: str, ids: list[int] = ()) -> dict[int, dict]:
+        values = self.lookups.get(table)
+        if values is None:
+            values = self.lookups.put(table, self.db_request(lookup_queries[table]))
+        # Неизвестный id означает, что справочник пополнился после загрузки: догружаются только такие строки
+        missing = self.lookups.missing(table, ids)
+        if missing:
+            values = self.lookups.add(table, missing, self.db_request(lookup_by_ids_query(table), params=(missing,)))
+        return values
+
+    def warm_up_lookups(self):
+        for table in lookup_queries:
+            self.lookup(table)
+
     def get_actor_names(self, actor_ids: list[int]) -> list[str]:
         if not actor_ids:
             return []
-        query = sql.SQL("SELECT (name || ' ' || surname) as name FROM actors WHERE id IN %s")
-        rows = self.db_request(query, params=(tuple(actor_ids),))
-        return [row['name'] for row in rows]
+        return lookup_names(self.lookup('actors', actor_ids), actor_ids)
     
-    def get_director_name(self, director_id: int) -> list[str]:
+    def get_director_name(self, director_id: int) -> str:
         if director_id:
-            query = sql.SQL("SELECT (name || ' ' || surname) as name FROM directors WHERE id = %s")
-            rows = self.db_request(query, params=(director_id,))
-            return rows[0].get('name')
+            return self.lookup('directors', [director_id]).get(director_id, {}).get('name')
     
-    def get_country_name(self, country_id: int = None, alpha2: str = None) -> list[str]:
+    def get_country_name(self, country_id: int = None, alpha2: str = None):
         if country_id:
-            query = sql.SQL("SELECT name FROM countries WHERE id = %s")
-            rows = self.db_request(query, params=(country_id,))
-            return rows[0].get('name')
+            return self.lookup('countries', [country_id]).get(country_id, {}).get('name')
         
         elif alpha2:
-            query = sql.SQL("SELECT id FROM countries WHERE alpha2 = %s")
-            rows = self.db_request(query, params=(alpha2,))
-            return rows[0].get('id')
+            return next((country['id'] for country in self.lookup('countries').values() if country['alpha2'] == alpha2), None)
 
     def get_genre_names(self, genre_ids: list[int]) -> list[str]:
         if not genre_ids:
             return []
-        query = sql.SQL("SELECT name FROM genres WHERE id IN %s")
-        rows = self.db_request(query, params=(tuple(genre_ids),))
-        return [row['name'] for row in rows]
+        return lookup_names(self.lookup('genres', genre_ids), genre_ids)
 
     def get_keyword_names(self, keyword_ids: list[int]) -> list[str]:
         if not keyword_ids:
             return []
-        query = sql.SQL("SELECT name FROM keywords WHERE id IN %s")
-        rows = self.db_request(query, params=(tuple(keyword_ids),))
-        return [row['name'] for row in rows]
+        return lookup_names(self.lookup('keywords', keyword_ids), keyword_ids)
     
     def add_to_list(self, user_id: int, movie_id: int, list_name: str):
-        self.db_request(f"INSERT INTO {list_name} (user_id, movie_id) VALUES ({user_id}, {movie_id})", False)
+        with self.transaction() as cursor:
+            cursor.execute(profile_lock_query, (user_id,))
+            cursor.execute(f"INSERT INTO {list_table(list_name)} (user_id, movie_id) VALUES (%s, %s) ON CONFLICT DO NOTHING", (user_id, movie_id))
+            if list_name == 'favorite_movies' and cursor.rowcount:
+                for statement, params in profile_delta_statements(user_id, movie_id, 1):
+                    cursor.execute(statement, params)
+                cursor.execute(invalidate_recommendations_query, (user_id,))
 
     def remove_from_list(self, user_id: int, movie_id: int, list_name: str):
-        self.db_request(f"DELETE FROM {list_name} WHERE user_id = {user_id} AND movie_id = {movie_id}", False)
+        with self.transaction() as cursor:
+            cursor.execute(profile_lock_query, (user_id,))
+            cursor.execute(f"DELETE FROM {list_table(list_name)} WHERE user_id = %s AND movie_id = %s", (user_id, movie_id))
+            if list_name == 'favorite_movies' and cursor.rowcount:
+                for statement, params in profile_delta_statements(user_id, movie_id, -1):
+                    cursor.execute(statement, params)
+                cursor.execute(invalidate_recommendations_query, (user_id,))
 
     def is_in_list(self, user_id: int, movie_id: int, list_name: str) -> bool:
-        result = self.db_request(f"SELECT 1 FROM {list_name} WHERE user_id = {user_id} AND movie_id = {movie_id}")
+        result = self.db_request(f"SELECT 1 FROM {list_table(list_name)} WHERE user_id = %s AND movie_id = %s", params=(user_id, movie_id))
         return bool(result)
     
-    def get_params_by_page(self, param_name: str, page: int = 0, page_len: int = 10, get_all: bool = False) -> list[dict]:
-        attrs = 'id, name'
-        match param_name:
-            case 'actors' | 'director':
-                attrs = "id, (name || ' ' || surname) as name"
-        match param_name:
-            case 'director':
-                param_name += 's'
-            case 'country':
-                param_name = 'countries'
-        if get_all:
-            query = f"SELECT {attrs} FROM {param_name}"
-        else:
-            query = f"SELECT {attrs} FROM {param_name} LIMIT {page_len} OFFSET {page * page_len}"
-        return self.db_request(query)
+    def get_params_by_page(self, param_name: str, after: list = None, page_len: int = 10) -> tuple[list[dict], list | None]:
+        query, params = params_page_query(param_name, after, page_len)
+        return params_page(self.db_request(query, params=params), page_len)
+
+    def suggest(self, table: str, text: str, limit: int = 10) -> list[dict]:
+        query, params = suggest_query(table, text, limit)
+        return self.db_request(query, params=params)
+
+    def find_param(self, table: str, text: str) -> dict | None:
+        query, params = exact_param_query(table, text)
+        rows = self.db_request(query, params=params)
+        return rows[0] if rows else None
     
     def get_movies_from_list(self, user_id: int, list_name: str) -> list[dict]:
-        query = f"""
-        SELECT m.id, m.name, m.release_date, m.release_country, m.poster_link, m.rating, m.revenue, m.runtime, m.director, m.overview,
-               array_agg(DISTINCT a.id) AS actors,
-               array_agg(DISTINCT g.id) AS genres,
-               array_agg(DISTINCT k.id) AS keywords
-        FROM movies m
-        LEFT JOIN {list_name} fm ON m.id = fm.movie_id
-        LEFT JOIN movies_actors ma ON m.id = ma.movie_id
-        LEFT JOIN actors a ON ma.actor_id = a.id
-        LEFT JOIN movies_genres mg ON m.id = mg.movie_id
-        LEFT JOIN genres g ON mg.genre_id = g.id
-        LEFT JOIN movies_keywords mk ON m.id = mk.movie_id
-        LEFT JOIN keywords k ON mk.keyword_id = k.id
-        WHERE fm.user_id = {user_id}
-        GROUP BY m.id
-        """
-        rows = self.db_request(query)
-        movies = []
-        for row in rows:
-            movie = {
-                'id': row['id'],
-                'name': row['name'],
-                'release_date': row['release_date'],
-                'release_country': row['release_country'],
-                'poster_link': row['poster_link'],
-                'rating': round(row['rating'], 1),
-                'revenue': row['revenue'],
-                'runtime': row['runtime'],
-                'director': row['director'],
-                'overview': row['overview'],
-                'actors': row['actors'],
-                'genres': row['genres'],
-                'keywords': row['keywords']
-            }
-            movies.append(movie)
-        return movies
+        query, params = movies_from_list_query(user_id, list_name)
+        rows = self.db_request(query, params=params)
+        return [movie_from_row(row) for row in rows]
+    
+    def iter_movies_from_list(self, user_id: int, list_name: str, chunk_size: int = stream_chunk_size) -> Iterator[list[dict]]:
+        query, params = movies_from_list_query(user_id, list_name)
+        for rows in self.stream_request(query, params, chunk_size):
+            yield [movie_from_row(row) for row in rows]
     
-    def save_movie(self, movie_data: dict, is_new: bool):
+    def save_movie(self, movie_data: dict, is_new: bool) -> int:
         if not is_new:
             query = sql.SQL('''
                 UPDATE movies 
@@ -228,9 +1177,9 @@ class DataProvider:
         else:
             query = sql.SQL('''
             INSERT INTO movies (name, release_date, release_country, poster_link, 
-                rating, revenue, runtime, director, overview)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-            
+                rating, revenue, runtime, director, overview, tmdb_id)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING id
         ''')
         params = [
             movie_data.get('name'),
@@ -245,76 +1194,81 @@ class DataProvider:
         ]
         if not is_new:
             params.append(movie_data.get('id'))
-        self.db_request(query, False, params)
-
-        if 'actors_for_delete' in movie_data:
-            delete_actors_query = sql.SQL('''
-                DELETE FROM movies_actors 
-                WHERE movie_id = %s AND actor_id = %s
-            ''')
-            for actor_id in movie_data.get('actors_for_delete', []):
-                if actor_id is None:
-                    continue
-                self.db_request(delete_actors_query, False, [movie_data.get('id'), actor_id])
+        else:
+            # Карточка, найденная в TMDB, потом обновляется sync_tmdb.py и не дублируется import_catalog.py
+            params.append(movie_data.get('tmdb_id'))
 
-        if 'actors_for_insert' in movie_data:
-            insert_actors_query = sql.SQL('''
-                INSERT INTO movies_actors (movie_id, actor_id)
-                VALUES (%s, %s)
-            ''')
-            for actor_id in movie_data.get('actors_for_insert', []):
-                if actor_id is None:
-                    continue
-                self.db_request(insert_actors_query, False, [movie_data.get('id'), actor_id])
+        # Фильм и все его связи сохраняются одной транзакцией, связи - групповыми запросами
+        with self.transaction() as cursor:
+            cursor.execute(query, params)
+            movie_id = cursor.fetchone()['id'] if is_new else movie_data.get('id')
 
-        if 'genres_for_delete' in movie_data:
-            delete_genres_query = sql.SQL('''
-                DELETE FROM movies_genres 
-                WHERE movie_id = %s AND genre_id = %s
-            ''')
-            for genre_id in movie_data.get('genres_for_delete', []):
-                if genre_id is None:
-                    continue
-                self.db_request(delete_genres_query, False, [movie_data.get('id'), genre_id])
+            relations_changed = is_new
+            for table, column, key in movie_relations:
+                ids_for_delete = [item_id for item_id in movie_data.get(f'{key}_for_delete', []) if item_id is not None]
+                if ids_for_delete:
+                    cursor.execute(
+                        sql.SQL('DELETE FROM {} WHERE movie_id = %s AND {} = ANY(%s)').format(sql.Identifier(table), sql.Identifier(column)),
+                        (movie_id, ids_for_delete)
+                    )
+                ids_for_insert = [item_id for item_id in movie_data.get(f'{key}_for_insert', []) if item_id is not None]
+                relations_changed = relations_changed or bool(ids_for_delete or ids_for_insert)
+                if ids_for_insert:
+                    psycopg2.extras.execute_values(
+                        cursor,
+                        sql.SQL('INSERT INTO {} (movie_id, {}) VALUES %s ON CONFLICT DO NOTHING').format(sql.Identifier(table), sql.Identifier(column)),
+                        [(movie_id, item_id) for item_id in ids_for_insert]
+                    )
 
-        if 'genres_for_insert' in movie_data:
-            insert_genres_query = sql.SQL('''
-                INSERT INTO movies_genres (movie_id, genre_id)
-                VALUES (%s, %s)
-            ''')
-            for genre_id in movie_data.get('genres_for_insert', []):
-                if genre_id is None:
-                    continue
-                self.db_request(insert_genres_query, False, [movie_data.get('id'), genre_id])
-
-        if 'keywords_for_delete' in movie_data:
-            delete_keywords_query = sql.SQL('''
-                DELETE FROM movies_keywords 
-                WHERE movie_id = %s AND keyword_id = %s
-            ''')
-            for keyword_id in movie_data.get('keywords_for_delete', []):
-                if keyword_id is None:
-                    continue
-                self.db_request(delete_keywords_query, False, [movie_data.get('id'), keyword_id])
+            # Сигнатура для поиска похожих пересчитывается только при изменении связей фильма
+            if relations_changed:
+                cursor.execute(movie_features_query, {'movie_id': movie_id})
+                features = [(row['feature_type'], row['feature_id']) for row in cursor.fetchall()]
+                for statement, params in signature_statements(movie_id, features):
+                    cursor.execute(statement, params)
 
-        if 'keywords_for_insert' in movie_data:
-            insert_keywords_query = sql.SQL('''
-                INSERT INTO movies_keywords (movie_id, keyword_id)
-                VALUES (%s, %s)
-            ''')
-            for keyword_id in movie_data.get('keywords_for_insert', []):
-                if keyword_id is None:
-                    continue
-                self.db_request(insert_keywords_query, False, [movie_data.get('id'), keyword_id])
+        movie_data['id'] = movie_id
+        return movie_id
         
     def delete_movie(self, movie_id: int):
-        query = sql.SQL('DELETE FROM movies WHERE id = %s')
-        params = [movie_id]
-        self.db_request(query, False, params)
+        with self.transaction() as cursor:
+            for table, _, _ in movie_relations:
+                cursor.execute(sql.SQL('DELETE FROM {} WHERE movie_id = %s').format(sql.Identifier(table)), (movie_id,))
+            for statement, params in signature_statements(movie_id, ()):
+                cursor.execute(statement, params)
+            for statement in movie_references_delete:
+                cursor.execute(statement, {'movie_id': movie_id})
+            cursor.execute(sql.SQL('DELETE FROM movies WHERE id = %s'), (movie_id,))
+
+    @contextmanager
+    def transaction(self):
+        with self.pool.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                    yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
         
+    def stream_request(self, query: str, params = None, chunk_size: int = stream_chunk_size) -> Iterator[list[dict]]:
+        """Выполняет запрос через именованный (серверный) курсор и отдаёт строки порциями по chunk_size,
+        не загружая весь результат в память. Соединение занято, пока генератор не исчерпан или не закрыт."""
+        with self.pool.connection() as conn:
+            conn.autocommit = False
+            try:
+                with conn.cursor(name=f'stream_{uuid.uuid4().hex}', cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                    cursor.itersize = chunk_size
+                    cursor.execute(query, params)
+                    while rows := cursor.fetchmany(chunk_size):
+                        yield rows
+            finally:
+                conn.rollback()
+
     def db_request(self, query: str, get: bool = True, params = None):
         result = None
-        with closing(psycopg2.connect(dbname=dbname, user=user, password=password, host=host)) as conn:
+        with self.pool.connection() as conn:
             conn.autocommit = True
             with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
                 try:
@@ -329,12 +1283,15 @@ class DataProvider:
         return result
     
     def set_movie_score(self, user_id: int, movie_id: int, score: int):
-        self.db_request(f"""
-            INSERT INTO movies_scores (user_id, movie_id, score)
-            VALUES ({user_id}, {movie_id}, {score})
-            ON CONFLICT (user_id, movie_id) DO UPDATE
-            SET score = EXCLUDED.score
-        """, False)
+        with self.transaction() as cursor:
+            cursor.execute(profile_lock_query, (user_id,))
+            cursor.execute(old_score_query, (user_id, movie_id))
+            old_score = cursor.fetchone()
+            cursor.execute(set_movie_score_query, (user_id, movie_id, score))
+            delta = score_weight(score) - score_weight(old_score['score'] if old_score else None)
+            for statement, params in profile_delta_statements(user_id, movie_id, delta):
+                cursor.execute(statement, params)
+            cursor.execute(invalidate_recommendations_query, (user_id,))
 
     def get_movie_score(self, movie_id: int, user_id: int):
         result = self.db_request(f"""
@@ -355,256 +1312,119 @@ class DataProvider:
         return 0
 
     def update_query(self, user_id, film_name, lower_date, upper_date, film_release_country, director, date, actors, genres, genres_no, keywords, keywords_no):
-        params = {
-            'user_id': user_id,
-            'movie_name': film_name,
-            'lower_date': lower_date,
-            'upper_date': upper_date,
-            'movie_release_country': film_release_country,
-            'director': director,
-            'date': date
-        }
-
-        filtered_params = {k: v for k, v in params.items() if v is not None}
-
-        columns = ', '.join(filtered_params.keys())
-        placeholders = ', '.join(['%s'] * len(filtered_params))
-        query = f"""
-            INSERT INTO queries ({columns})
-            VALUES ({placeholders})
-            RETURNING id;
-        """
-
-        result = self.db_request(query, params=tuple(filtered_params.values()))
-        query_id = result[0].get('id')
-
-        for actor_id in actors or []:
-            self.db_request("""
-                INSERT INTO query_actors (query_id, actor_id)
-                VALUES (%s, %s);
-            """, get=False, params=(query_id, actor_id))
-
-        for genre_id in genres or []:
-            self.db_request("""
-                INSERT INTO query_genres (query_id, genre_id)
-                VALUES (%s, %s);
-            """, get=False, params=(query_id, genre_id))
-
-        for genre_id in genres_no or []:
-            self.db_request("""
-                INSERT INTO query_genres_no (query_id, genre_id)
-                VALUES (%s, %s);
-            """, get=False, params=(query_id, genre_id))
-
-        for keyword_id in keywords or []:
-            self.db_request("""
-                INSERT INTO query_keywords (query_id, keyword_id)
-                VALUES (%s, %s);
-            """, get=False, params=(query_id, keyword_id))
-
-        for keyword_id in keywords_no or []:
-            self.db_request("""
-                INSERT INTO query_keywords_no (query_id, keyword_id)
-                VALUES (%s, %s);
-            """, get=False, params=(query_id, keyword_id))
-            
-    def get_stats(self) -> dict[str, int | dict]:
-        # Основная статистика
-        usr_cnt = len(self.db_request('SELECT * FROM users'))
-        query_month = len(self.db_request("SELECT * FROM queries WHERE date > CURRENT_DATE - '1 month'::interval"))
-        query_week = len(self.db_request("SELECT * FROM queries WHERE date > CURRENT_DATE - '1 week'::interval"))
-        query_day = len(self.db_request("SELECT * FROM queries WHERE date > CURRENT_DATE - '1 day'::interval"))
-        favorite = len(self.db_request("SELECT * FROM favorite_movies"))
-        watchlist = len(self.db_request("SELECT * FROM watchlist"))
-
-        # Статистика по актёрам, ключевым словам, жанрам и режиссёрам
-        def get_param_stats(table_name: str, interval: str) -> dict[str, int]:
-            """Возвращает статистику по параметрам (актёры, ключевые слова, жанры) за указанный интервал."""
-            query = f"""
-                SELECT {table_name}.name, COUNT(*) as count
-                FROM queries
-                JOIN query_{table_name} ON queries.id = query_{table_name}.query_id
-                JOIN {table_name} ON query_{table_name}.{table_name[:-1]}_id = {table_name}.id
-                WHERE queries.date > CURRENT_DATE - '{interval}'::interval
-                GROUP BY {table_name}.name
-                ORDER BY count DESC
-                LIMIT 3
-            """
-            results = self.db_request(query)
-            return [row['name'] for row in results]
-
-        def get_actor_stats(interval: str) -> dict[str, int]:
-            """Возвращает статистику по актёрам за указанный интервал."""
-            query = f"""
-                SELECT actors.name, actors.surname, COUNT(*) as count
-                FROM queries
-                JOIN query_actors ON queries.id = query_actors.query_id
-                JOIN actors ON query_actors.actor_id = actors.id
-                WHERE queries.date > CURRENT_DATE - '{interval}'::interval
-                GROUP BY actors.name, actors.surname
-                ORDER BY count DESC
-                LIMIT 3
-            """
-            results = self.db_request(query)
-            return [f"{row['name']} {row['surname']}" for row in results]
-
-        def get_director_stats(interval: str) -> dict[str, int]:
-            """Возвращает статистику по режиссёрам за указанный интервал."""
-            query = f"""
-                SELECT directors.name, directors.surname, COUNT(*) as count
-                FROM queries
-                JOIN directors ON queries.director = directors.id
-                WHERE queries.date > CURRENT_DATE - '{interval}'::interval
-                GROUP BY directors.name, directors.surname
-                ORDER BY count DESC
-                LIMIT 3
-            """
-            results = self.db_request(query)
-            return [f"{row['name']} {row['surname']}" for row in results]
-
-        # Сбор статистики за день, неделю и месяц
-        user_queries_day = {
-            'actors': get_actor_stats('1 day'),
-            'keywords': get_param_stats('keywords', '1 day'),
-            'genres': get_param_stats('genres', '1 day'),
-            'directors': get_director_stats('1 day'),
-        }
-
-        user_queries_week = {
-            'actors': get_actor_stats('1 week'),
-            'keywords': get_param_stats('keywords', '1 week'),
-            'genres': get_param_stats('genres', '1 week'),
-            'directors': get_director_stats('1 week'),
-        }
-
-        user_queries_month = {
-            'actors': get_actor_stats('1 month'),
-            'keywords': get_param_stats('keywords', '1 month'),
-            'genres': get_param_stats('genres', '1 month'),
-            'directors': get_director_stats('1 month'),
-        }
-
-        # Возвращаем все данные
-        return {
-            'usr_cnt': usr_cnt,
-            'query_month': query_month,
-            'query_week': query_week,
-            'query_day': query_day,
-            'favorite': favorite,
-            'watchlist': watchlist,
-            'user_queries_day': user_queries_day,
-            'user_queries_week': user_queries_week,
-            'user_queries_month': user_queries_month,
-        }
+        self.query_log.add(query_record(user_id, film_name, lower_date, upper_date, film_release_country, director, date,
+                                        actors, genres, genres_no, keywords, keywords_no))
+
+    def __flush_queries(self, records: list[dict]):
+        with self.transaction() as cursor:
+            cursor.execute(query_ids_query, (len(records),))
+            query_ids = [row['id'] for row in cursor.fetchall()]
+            queries, links = query_log_rows(records, query_ids)
+            for columns, rows in queries.items():
+                psycopg2.extras.execute_values(cursor, f"INSERT INTO queries ({', '.join(columns)}) VALUES %s", rows)
+            for table, column, _ in query_links:
+                if links[table]:
+                    psycopg2.extras.execute_values(cursor, f"INSERT INTO {table} (query_id, {column}) VALUES %s", links[table])
+            for statement in query_rollup_by_ids:
+                cursor.execute(statement, {'ids': query_ids})
+
+    def rebuild_query_rollups(self, date_from: datetime.date, date_to: datetime.date):
+        """Пересобирает дневные агрегаты за [date_from, date_to) по сырому журналу, кроме дней, уже свёрнутых
+        retention.py. Блокировка не даёт параллельной записи журнала посчитать свои запросы дважды."""
+        with self.transaction() as cursor:
+            cursor.execute(query_rollup_lock)
+            params = {'date_from': date_from, 'date_to': date_to}
+            for statement in query_rollup_clear + query_rollup_by_dates:
+                cursor.execute(statement, params)
+
+
+    def get_stats(self, on_section: Callable[[str, dict], None] = None, timeout: float = stats_timeout) -> dict[str, int | dict]:
+        """Выполняет разделы статистики параллельно на соединениях пула. Каждый готовый раздел передаётся
+        в on_section; разделы, не уложившиеся в timeout или завершившиеся ошибкой, остаются нулевыми."""
+        stats = empty_stats()
+        deadline = time.monotonic() + timeout
+
+        def run_section(name: str) -> dict:
+            query, params = stats_sections[name]
+            remaining = max(deadline - time.monotonic(), 0.001)
+            with self.transaction() as cursor:
+                cursor.execute("SELECT set_config('statement_timeout', %s, true)", (str(int(remaining * 1000)),))
+                cursor.execute(query, params)
+                rows = cursor.fetchall()
+            if name in stats_dimensions:
+                names = self.lookup(name, [row['item_id'] for row in rows])
+                for row in rows:
+                    row['name'] = names.get(row['item_id'], {}).get('name')
+            return stats_section(name, rows)
+
+        executor = ThreadPoolExecutor(max_workers=stats_workers)
+        futures = {executor.submit(run_section, name): name for name in stats_sections}
+        try:
+            for future in as_completed(futures, timeout=timeout):
+                try:
+                    section = future.result()
+                except Exception:
+                    print(traceback.format_exc())
+                    continue
+                merge_stats(stats, section)
+                if on_section is not None:
+                    on_section(futures[future], section)
+        except TimeoutError:
+            print(f'Статистика собрана не полностью: разделы не уложились в {timeout} с')
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        return stats
     
     def get_credits(self, id):
-        actors = []
-        director = None
-        credits_url = f"https://api.themoviedb.org/3/movie/{id}/credits?language=ru-RU"
-        credits_response = self.session.get(credits_url, headers=headers).json()
-        cast: list = credits_response['cast']
-        crew = credits_response['crew']
-        credits_response = cast + crew
-        for credit in credits_response:
-            name = credit['name']
-            if self.is_cyrillic(name):
-                ns = name.split()
-                if len(ns) < 2:
-                    continue
-                if credit['known_for_department'] == 'Acting':
-                    actors.append((credit['id'], ns[0], ns[1]))
-                elif credit['known_for_department'] == 'Directing':
-                    director = [credit['id'], ns[0], ns[1]]
-                    break
-        return actors, director
+        return parse_credits(self.tmdb.run(lambda client: client.credits(id)))
     
-    def get_personal_recommendations(self, user_id: int) -> list[dict]:
-        preferences_query = """
-            SELECT movie_id FROM movies_scores WHERE user_id = %s
-            UNION
-            SELECT movie_id FROM favorite_movies WHERE user_id = %s;
-        """
-        preferences = self.db_request(preferences_query, params=(user_id, user_id))
-        
-        if not preferences:
+    def content_recommender(self) -> ContentRecommender:
+        """Матрица каталога строится при первом обращении и перестраивается раз в recommender_ttl секунд."""
+        with self.__recommender_lock:
+            if self.__recommender is None or time.monotonic() - self.__recommender_built_at > recommender_ttl:
+                movies = self.db_request(recommender_movies_query)
+                relations = {feature_type: self.db_request(query) for feature_type, query in recommender_relation_queries.items()}
+                self.__recommender = ContentRecommender.from_rows(movies, relations)
+                self.__recommender_built_at = time.monotonic()
+            return self.__recommender
+
+    def update_movies(self, rows: list[tuple]):
+        """Групповое обновление полей фильмов, которые меняются в TMDB (movies_update_query); строки начинаются с id TMDB."""
+        with self.transaction() as cursor:
+            psycopg2.extras.execute_values(cursor, movies_update_query, rows, template=movies_update_template, page_size=1000)
+
+    def get_movies_by_ids(self, movie_ids: list[int]) -> list[dict]:
+        if not movie_ids:
             return []
+        query, params = movies_by_ids_query(movie_ids)
+        return movies_in_order(self.db_request(query, params=params), movie_ids)
 
-        features_query = """
-            WITH preferred_features AS (
-                SELECT 
-                    mg.genre_id AS feature_id,
-                    'genre' AS feature_type,
-                    COUNT(*) AS score
-                FROM movies_genres mg
-                WHERE mg.movie_id IN %s
-                GROUP BY mg.genre_id
-                
-                UNION ALL
-                
-                SELECT 
-                    mk.keyword_id AS feature_id,
-                    'keyword' AS feature_type,
-                    COUNT(*) AS score
-                FROM movies_keywords mk 
-                WHERE mk.movie_id IN %s
-                GROUP BY mk.keyword_id
-                
-                UNION ALL
-                
-                SELECT 
-                    ma.actor_id AS feature_id,
-                    'actor' AS feature_type,
-                    COUNT(*) AS score 
-                FROM movies_actors ma
-                WHERE ma.movie_id IN %s
-                GROUP BY ma.actor_id
-            )
-            SELECT feature_id, feature_type
-            FROM preferred_features
-            ORDER BY score DESC
-            LIMIT 10;
-        """
-        movie_ids = tuple([pref['movie_id'] for pref in preferences])
-        top_features = self.db_request(features_query, params=(movie_ids, movie_ids, movie_ids))
-
-        if not top_features:
+    def similar_movies(self, movie_id: int, k: int = similar_movies_count) -> list[dict]:
+        """До k фильмов, ближайших к данному по жанрам, ключевым словам и актёрам (индекс MinHash LSH)."""
+        rows = self.db_request(movie_signature_query, params=(movie_id,))
+        if not rows:
             return []
+        candidates = self.db_request(similar_candidates_query, params={'movie_id': movie_id})
+        similar_ids = rank_similar(signature_from_bytes(rows[0]['signature']), [(row['movie_id'], row['signature']) for row in candidates], k)
+        return self.get_movies_by_ids(similar_ids)
 
-        feature_ids_by_type = {
-            'genre': [],
-            'keyword': [],
-            'actor': []
-        }
-        for feature in top_features:
-            feature_ids_by_type[feature['feature_type']].append(feature['feature_id'])
-
-        movies_query = """
-            SELECT DISTINCT m.*
-            FROM movies m
-            LEFT JOIN movies_genres mg ON mg.movie_id = m.id
-            LEFT JOIN movies_keywords mk ON mk.movie_id = m.id
-            LEFT JOIN movies_actors ma ON ma.movie_id = m.id
-            WHERE 
-                (mg.genre_id IN %s OR %s = FALSE) AND
-                (mk.keyword_id IN %s OR %s = FALSE) AND
-                (ma.actor_id IN %s OR %s = FALSE)
-                AND m.id NOT IN %s
-            ORDER BY m.rating DESC
-            LIMIT 3;
-        """
-        genre_ids = tuple(feature_ids_by_type['genre']) if feature_ids_by_type['genre'] else (0,)
-        keyword_ids = tuple(feature_ids_by_type['keyword']) if feature_ids_by_type['keyword'] else (0,)
-        actor_ids = tuple(feature_ids_by_type['actor']) if feature_ids_by_type['actor'] else (0,)
-        exclude_movie_ids = tuple([pref['movie_id'] for pref in preferences]) if preferences else (0,)
-
-        recommended_movies = self.db_request(
-            movies_query,
-            params=(
-                genre_ids, not feature_ids_by_type['genre'],
-                keyword_ids, not feature_ids_by_type['keyword'],
-                actor_ids, not feature_ids_by_type['actor'],
-                exclude_movie_ids
-            )
-        )
+    def get_personal_recommendations(self, user_id: int, k: int = compilation_size) -> list[dict]:
+        """Подборка, заранее посчитанная recommend_batch.py, или расчёт на месте с сохранением результата.
+        Сохранённая подборка короче k считается заново."""
+        rows = self.db_request(precomputed_recommendations_query, params=(user_id,))
+        if rows and len(rows[0]['movie_ids']) >= k:
+            return self.get_movies_by_ids(rows[0]['movie_ids'][:k])
 
-        return recommended_movies
\ No newline at end of file
+        recommender = self.content_recommender()
+        with self.transaction() as cursor:
+            cursor.execute(preferences_query, (user_id, user_id))
+            movie_ids = [row['movie_id'] for row in cursor.fetchall()]
+            recommended_ids = []
+            if movie_ids:
+                cursor.execute(user_profile_query, (user_id,))
+                profile = user_profile(recommender, cursor.fetchall(), movie_ids)
+                cursor.execute(neighbours_query, (movie_ids,))
+                neighbours = {row['neighbour_id']: row['score'] for row in cursor.fetchall()}
+                recommended_ids = recommender.recommend(profile, k, movie_ids, neighbours, neighbours_weight)
+            cursor.execute(store_recommendation_query, (user_id, recommended_ids))
+        return self.get_movies_by_ids(recommended_ids)
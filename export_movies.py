@@ -0,0 +1,54 @@
+"""Выгрузка фильмов в CSV порциями через серверный курсор: память не растёт с размером выборки.
+
+    python export_movies.py movies.csv --genre 18 --order-by rating
+    python export_movies.py favorites.csv --user 123456 --list favorite_movies
+"""
+from data_provider import DataProvider, movie_lists, sort_columns, sort_directions
+import argparse, csv
+
+columns = ('id', 'name', 'release_date', 'release_country', 'poster_link', 'rating', 'revenue', 'runtime',
+           'director', 'overview', 'actors', 'genres', 'keywords')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('output')
+    parser.add_argument('--user', type=int, help='выгрузить список пользователя вместо результатов поиска')
+    parser.add_argument('--list', choices=movie_lists, default='favorite_movies')
+    parser.add_argument('--genre', type=int, action='append', dest='genres_included')
+    parser.add_argument('--keyword', type=int, action='append', dest='keywords_included')
+    parser.add_argument('--actor', type=int, action='append', dest='actors')
+    parser.add_argument('--director', type=int)
+    parser.add_argument('--country', type=int)
+    parser.add_argument('--order-by', choices=sort_columns, default='id')
+    parser.add_argument('--order-dir', choices=sort_directions, default='ASC')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    args = parser.parse_args()
+
+    data_provider = DataProvider(minconn=1, maxconn=1)
+    try:
+        if args.user is not None:
+            chunks = data_provider.iter_movies_from_list(args.user, args.list, args.chunk_size)
+        else:
+            chunks = data_provider.iter_search_movies(
+                args.chunk_size,
+                genres_included=args.genres_included,
+                keywords_included=args.keywords_included,
+                actors=args.actors,
+                director=args.director,
+                country=args.country,
+                order_by=args.order_by,
+                order_dir=args.order_dir
+            )
+        exported = 0
+        with open(args.output, 'w', newline='', encoding='utf-8') as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            for movies in chunks:
+                writer.writerows(movies)
+                exported += len(movies)
+        print(f'Выгружено фильмов: {exported}')
+    finally:
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,236 @@
+"""Массовая загрузка фильмов из TMDB в каталог.
+
+На вход - файл, в каждой строке которого название фильма или id TMDB. Фильмы обрабатываются пачками:
+пока пачка записывается в базу одной транзакцией, следующая уже загружается из API. Для каждого фильма
+одновременно запрашиваются подробности, титры и ключевые слова. Фильмы, жанры, ключевые слова, актёры
+и режиссёры сопоставляются с TMDB по столбцу tmdb_id и создаются групповыми upsert; собственные id каталога
+остаются последовательными. Записи, заведённые вручную без tmdb_id, сопоставляются по имени (у фильмов - по
+названию и дате выхода), чтобы не появлялись дубликаты. Связи фильма заменяются целиком, а сигнатура похожих
+пересчитывается.
+
+Записанные пачки отмечаются в файле контрольной точки, поэтому прерванную загрузку можно просто запустить снова.
+С --record ответы API сохраняются в каталог, с --replay загрузка идёт из него без сети.
+
+    python import_catalog.py titles.txt
+    python import_catalog.py ids.txt --record fixtures/
+    python import_catalog.py ids.txt --replay fixtures/ --checkpoint /tmp/replay.checkpoint
+"""
+from data_provider import DataProvider, movie_relations, minhasher, param_name_expr, tmdb_name_columns
+from similarity import signature_to_bytes
+from tmdb_client import TMDBClient, FixtureClient, TMDBError, parse_credits
+import argparse, asyncio, os, psycopg2.extras
+
+# Строки каждой таблицы начинаются с (tmdb_id, ...) в порядке столбцов; RETURNING даёт соответствие id TMDB и каталога
+upsert_queries = {
+    'genres': """
+        INSERT INTO genres (tmdb_id, name) VALUES %s
+        ON CONFLICT (tmdb_id) DO UPDATE SET name = EXCLUDED.name
+        RETURNING id, tmdb_id
+    """,
+    'keywords': """
+        INSERT INTO keywords (tmdb_id, name) VALUES %s
+        ON CONFLICT (tmdb_id) DO UPDATE SET name = EXCLUDED.name
+        RETURNING id, tmdb_id
+    """,
+    'actors': """
+        INSERT INTO actors (tmdb_id, name, surname) VALUES %s
+        ON CONFLICT (tmdb_id) DO UPDATE SET name = EXCLUDED.name, surname = EXCLUDED.surname
+        RETURNING id, tmdb_id
+    """,
+    'directors': """
+        INSERT INTO directors (tmdb_id, name, surname) VALUES %s
+        ON CONFLICT (tmdb_id) DO UPDATE SET name = EXCLUDED.name, surname = EXCLUDED.surname
+        RETURNING id, tmdb_id
+    """,
+    'movies': """
+        INSERT INTO movies (tmdb_id, name, release_date, release_country, poster_link, rating, revenue, runtime, director, overview)
+        VALUES %s
+        ON CONFLICT (tmdb_id) DO UPDATE SET
+            name = EXCLUDED.name, release_date = EXCLUDED.release_date, release_country = EXCLUDED.release_country,
+            poster_link = EXCLUDED.poster_link, rating = EXCLUDED.rating, revenue = EXCLUDED.revenue,
+            runtime = EXCLUDED.runtime, director = EXCLUDED.director, overview = EXCLUDED.overview
+        RETURNING id, tmdb_id
+    """,
+}
+# Выражения, по которым строке без tmdb_id присваивается id TMDB, и шаблон строки (tmdb_id, значения...).
+# У справочников это выражение имени из индексов *_name_idx и match_tmdb_ids, у фильмов - индекс movies_name_release_date_idx
+adopt_keys = {
+    **{table: ((param_name_expr(table),), None) for table in tmdb_name_columns},
+    'movies': (('name', 'release_date'), '(%s, %s, %s::date)'),
+}
+
+def adopt_row(table: str, row: tuple) -> tuple:
+    if table in tmdb_name_columns:
+        return (row[0], ' '.join(row[1:len(tmdb_name_columns[table]) + 1]))
+    return row[:len(adopt_keys[table][0]) + 1]
+
+def adopt_query(table: str) -> str:
+    expressions, _ = adopt_keys[table]
+    keys = [f'key{i}' for i in range(len(expressions))]
+    match = ' AND '.join(f'{expression} = v.{key}' for expression, key in zip(expressions, keys))
+    return f"""
+        UPDATE {table} t SET tmdb_id = v.tmdb_id
+        FROM (VALUES %s) AS v (tmdb_id, {', '.join(keys)})
+        WHERE t.id = (SELECT min(id) FROM {table} WHERE tmdb_id IS NULL AND {match})
+            AND NOT EXISTS (SELECT 1 FROM {table} WHERE tmdb_id = v.tmdb_id)
+    """
+
+def upsert_ids(cursor, table: str, rows: list[tuple]) -> dict[int, int]:
+    """Записывает строки (tmdb_id, ...) и возвращает соответствие id TMDB -> id каталога."""
+    if not rows:
+        return {}
+    _, template = adopt_keys[table]
+    psycopg2.extras.execute_values(cursor, adopt_query(table), [adopt_row(table, row) for row in rows], template=template, page_size=1000)
+    returned = psycopg2.extras.execute_values(cursor, upsert_queries[table], rows, page_size=1000, fetch=True)
+    return {row['tmdb_id']: row['id'] for row in returned}
+
+def read_items(path: str) -> list[str]:
+    with open(path, encoding='utf-8') as file:
+        return list(dict.fromkeys(line.strip() for line in file if line.strip()))
+
+def read_checkpoint(path: str) -> set[str]:
+    if not os.path.exists(path):
+        return set()
+    with open(path, encoding='utf-8') as file:
+        return {line.rstrip('\n') for line in file}
+
+def write_checkpoint(path: str, items: list[str]):
+    with open(path, 'a', encoding='utf-8') as file:
+        file.writelines(f'{item}\n' for item in items)
+        file.flush()
+        os.fsync(file.fileno())
+
+async def fetch_movie(client: TMDBClient, item: str) -> dict | None:
+    """Данные фильма для загрузки или None, если фильм не найден."""
+    try:
+        if item.isdigit():
+            movie_id = int(item)
+        else:
+            movie = await client.search(item)
+            if movie is None:
+                return None
+            movie_id = movie['id']
+        details, credits, keywords = await asyncio.gather(client.details(movie_id), client.credits(movie_id), client.keywords(movie_id))
+    except TMDBError as error:
+        if error.status == 404:
+            return None
+        raise
+    actors, director = parse_credits(credits)
+    return {'details': details, 'actors': actors, 'director': director, 'keywords': keywords.get('keywords', [])}
+
+def load_batch(data_provider: DataProvider, records: list[dict]) -> int:
+    countries = {country['alpha2']: country_id for country_id, country in data_provider.lookup('countries').items()}
+    references = {table: {} for table in upsert_queries if table != 'movies'}
+    movies, relations = {}, {table: [] for table, _, _ in movie_relations}
+    # Пока всё в id TMDB; на id каталога они заменяются после upsert
+    for record in records:
+        details = record['details']
+        movie_id = details['id']
+        director = record['director']
+        origin_country = details.get('origin_country') or [None]
+        for genre in details.get('genres', []):
+            references['genres'][genre['id']] = (genre['id'], genre['name'])
+        for keyword in record['keywords']:
+            references['keywords'][keyword['id']] = (keyword['id'], keyword['name'])
+        for actor in record['actors']:
+            references['actors'][actor[0]] = tuple(actor)
+        if director:
+            references['directors'][director[0]] = tuple(director)
+        movies[movie_id] = (
+            movie_id,
+            details.get('title', ''),
+            details.get('release_date') or None,
+            countries.get(origin_country[0]),
+            f"https://image.tmdb.org/t/p/original{details.get('poster_path') or ''}",
+            details.get('vote_average', 0),
+            details.get('revenue', 0),
+            details.get('runtime', 0),
+            director[0] if director else None,
+            details.get('overview', ''),
+        )
+        relations['movies_actors'] += [(movie_id, actor[0]) for actor in dict.fromkeys(record['actors'])]
+        relations['movies_genres'] += [(movie_id, genre['id']) for genre in details.get('genres', [])]
+        relations['movies_keywords'] += [(movie_id, keyword['id']) for keyword in record['keywords']]
+
+    with data_provider.transaction() as cursor:
+        ids = {table: upsert_ids(cursor, table, list(rows.values())) for table, rows in references.items()}
+        movies = {movie_id: (*row[:8], ids['directors'].get(row[8]), row[9]) for movie_id, row in movies.items()}
+        ids['movies'] = upsert_ids(cursor, 'movies', list(movies.values()))
+        relations = {
+            table: list(dict.fromkeys((ids['movies'][movie_id], ids[reference][feature_id]) for movie_id, feature_id in relations[table]))
+            for table, _, reference in movie_relations
+        }
+
+        features = {movie_id: [] for movie_id in ids['movies'].values()}
+        for table, feature_type in (('movies_genres', 'genre'), ('movies_keywords', 'keyword'), ('movies_actors', 'actor')):
+            for movie_id, feature_id in relations[table]:
+                features[movie_id].append((feature_type, feature_id))
+        signatures, buckets = [], []
+        for movie_id, movie_features in features.items():
+            signature = minhasher.signature(movie_features)
+            if signature is not None:
+                signatures.append((movie_id, signature_to_bytes(signature)))
+                buckets.extend((band, bucket, movie_id) for band, bucket in minhasher.buckets(signature))
+
+        movie_ids = list(features)
+        for table, column, _ in movie_relations:
+            cursor.execute(f"DELETE FROM {table} WHERE movie_id = ANY(%s)", (movie_ids,))
+            psycopg2.extras.execute_values(cursor, f"INSERT INTO {table} (movie_id, {column}) VALUES %s ON CONFLICT DO NOTHING",
+                                           relations[table], page_size=1000)
+        cursor.execute("DELETE FROM movie_lsh WHERE movie_id = ANY(%s)", (movie_ids,))
+        cursor.execute("DELETE FROM movie_signatures WHERE movie_id = ANY(%s)", (movie_ids,))
+        psycopg2.extras.execute_values(cursor, "INSERT INTO movie_signatures (movie_id, signature) VALUES %s", signatures, page_size=1000)
+        psycopg2.extras.execute_values(cursor, "INSERT INTO movie_lsh (band, bucket, movie_id) VALUES %s", buckets, page_size=1000)
+    return len(movies)
+
+async def run(args, client: TMDBClient, data_provider: DataProvider):
+    done = read_checkpoint(args.checkpoint)
+    items = [item for item in read_items(args.input) if item not in done]
+    batches = [items[start:start + args.batch_size] for start in range(0, len(items), args.batch_size)]
+
+    async def fetch_batch(batch: list[str]) -> list[dict | None]:
+        return await asyncio.gather(*(fetch_movie(client, item) for item in batch))
+
+    loaded = missing = 0
+    fetching = asyncio.create_task(fetch_batch(batches[0])) if batches else None
+    for index, batch in enumerate(batches):
+        records = await fetching
+        fetching = asyncio.create_task(fetch_batch(batches[index + 1])) if index + 1 < len(batches) else None
+        found = [record for record in records if record is not None]
+        missing += len(records) - len(found)
+        if found:
+            loaded += await asyncio.to_thread(load_batch, data_provider, found)
+        write_checkpoint(args.checkpoint, batch)
+        print(f'Пачка {index + 1}/{len(batches)}: загружено {loaded}, не найдено {missing}')
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input', help='файл с названиями или id TMDB, по одному в строке')
+    parser.add_argument('--checkpoint', help='файл с уже загруженными строками (по умолчанию <input>.checkpoint)')
+    parser.add_argument('--batch-size', type=int, default=500, help='сколько фильмов записывать одной транзакцией')
+    parser.add_argument('--concurrency', type=int, help='сколько запросов к API выполнять одновременно')
+    fixtures = parser.add_mutually_exclusive_group()
+    fixtures.add_argument('--record', metavar='DIR', help='сохранять ответы API в каталог')
+    fixtures.add_argument('--replay', metavar='DIR', help='брать ответы из каталога без обращения к API')
+    args = parser.parse_args()
+    args.checkpoint = args.checkpoint or f'{args.input}.checkpoint'
+
+    data_provider = DataProvider(minconn=1, maxconn=2)
+    client_options = {'concurrency': args.concurrency} if args.concurrency else {}
+    if args.record or args.replay:
+        client = FixtureClient(args.record or args.replay, record=bool(args.record), **client_options)
+    else:
+        # Повторная загрузка тех же фильмов берёт свежие ответы из дискового кэша
+        client = TMDBClient(cache=data_provider.responses, **client_options)
+    try:
+
+        async def import_all():
+            async with client:
+                await run(args, client, data_provider)
+        asyncio.run(import_all())
+        print(f'Кэш ответов TMDB: {data_provider.responses.stats}')
+    finally:
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()
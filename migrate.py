@@ -0,0 +1,136 @@
+"""Миграция схемы: служебные таблицы, столбцы и индексы, которые нужны приложению, боту и скриптам.
+
+Запускается вручную при развёртывании и после обновления, до старта приложения; сами приложение, бот
+и скрипты схему не меняют. Индексы строятся через CREATE INDEX CONCURRENTLY вне транзакции, поэтому
+чтение и запись таблиц во время миграции продолжаются. Индекс, оставшийся невалидным после прерванной
+сборки, удаляется и строится заново. Повторный запуск уже созданное не трогает.
+
+    python migrate.py
+"""
+from data_provider import DataProvider, query_links
+import argparse, psycopg2.extras, re
+
+# Таблицы, строки которых можно сопоставить с TMDB по столбцу tmdb_id
+tmdb_tables = ('movies', 'genres', 'keywords', 'actors', 'directors')
+
+def add_column_statement(table: str, column: str, definition: str) -> str:
+    """ALTER TABLE ... ADD COLUMN только если столбца ещё нет: ALTER берёт исключительную блокировку таблицы,
+    даже когда столбец уже добавлен, а миграция запускается повторно."""
+    return f"""DO $$ BEGIN
+        IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_schema = current_schema() AND table_name = '{table}' AND column_name = '{column}') THEN
+            ALTER TABLE {table} ADD COLUMN {column} {definition};
+        END IF;
+    END $$"""
+
+# Служебные объекты базы в порядке создания; каждый оператор выполняется отдельно, вне транзакции
+schema_statements = [
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS actors_full_name_idx ON actors ((name || ' ' || surname), id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS directors_full_name_idx ON directors ((name || ' ' || surname), id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS countries_name_idx ON countries (name, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS genres_name_idx ON genres (name, id)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS keywords_name_idx ON keywords (name, id)",
+    # Триграммные индексы для подсказок (suggest): ILIKE '%текст%' и поиск похожих по ним не требует полного просмотра
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS actors_full_name_trgm_idx ON actors USING gin ((name || ' ' || surname) gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS directors_full_name_trgm_idx ON directors USING gin ((name || ' ' || surname) gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS countries_name_trgm_idx ON countries USING gin (name gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS genres_name_trgm_idx ON genres USING gin (name gin_trgm_ops)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS keywords_name_trgm_idx ON keywords USING gin (name gin_trgm_ops)",
+    # Дневные агрегаты журнала поиска для статистики (query_rollup_statements)
+    "CREATE TABLE IF NOT EXISTS query_counts_daily (day date PRIMARY KEY, cnt integer NOT NULL)",
+    """CREATE TABLE IF NOT EXISTS query_stats_daily (
+        day date NOT NULL,
+        dimension text NOT NULL,
+        item_id integer NOT NULL,
+        cnt integer NOT NULL,
+        PRIMARY KEY (day, dimension, item_id)
+    )""",
+    # Дни, агрегаты которых пересобраны перед удалением сырого журнала (retention.py)
+    "CREATE TABLE IF NOT EXISTS query_rollup_folded (day date PRIMARY KEY)",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS queries_date_idx ON queries (date)",
+    *(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {table}_query_id_idx ON {table} (query_id)" for table, _, _ in query_links),
+    # Совместная фильтрация (cf_neighbours.py): время изменения оценок и рассчитанные соседи фильмов
+    add_column_statement('movies_scores', 'updated_at', 'timestamptz NOT NULL DEFAULT now()'),
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS movies_scores_updated_at_idx ON movies_scores (updated_at)",
+    """CREATE TABLE IF NOT EXISTS movie_neighbours (
+        movie_id integer NOT NULL,
+        neighbour_id integer NOT NULL,
+        similarity real NOT NULL,
+        PRIMARY KEY (movie_id, neighbour_id)
+    )""",
+    "CREATE TABLE IF NOT EXISTS recommender_state (name text PRIMARY KEY, updated_at timestamptz NOT NULL)",
+    # Готовые подборки (recommend_batch.py и расчёт по запросу); подборка действительна, если посчитана после сброса
+    """CREATE TABLE IF NOT EXISTS user_recommendations (
+        user_id bigint PRIMARY KEY,
+        movie_ids integer[],
+        computed_at timestamptz,
+        invalidated_at timestamptz
+    )""",
+    # Профиль вкуса пользователя: сумма по оценённым (score_weight) и избранным (1) фильмам их признаков,
+    # нормированных на фильм (1 / sqrt(число признаков))
+    """CREATE TABLE IF NOT EXISTS user_profiles (
+        user_id bigint,
+        feature_type text,
+        feature_id integer,
+        weight double precision NOT NULL,
+        PRIMARY KEY (user_id, feature_type, feature_id)
+    )""",
+    # id TMDB фильмов и справочников (import_catalog.py, sync_tmdb.py); собственные id остаются последовательными
+    *(add_column_statement(table, 'tmdb_id', 'integer') for table in tmdb_tables),
+    *(f"CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS {table}_tmdb_id_idx ON {table} (tmdb_id)" for table in tmdb_tables),
+    # Фильмы без tmdb_id сопоставляются по названию и дате выхода (import_catalog.py)
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS movies_name_release_date_idx ON movies (name, release_date, id)",
+    # До какой даты применена лента изменений TMDB (sync_tmdb.py)
+    "CREATE TABLE IF NOT EXISTS tmdb_sync_state (name text PRIMARY KEY, synced_until date NOT NULL)",
+    # MinHash-сигнатуры фильмов и LSH-корзины их полос (similarity.py)
+    "CREATE TABLE IF NOT EXISTS movie_signatures (movie_id integer PRIMARY KEY, signature bytea NOT NULL)",
+    """CREATE TABLE IF NOT EXISTS movie_lsh (
+        band smallint,
+        bucket bigint,
+        movie_id integer,
+        PRIMARY KEY (band, bucket, movie_id)
+    )""",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS movie_lsh_movie_id_idx ON movie_lsh (movie_id)",
+]
+
+index_statement = re.compile(r'INDEX CONCURRENTLY IF NOT EXISTS (\w+) ON (\w+)')
+
+def drop_invalid_index(cursor, name: str) -> bool:
+    """Удаляет индекс, если прерванная сборка CONCURRENTLY оставила его невалидным: IF NOT EXISTS его бы пропустил."""
+    cursor.execute("SELECT NOT indisvalid AS invalid FROM pg_index WHERE indexrelid = to_regclass(%s)", (name,))
+    row = cursor.fetchone()
+    if row is None or not row['invalid']:
+        return False
+    cursor.execute(f"DROP INDEX CONCURRENTLY {name}")
+    return True
+
+def is_partitioned(cursor, table: str) -> bool:
+    cursor.execute("SELECT relkind = 'p' AS partitioned FROM pg_class WHERE oid = to_regclass(%s)", (table,))
+    row = cursor.fetchone()
+    return bool(row and row['partitioned'])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    data_provider = DataProvider(minconn=1, maxconn=1)
+    try:
+        with data_provider.pool.connection() as conn:
+            # CREATE INDEX CONCURRENTLY нельзя выполнять внутри транзакции
+            conn.autocommit = True
+            with conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor) as cursor:
+                for statement in schema_statements:
+                    match = index_statement.search(statement)
+                    if match and drop_invalid_index(cursor, match.group(1)):
+                        print(f'Невалидный индекс {match.group(1)} удалён и будет построен заново')
+                    # Для секционированной таблицы (queries после retention.py --partition) CONCURRENTLY не поддерживается;
+                    # её индексы создаёт сама разбивка на секции, так что здесь IF NOT EXISTS их пропускает
+                    if match and is_partitioned(cursor, match.group(2)):
+                        statement = statement.replace(' CONCURRENTLY', '', 1)
+                    cursor.execute(statement)
+        print(f'Схема обновлена: выполнено операторов - {len(schema_statements)}')
+    finally:
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""Пакетный расчёт персональных подборок для всех активных пользователей в user_recommendations.
+
+Матрица каталога и соседи фильмов строятся один раз и передаются процессам пула через разделяемую
+память, а пользователи делятся между процессами порциями. Бот после этого читает подборку одним
+запросом по первичному ключу; подборки, сброшенные новыми оценками во время расчёта, не считаются готовыми.
+
+    python recommend_batch.py --days 30 --workers 4
+"""
+from data_provider import DataProvider, compilation_size, neighbours_weight, stream_chunk_size, user_profile
+from recommender import ContentRecommender, share_arrays, attach_arrays
+from multiprocessing import Pool
+from collections import defaultdict
+import argparse, numpy as np, os, psycopg2.extras, scipy.sparse as sp
+
+active_users_query = """
+    SELECT id FROM users u
+    WHERE EXISTS (SELECT 1 FROM queries q WHERE q.user_id = u.id AND q.date > CURRENT_DATE - make_interval(days => %(days)s))
+        OR EXISTS (SELECT 1 FROM movies_scores s WHERE s.user_id = u.id AND s.updated_at > now() - make_interval(days => %(days)s))
+"""
+preferences_batch_query = """
+    SELECT user_id, array_agg(DISTINCT movie_id) AS movie_ids
+    FROM (
+        SELECT user_id, movie_id FROM movies_scores WHERE user_id = ANY(%(users)s)
+        UNION ALL
+        SELECT user_id, movie_id FROM favorite_movies WHERE user_id = ANY(%(users)s)
+    ) preferences
+    GROUP BY user_id
+"""
+profiles_batch_query = "SELECT user_id, feature_type, feature_id, weight FROM user_profiles WHERE user_id = ANY(%(users)s)"
+store_recommendations_batch_query = """
+    INSERT INTO user_recommendations (user_id, movie_ids, computed_at) VALUES %s
+    ON CONFLICT (user_id) DO UPDATE SET movie_ids = EXCLUDED.movie_ids, computed_at = EXCLUDED.computed_at
+    WHERE user_recommendations.computed_at IS NULL OR user_recommendations.computed_at < EXCLUDED.computed_at
+"""
+
+# Состояние процесса пула: подключённые блоки разделяемой памяти и собранные из них матрицы
+worker_state = {}
+
+def neighbours_matrix(data_provider: DataProvider, recommender: ContentRecommender) -> sp.csr_matrix:
+    """Соседи фильмов как матрица фильмы x фильмы в порядке recommender.movie_ids."""
+    rows, cols, values = [], [], []
+    for chunk in data_provider.stream_request("SELECT movie_id, neighbour_id, similarity FROM movie_neighbours", chunk_size=stream_chunk_size * 100):
+        for row in chunk:
+            rows.append(row['movie_id'])
+            cols.append(row['neighbour_id'])
+            values.append(row['similarity'])
+    size = len(recommender.movie_ids)
+    rows, cols = np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+    if not size or not len(rows):
+        return sp.csr_matrix((size, size), dtype=np.float32)
+    row_positions = np.searchsorted(recommender.movie_ids, rows).clip(0, size - 1)
+    col_positions = np.searchsorted(recommender.movie_ids, cols).clip(0, size - 1)
+    known = (recommender.movie_ids[row_positions] == rows) & (recommender.movie_ids[col_positions] == cols)
+    return sp.csr_matrix(
+        (np.array(values, dtype=np.float32)[known], (row_positions[known], col_positions[known])),
+        shape=(size, size)
+    )
+
+def init_worker(spec: dict, k: int, weight: float):
+    blocks, arrays = attach_arrays(spec)
+    size = len(arrays['movie_ids'])
+    worker_state.update(
+        blocks=blocks,
+        recommender=ContentRecommender.from_arrays(arrays),
+        neighbours=sp.csr_matrix(
+            (arrays['neighbours_data'], arrays['neighbours_indices'], arrays['neighbours_indptr']),
+            shape=(size, size), copy=False
+        ),
+        k=k,
+        weight=weight,
+    )
+
+def recommend_shard(shard: list[tuple[int, list[int], list[dict]]]) -> list[tuple[int, list[int]]]:
+    recommender: ContentRecommender = worker_state['recommender']
+    neighbours: sp.csr_matrix = worker_state['neighbours']
+    result = []
+    for user_id, movie_ids, profile_rows in shard:
+        positions = recommender.movie_positions(movie_ids)
+        collaborative = np.asarray(neighbours[positions].sum(axis=0)).ravel()
+        profile = user_profile(recommender, profile_rows, movie_ids)
+        result.append((user_id, recommender.recommend(profile, worker_state['k'], movie_ids, collaborative, worker_state['weight'])))
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=30, help='активные пользователи - искавшие или оценивавшие фильмы за столько дней')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--shard-size', type=int, default=500, help='сколько пользователей получает процесс за раз')
+    parser.add_argument('--k', type=int, default=compilation_size, help='размер подборки')
+    args = parser.parse_args()
+
+    data_provider = DataProvider(minconn=1, maxconn=2)
+    blocks = []
+    try:
+        # Момент начала расчёта: подборки пользователей, сброшенные позже, не будут считаться готовыми
+        started_at = data_provider.db_request("SELECT now() AS now")[0]['now']
+        users = [row['id'] for row in data_provider.db_request(active_users_query, params={'days': args.days})]
+        profiles = defaultdict(list)
+        for row in data_provider.db_request(profiles_batch_query, params={'users': users}):
+            profiles[row['user_id']].append(dict(row))
+        preferences = [(row['user_id'], row['movie_ids'], profiles[row['user_id']])
+                       for row in data_provider.db_request(preferences_batch_query, params={'users': users})]
+        if not preferences:
+            print('Нет активных пользователей с оценками или избранным')
+            return
+
+        recommender = data_provider.content_recommender()
+        neighbours = neighbours_matrix(data_provider, recommender)
+        arrays = recommender.to_arrays()
+        arrays.update(neighbours_data=neighbours.data, neighbours_indices=neighbours.indices, neighbours_indptr=neighbours.indptr)
+        blocks, spec = share_arrays(arrays)
+
+        shards = [preferences[start:start + args.shard_size] for start in range(0, len(preferences), args.shard_size)]
+        computed = 0
+        with Pool(args.workers, initializer=init_worker, initargs=(spec, args.k, neighbours_weight)) as pool:
+            for result in pool.imap_unordered(recommend_shard, shards):
+                with data_provider.transaction() as cursor:
+                    psycopg2.extras.execute_values(cursor, store_recommendations_batch_query,
+                                                   [(user_id, movie_ids, started_at) for user_id, movie_ids in result])
+                computed += len(result)
+        print(f'Рассчитано подборок: {computed} из {len(users)} активных пользователей')
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,188 @@
+"""Контентные рекомендации по жанрам, ключевым словам и актёрам фильмов.
+
+Каталог один раз загружается в разреженную матрицу фильмы x признаки (веса idf, строки нормированы),
+после чего оценка всех фильмов для профиля пользователя - одно умножение матрицы на вектор.
+Оценки совместной фильтрации дают соседи фильмов по оценкам пользователей (item_neighbours),
+которые заранее рассчитывает cf_neighbours.py.
+"""
+from collections.abc import Iterable
+from multiprocessing import shared_memory
+import numpy as np, scipy.sparse as sp
+
+class ContentRecommender:
+    def __init__(self, movie_ids: np.ndarray, ratings: np.ndarray, feature_ids: dict[str, np.ndarray], matrix: sp.csr_matrix, idf: np.ndarray):
+        self.movie_ids = movie_ids
+        self.ratings = ratings
+        self.feature_ids = feature_ids
+        self.matrix = matrix
+        self.idf = idf
+        self.__offsets = {}
+        offset = 0
+        for feature_type, ids in feature_ids.items():
+            self.__offsets[feature_type] = offset
+            offset += len(ids)
+
+    @classmethod
+    def from_rows(cls, movies: list[dict], relations: dict[str, list[dict]]) -> 'ContentRecommender':
+        """movies - строки (id, rating), relations - строки (movie_id, feature_id) по типам признаков."""
+        movie_ids = np.array(sorted(movie['id'] for movie in movies), dtype=np.int64)
+        ratings_by_id = {movie['id']: movie['rating'] or 0 for movie in movies}
+        ratings = np.array([ratings_by_id[movie_id] for movie_id in movie_ids], dtype=np.float32)
+
+        feature_ids, blocks = {}, []
+        for feature_type, rows in relations.items():
+            movie_col = np.fromiter((row['movie_id'] for row in rows), dtype=np.int64, count=len(rows))
+            feature_col = np.fromiter((row['feature_id'] for row in rows), dtype=np.int64, count=len(rows))
+            positions = np.searchsorted(movie_ids, movie_col).clip(0, max(len(movie_ids) - 1, 0))
+            known = movie_ids[positions] == movie_col if len(movie_ids) else np.zeros(len(rows), dtype=bool)
+            ids, columns = np.unique(feature_col[known], return_inverse=True)
+            block = sp.csr_matrix(
+                (np.ones(len(columns), dtype=np.float32), (positions[known], columns)),
+                shape=(len(movie_ids), len(ids))
+            )
+            # Повторяющиеся связи не должны увеличивать вес признака
+            block.data[:] = 1
+            feature_ids[feature_type] = ids
+            blocks.append(block)
+
+        matrix = sp.hstack(blocks, format='csr', dtype=np.float32) if blocks else sp.csr_matrix((len(movie_ids), 0), dtype=np.float32)
+        document_freq = np.bincount(matrix.indices, minlength=matrix.shape[1])
+        idf = (np.log((1 + len(movie_ids)) / (1 + document_freq)) + 1).astype(np.float32)
+        matrix = (matrix @ sp.diags(idf)).tocsr()
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+        norms[norms == 0] = 1
+        matrix = (sp.diags(1 / norms) @ matrix).tocsr().astype(np.float32)
+        return cls(movie_ids, ratings, feature_ids, matrix, idf)
+
+    def movie_positions(self, movie_ids: Iterable[int]) -> np.ndarray:
+        movie_ids = np.fromiter(movie_ids, dtype=np.int64)
+        if not len(self.movie_ids) or not len(movie_ids):
+            return np.empty(0, dtype=np.int64)
+        positions = np.searchsorted(self.movie_ids, movie_ids).clip(0, len(self.movie_ids) - 1)
+        return positions[self.movie_ids[positions] == movie_ids]
+
+    def profile_from_movies(self, movie_ids: Iterable[int]) -> np.ndarray:
+        """Профиль пользователя как сумма векторов понравившихся фильмов."""
+        positions = self.movie_positions(movie_ids)
+        return np.asarray(self.matrix[positions].sum(axis=0)).ravel()
+
+    def profile_from_features(self, features: Iterable[tuple[str, int, float]]) -> np.ndarray:
+        """Профиль из взвешенных признаков (тип, id, вес) в пространстве матрицы каталога. Веса уже нормированы
+        на фильм (user_profiles), idf применяется здесь, как в строках матрицы."""
+        profile = np.zeros(self.matrix.shape[1], dtype=np.float32)
+        for feature_type, feature_id, weight in features:
+            ids = self.feature_ids.get(feature_type)
+            if ids is None or not len(ids):
+                continue
+            position = np.searchsorted(ids, feature_id)
+            if position < len(ids) and ids[position] == feature_id:
+                column = self.__offsets[feature_type] + position
+                profile[column] += weight * self.idf[column]
+        return profile
+
+    def recommend(self, profile: np.ndarray, k: int, exclude: Iterable[int] = (),
+                  neighbours: dict[int, float] | np.ndarray = None, neighbours_weight: float = 0.5) -> list[int]:
+        """id k фильмов с наибольшей оценкой для профиля; при равной оценке выше фильм с большим рейтингом.
+        neighbours - оценки совместной фильтрации по id фильмов (или вектор в порядке movie_ids), они
+        смешиваются с контентными в пропорции neighbours_weight после приведения обеих к максимуму 1."""
+        has_neighbours = neighbours is not None and len(neighbours) > 0 and len(self.movie_ids) > 0
+        if k <= 0 or (not profile.any() and not has_neighbours):
+            return []
+        scores = self.matrix @ profile
+        if scores.max(initial=0) > 0:
+            scores /= scores.max()
+        if has_neighbours:
+            if isinstance(neighbours, np.ndarray):
+                collaborative = neighbours.astype(np.float32)
+            else:
+                ids = np.fromiter(neighbours.keys(), dtype=np.int64, count=len(neighbours))
+                values = np.fromiter(neighbours.values(), dtype=np.float32, count=len(neighbours))
+                positions = np.searchsorted(self.movie_ids, ids).clip(0, len(self.movie_ids) - 1)
+                known = self.movie_ids[positions] == ids
+                collaborative = np.zeros_like(scores)
+                collaborative[positions[known]] = values[known]
+            if collaborative.max(initial=0) > 0:
+                collaborative /= collaborative.max()
+            scores = (1 - neighbours_weight) * scores + neighbours_weight * collaborative
+        scores[self.movie_positions(exclude)] = 0
+        candidates = np.flatnonzero(scores > 0)
+        if not len(candidates):
+            return []
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        order = np.lexsort((-self.ratings[candidates], -scores[candidates]))
+        return self.movie_ids[candidates[order]].tolist()
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """Массивы, из которых from_arrays восстанавливает рекомендатель без копирования (для shared memory)."""
+        arrays = {
+            'movie_ids': self.movie_ids,
+            'ratings': self.ratings,
+            'idf': self.idf,
+            'data': self.matrix.data,
+            'indices': self.matrix.indices,
+            'indptr': self.matrix.indptr,
+        }
+        for feature_type, ids in self.feature_ids.items():
+            arrays[f'features_{feature_type}'] = ids
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, arrays: dict[str, np.ndarray]) -> 'ContentRecommender':
+        feature_ids = {name[len('features_'):]: ids for name, ids in arrays.items() if name.startswith('features_')}
+        shape = (len(arrays['movie_ids']), len(arrays['idf']))
+        matrix = sp.csr_matrix((arrays['data'], arrays['indices'], arrays['indptr']), shape=shape, copy=False)
+        return cls(arrays['movie_ids'], arrays['ratings'], feature_ids, matrix, arrays['idf'])
+
+def share_arrays(arrays: dict[str, np.ndarray]) -> tuple[list[shared_memory.SharedMemory], dict[str, tuple]]:
+    """Копирует массивы в разделяемую память. Возвращает блоки (их нужно закрыть и освободить)
+    и описание, по которому attach_arrays подключает те же массивы в другом процессе."""
+    blocks, spec = [], {}
+    for name, array in arrays.items():
+        block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[...] = array
+        blocks.append(block)
+        spec[name] = (block.name, array.dtype.str, array.shape)
+    return blocks, spec
+
+def attach_arrays(spec: dict[str, tuple]) -> tuple[list[shared_memory.SharedMemory], dict[str, np.ndarray]]:
+    blocks, arrays = [], {}
+    for name, (block_name, dtype, shape) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+    return blocks, arrays
+
+def item_neighbours(user_ids: np.ndarray, movie_ids: np.ndarray, scores: np.ndarray, targets: Iterable[int],
+                    top_n: int = 20, chunk_size: int = 512) -> list[tuple[int, int, float]]:
+    """Ближайшие соседи фильмов targets по косинусу между столбцами матрицы пользователи x фильмы,
+    в которой из оценок вычтено среднее пользователя. Возвращает строки (фильм, сосед, сходство)."""
+    users, user_rows = np.unique(user_ids, return_inverse=True)
+    movies, movie_cols = np.unique(movie_ids, return_inverse=True)
+    scores = scores.astype(np.float32)
+    means = np.bincount(user_rows, weights=scores) / np.bincount(user_rows)
+    centred = (scores - means[user_rows]).astype(np.float32)
+    ratings = sp.csc_matrix((centred, (user_rows, movie_cols)), shape=(len(users), len(movies)))
+    norms = np.sqrt(np.asarray(ratings.multiply(ratings).sum(axis=0)).ravel())
+
+    target_ids = np.fromiter(targets, dtype=np.int64)
+    positions = np.searchsorted(movies, target_ids).clip(0, max(len(movies) - 1, 0))
+    target_cols = positions[movies[positions] == target_ids] if len(movies) else np.empty(0, dtype=np.int64)
+
+    result = []
+    # Сходства считаются порциями, чтобы промежуточная матрица не росла с числом целевых фильмов
+    for start in range(0, len(target_cols), chunk_size):
+        cols = target_cols[start:start + chunk_size]
+        similarity = (ratings[:, cols].T @ ratings).tocsr()
+        for row, col in enumerate(cols):
+            begin, end = similarity.indptr[row], similarity.indptr[row + 1]
+            neighbours = similarity.indices[begin:end]
+            denominator = norms[col] * norms[neighbours]
+            values = np.divide(similarity.data[begin:end], denominator, out=np.zeros(end - begin, dtype=np.float32), where=denominator > 0)
+            keep = (neighbours != col) & (values > 0)
+            neighbours, values = neighbours[keep], values[keep]
+            if len(values) > top_n:
+                best = np.argpartition(-values, top_n - 1)[:top_n]
+                neighbours, values = neighbours[best], values[best]
+            result.extend((int(movies[col]), int(movies[neighbour]), float(value)) for neighbour, value in zip(neighbours, values))
+    return result
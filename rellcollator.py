@@ -3,12 +3,14 @@ from PyQt5.QtCore import *
 from PyQt5.QtWidgets import *
 from PyQt5.QtGui import *
 from PyQt5.QtSvg import QSvgWidget
-from data_provider import DataProvider
+from data_provider import DataProvider, empty_stats
+from tmdb_client import parse_credits
 from collections import deque, Counter
 from datetime import date
 from functools import partial
 
 class StatsWorkerSignals(QObject):
+    section = pyqtSignal(str, dict)
     finished = pyqtSignal(dict)
 
 class StatsWorker(QRunnable):
@@ -18,7 +20,7 @@ class StatsWorker(QRunnable):
         self.signals = StatsWorkerSignals()
 
     def run(self):
-        stats = self.data_provider.get_stats()
+        stats = self.data_provider.get_stats(on_section=self.signals.section.emit)
         self.signals.finished.emit(stats)
 
 class WorkerSignals(QObject):
@@ -148,13 +150,7 @@ class ParameterPanel(QWidget):
 
     def load_suggestions(self, text: str):
         def fetch_data():
-            if len(self.name_str) == 4:
-                query = f"SELECT id, {self.name_str} FROM {self.table_name} WHERE name ILIKE %s"
-                results = data_provider.db_request(query, params=(f"%{text}%",))
-            else:
-                query = f"SELECT id, {self.name_str} FROM {self.table_name} WHERE (name || ' ' || surname) ILIKE %s"
-                results = data_provider.db_request(query, params=(f"%{text}%",))
-            return results
+            return data_provider.suggest(self.table_name, text)
 
         def update_ui(results):
             self.values.clear()
@@ -172,27 +168,28 @@ class ParameterPanel(QWidget):
         if not self.ext_checked is None:
             self.ext_checked()
         if id is None:
-            param_key = None
-            if not param_key:
-                if len(self.name_str) == 4:
-                    query = f"SELECT id, {self.name_str} FROM {self.table_name} WHERE name ILIKE %s"
-                    results = data_provider.db_request(query, params=(f"%{text}%",))
-                else:
-                    query = f"SELECT id, {self.name_str} FROM {self.table_name} WHERE (name || ' ' || surname) ILIKE %s"
-                    results = data_provider.db_request(query, params=(f"%{text}%",))
-                if bool(results):
-                    if self.one_value:
-                        self.checked_params.clear()
-                        self.checked_params[param_key] = 0
-                        self.param_edit.setText(text)
-                        return
-                    pass
+            if not text:
+                results = []
+            elif self.table_name:
+                # Похожее имя из подсказок не подставляется: без точного совпадения предлагается добавить новое значение
+                found = data_provider.find_param(self.table_name, text.strip())
+                results = [found] if found else []
+            else:
+                results = [{'id': key, 'name': value} for key, value in self.values.items() if value == text]
+            if not results:
+                if not self.ext_not_checked is None and text:
+                    self.ext_not_checked()
                 else:
-                    if not self.ext_not_checked is None and text:
-                        self.ext_not_checked()
-                    else:
-                        self.param_edit.clear()
-                    return
+                    self.param_edit.clear()
+                return
+            param_key = results[0]['id']
+            text = results[0]['name']
+            self.values[param_key] = text
+            if self.one_value:
+                self.checked_params.clear()
+                self.checked_params[param_key] = 0
+                self.param_edit.setText(text)
+                return
         else:
             if not id:
                 return
@@ -322,6 +319,8 @@ class MoviePage(QWidget):
         self.delete_btn.clicked.connect(self.__pre_delete_movie)
         self.save_btn = CustomPushButton('Сохранить')
         self.save_btn.clicked.connect(self.__save_movie)
+        self.similar_btn = CustomPushButton('Похожие фильмы')
+        self.similar_btn.clicked.connect(self.__show_similar)
 
         self.title = QLineEdit(self.title_txt)
         self.title.setObjectName('title-edit')
@@ -377,6 +376,7 @@ class MoviePage(QWidget):
 
         botside_r = QHBoxLayout()
         botside_r.addWidget(self.create_btn)
+        botside_r.addWidget(self.similar_btn)
         botside_r.addStretch()
         botside_r.addWidget(self.delete_btn)
         botside_r.addWidget(self.save_btn)
@@ -397,12 +397,22 @@ class MoviePage(QWidget):
         self.overlay.close()
 
     def __find_new_movie(self):
-        movie_data = data_provider.search(self.title.text())
-        if movie_data:
-            movie_id = movie_data.get('id')
-            details_data = data_provider.details(movie_id)
-            print(details_data)
-            new_movie_data = {
+        title = self.title.text()
+
+        def fetch_data():
+            found = data_provider.find_movie(title)
+            if found is None:
+                return []
+            movie_data, details_data, credits_data = found
+            if data_provider.db_request("SELECT 1 FROM movies WHERE tmdb_id = %s", params=(movie_data['id'],)):
+                return []
+            actors, director = parse_credits(credits_data)
+            # В карточку попадают только люди и жанры, которые уже есть в справочниках; id TMDB в них не используются
+            actor_ids = data_provider.match_tmdb_ids('actors', actors)
+            director_ids = data_provider.match_tmdb_ids('directors', [director] if director else [])
+            genre_ids = data_provider.match_tmdb_ids('genres', [(genre['id'], genre['name']) for genre in details_data.get('genres', [])])
+            origin_country = details_data.get('origin_country') or [None]
+            return [{
                 'name': movie_data.get('title', ''),
                 'overview': movie_data.get('overview', ''),
                 'poster_link': f"https://image.tmdb.org/t/p/original{movie_data.get('poster_path', '')}",
@@ -410,22 +420,28 @@ class MoviePage(QWidget):
                 'rating': 0,
                 'revenue': details_data.get('revenue', 0),
                 'runtime': details_data.get('runtime', 0),
-                'release_country': data_provider.get_country_name(alpha2=details_data.get('origin_country')[0]),
-                'director': '',
-                'actors': [],
-                'genres': movie_data.get('genre_ids', []),
+                'release_country': data_provider.get_country_name(alpha2=origin_country[0]),
+                'director': director_ids.get(director[0], '') if director else '',
+                'actors': list(dict.fromkeys(actor_ids[actor[0]] for actor in actors if actor[0] in actor_ids)),
+                'genres': list(genre_ids.values()),
                 'keywords': [],
-                'id': movie_data.get('id', ''),
-            }
-            result = data_provider.db_request(f"SELECT * FROM movies WHERE id = {movie_id}")
-            if bool(result):
+                'tmdb_id': movie_data.get('id'),
+            }]
+
+        def update_ui(results):
+            if not results:
                 return
             app_window.main_window.removeTab(1)
-            app_window.main_window.insertTab(1, MoviePage(new_movie_data, is_new=True), 'Фильм')
+            app_window.main_window.insertTab(1, MoviePage(results[0], is_new=True), 'Фильм')
             app_window.main_window.setCurrentIndex(1)
             app_window.main_window.widget(1).update_poster()
             app_window.main_window.widget(1).update_state('just_changed')
-            
+
+        # Запросы к TMDB идут в пуле потоков, чтобы не блокировать интерфейс
+        worker = Worker(fetch_data)
+        worker.signals.result.connect(update_ui)
+        QThreadPool.globalInstance().start(worker)
+
     def update_poster(self):
         try:
             image_bin = data_provider.get_image_bin(self.poster_link.text())
@@ -488,6 +504,7 @@ class MoviePage(QWidget):
             elif self.table_to_add == 'keywords':
                 self.keywords_param.update_checked_params(name)
 
+        data_provider.lookups.invalidate(self.table_to_add)
         self.confirm_dialog.close()
         self.overlay.close()
 
@@ -510,9 +527,12 @@ class MoviePage(QWidget):
         self.save_btn.setEnabled(enable_save)
         self.create_btn.setEnabled(enable_create)
         self.delete_btn.setEnabled(enable_delete)
+        # Похожие ищутся по сохранённым связям, поэтому у несохранённой карточки кнопка недоступна
+        self.similar_btn.setEnabled(self.state == 'just_saved' and bool(self.movie_id))
         self.save_btn.updateBackgroundColor()
         self.create_btn.updateBackgroundColor()
         self.delete_btn.updateBackgroundColor()
+        self.similar_btn.updateBackgroundColor()
 
     def __save_movie(self):
         try:
@@ -545,16 +565,21 @@ class MoviePage(QWidget):
             checked_actors = list(self.actors_param.checked_params.keys())
             checked_genres = list(self.genres_param.checked_params.keys())
             checked_keywords = list(self.keywords_param.checked_params.keys())
-            self.movie_data['actors_for_insert'] = [actor if actor not in self.actors else None for actor in checked_actors]
-            self.movie_data['actors_for_delete'] = [actor if actor not in checked_actors else None for actor in self.actors]
-            self.movie_data['genres_for_insert'] = [genre if genre not in self.genres else None for genre in checked_genres]
-            self.movie_data['genres_for_delete'] = [genre if genre not in checked_genres else None for genre in self.genres]
-            self.movie_data['keywords_for_insert'] = [keyword if keyword not in self.keywords else None for keyword in checked_keywords]
-            self.movie_data['keywords_for_delete'] = [keyword if keyword not in checked_keywords else None for keyword in self.keywords]
+            # У нового фильма в базе ещё нет связей, поэтому вставляются все выбранные значения
+            saved_actors = [] if self.is_new else self.actors
+            saved_genres = [] if self.is_new else self.genres
+            saved_keywords = [] if self.is_new else self.keywords
+            self.movie_data['actors_for_insert'] = [actor if actor not in saved_actors else None for actor in checked_actors]
+            self.movie_data['actors_for_delete'] = [actor if actor not in checked_actors else None for actor in saved_actors]
+            self.movie_data['genres_for_insert'] = [genre if genre not in saved_genres else None for genre in checked_genres]
+            self.movie_data['genres_for_delete'] = [genre if genre not in checked_genres else None for genre in saved_genres]
+            self.movie_data['keywords_for_insert'] = [keyword if keyword not in saved_keywords else None for keyword in checked_keywords]
+            self.movie_data['keywords_for_delete'] = [keyword if keyword not in checked_keywords else None for keyword in saved_keywords]
             self.actors = checked_actors
             self.genres = checked_genres
             self.keywords = checked_keywords
-            data_provider.save_movie(self.movie_data, self.is_new)
+            self.movie_id = data_provider.save_movie(self.movie_data, self.is_new)
+            self.movie_data['id'] = self.movie_id
             self.update_state('just_saved')
             self.is_new = False
 
@@ -564,6 +589,10 @@ class MoviePage(QWidget):
             self.overlay.show()
             return
 
+    def __show_similar(self):
+        app_window.main_window.widget(0).show_similar(self.movie_id)
+        app_window.main_window.setCurrentIndex(0)
+
     def __pre_delete_movie(self):
         self.overlay.show()
         self.confirm_dialog = ModalWidget(self, "Требуется подтверждение", 
@@ -816,6 +845,11 @@ class SearchPage(QWidget):
         self.sort_params = {'rating': 'рейтингу',
                             'release_date': 'дате выхода',
                             'revenue': 'сумме сборов'}
+        self.movies = {}
+        self.image_queue = deque()
+        self.image_loading = False
+        self.next_cursor = None
+        self.page_worker: Worker = None
         self.__initUI()
 
     def __initUI(self):
@@ -877,6 +911,7 @@ class SearchPage(QWidget):
         self.v_layout.addStretch()
         
         self.results = ResultsPanel()
+        self.results.end_reached.connect(self.load_more)
         self.show_msg('')
 
         main_layout = QHBoxLayout()
@@ -901,6 +936,7 @@ class SearchPage(QWidget):
         self.process_next_image()
 
     def process_next_image(self):
+        self.image_loading = bool(self.image_queue)
         if self.image_queue:
             if self.results.movie_cnt > 8:
                 self.results.movie_cnt = 0
@@ -928,7 +964,7 @@ class SearchPage(QWidget):
         if int(''.join(release_date_gte)) > int(''.join(release_date_lte)):
             self.show_msg('Первая дата интервала выхода фильма не может быть больше второй')
 
-        movies = data_provider.search_movies(
+        self.search_filters = dict(
             genres_included=[id for id in self.genres_panel.checked_params.keys()],
             genres_excluded=[id for id in self.genres_panel_no.checked_params.keys()],
             keywords_included=[id for id in self.keywords_panel.checked_params.keys()],
@@ -943,15 +979,46 @@ class SearchPage(QWidget):
             order_dir=self.sort_asc_desc.value
         )
         self.movies = {}
-        if movies:
-            for movie in movies:
-                movie_id = movie.get('id')
-                movie_poster = movie.get('poster_link')
-                self.movies[movie_id] = movie
-                self.image_queue.append((movie_id, movie_poster))
-            self.process_next_image()
-        else: 
+        self.next_cursor = None
+        self.load_page()
+
+    def load_page(self, cursor: str = None):
+        filters = self.search_filters
+
+        def fetch_page():
+            movies, next_cursor = data_provider.search_movies_page(search_page_size, cursor, **filters)
+            return [movies, next_cursor]
+
+        self.__start_page_worker(fetch_page)
+
+    def load_more(self):
+        # Следующая страница результатов запрашивается, только когда пользователь долистал до конца
+        if self.next_cursor and not self.image_queue:
+            cursor, self.next_cursor = self.next_cursor, None
+            self.load_page(cursor)
+
+    def __start_page_worker(self, fn):
+        # Результат прежнего поиска, пришедший после начала нового, отбрасывается в __on_page
+        self.page_worker = Worker(fn)
+        self.page_worker.signals.result.connect(self.__on_page)
+        QThreadPool.globalInstance().start(self.page_worker)
+
+    def __on_page(self, page: list):
+        if self.sender() is not self.page_worker.signals:
+            return
+        movies, self.next_cursor = page
+        if not movies and not self.movies:
             self.show_msg('По Вашему запросу ничего не было найдено')
+        self.add_movies(movies)
+
+    def add_movies(self, movies: list[dict]):
+        for movie in movies:
+            movie_id = movie.get('id')
+            movie_poster = movie.get('poster_link')
+            self.movies[movie_id] = movie
+            self.image_queue.append((movie_id, movie_poster))
+        if not self.image_loading:
+            self.process_next_image()
 
     def start_search(self):
         self.search_bttn.setEnabled(False)
@@ -964,6 +1031,15 @@ class SearchPage(QWidget):
         self.image_queue = deque()
         asyncio.run(self.__search())
 
+    def show_similar(self, movie_id: int):
+        """Показывает в результатах фильмы, похожие на данный."""
+        self.clear_results(self.results.results_layout)
+        self.results.results_layout.insertItem(0, QHBoxLayout())
+        self.image_queue = deque()
+        self.movies = {}
+        self.next_cursor = None
+        self.__start_page_worker(lambda: [data_provider.similar_movies(movie_id), None])
+
     def clear_results(self, widget):
         self.results.current_col_result = 0
         self.results.current_row_result = 0
@@ -977,6 +1053,8 @@ class SearchPage(QWidget):
         self.results.add_page()
 
 class ResultsPanel(QStackedWidget):
+    end_reached = pyqtSignal()
+
     def __init__(self):
         super().__init__()
         self.current_col_result = 0
@@ -1013,6 +1091,8 @@ class ResultsPanel(QStackedWidget):
         elif value == max_value and self.page_num < self.page_cnt:
             self.page_num += 1
             self.setCurrentIndex(self.page_num-1)
+        elif value == max_value:
+            self.end_reached.emit()
 
 class StatsPage(QWidget):
     def __init__(self):
@@ -1026,6 +1106,7 @@ class StatsPage(QWidget):
         self.user_queries_day = {}
         self.user_queries_week = {}
         self.user_queries_month = {}
+        self.users_loaded = False
         self.__init_ui()
         self.set_data()
         self.__update_data()
@@ -1215,45 +1296,64 @@ class StatsPage(QWidget):
     def __update_data(self):
         self.update_bttn.setEnabled(False)
         self.update_bttn.updateBackgroundColor()
-        
+        # Разделы, которые не придут в этот раз (ошибка, таймаут), не должны показывать прежние значения
+        for key, value in empty_stats().items():
+            setattr(self, key, value)
+        self.users_loaded = False
+        self.set_data()
+
         self.worker = StatsWorker(data_provider)
+        self.worker.signals.section.connect(self.__on_stats_section)
         self.worker.signals.finished.connect(self.__on_stats_ready)
         QThreadPool.globalInstance().start(self.worker)
 
+    def __on_stats_section(self, name: str, section: dict):
+        # Разделы прежнего обновления, пришедшие после повторного нажатия кнопки, не нужны
+        if self.sender() is not self.worker.signals:
+            return
+        for key, value in section.items():
+            if isinstance(value, dict):
+                getattr(self, key).update(value)
+            else:
+                setattr(self, key, value)
+        if name == 'users':
+            self.users_loaded = True
+        # Данные уже видны, поэтому обновление можно запустить снова, не дожидаясь остальных разделов
+        self.update_bttn.setEnabled(True)
+        self.update_bttn.updateBackgroundColor()
+        self.set_data()
+
     def __on_stats_ready(self, stats: dict):
-        self.usr_cnt = stats.get('usr_cnt', 0)
-        self.favorite = stats.get('favorite', 0)
-        self.watchlist = stats.get('watchlist', 0)
-        self.query_day = stats.get('query_day', 0)
-        self.query_week = stats.get('query_week', 0)
-        self.query_month = stats.get('query_month', 0)
-        self.user_queries_day = stats.get('user_queries_day', {})
-        self.user_queries_week = stats.get('user_queries_week', {})
-        self.user_queries_month = stats.get('user_queries_month', {})
+        if self.sender() is not self.worker.signals:
+            return
         self.update_bttn.setEnabled(True)
         self.update_bttn.updateBackgroundColor()
         self.set_data()
 
+    def __average(self, value: int) -> str:
+        # Среднее считается только по пришедшему числу пользователей
+        if not self.users_loaded:
+            return '—'
+        return str(value // max(self.usr_cnt, 1))
+
     def set_data(self):
-        self.usr_cnt_value.setText(str(self.usr_cnt))
-        if self.usr_cnt == 0:
-            self.usr_cnt = 1
+        self.usr_cnt_value.setText(str(self.usr_cnt) if self.users_loaded else '—')
         match self.movie_bttns.value:
             case 'all':
                 self.favorite_value.setText(str(self.favorite))
                 self.watchlist_value.setText(str(self.watchlist))
             case 'avg':
-                self.favorite_value.setText(str(self.favorite // self.usr_cnt))
-                self.watchlist_value.setText(str(self.watchlist // self.usr_cnt))
+                self.favorite_value.setText(self.__average(self.favorite))
+                self.watchlist_value.setText(self.__average(self.watchlist))
         match self.query_bttns.value:
             case 'all':
                 self.query_day_value.setText(str(self.query_day))
                 self.query_week_value.setText(str(self.query_week))
                 self.query_month_value.setText(str(self.query_month))
             case 'avg':
-                self.query_day_value.setText(str(self.query_day // self.usr_cnt))
-                self.query_week_value.setText(str(self.query_week // self.usr_cnt))
-                self.query_month_value.setText(str(self.query_month // self.usr_cnt))
+                self.query_day_value.setText(self.__average(self.query_day))
+                self.query_week_value.setText(self.__average(self.query_week))
+                self.query_month_value.setText(self.__average(self.query_month))
         match self.user_bttns.value:
             case 'month':
                 user_queries = self.user_queries_month
@@ -1487,20 +1587,11 @@ class AppWindow(QGraphicsView):
         super().changeEvent(event)
 
 data_provider = DataProvider()
-# genres: dict[int, str] = {}
-# keywords: dict[int, str] = {}
-# directors: dict[int, str] = {}
-# actors: dict[int, str] = {}
-# countries: dict[str, str] = {}
-
-# for param in ('genres', 'keywords', 'directors', 'actors', 'countries'):
-#     for row in data_provider.db_request(f'SELECT * FROM {param}'):
-#         if param in ('genres', 'keywords', 'countries'):
-#             locals()[param][row.get('id')] = row.get('name')
-#         else:
-#             locals()[param][row.get('id')] = ' '.join([row.get('name'), row.get('surname')])
+search_page_size = 18
+data_provider.warm_up_lookups()
 
 app = QApplication(sys.argv)
+app.aboutToQuit.connect(data_provider.close)
 icons = {}
 for iconame in ('rating', 'date', 'duration', 'revenue'):
     icons[iconame] = QSvgWidget(f'icons/{iconame}.svg')
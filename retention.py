@@ -0,0 +1,189 @@
+"""Очистка журнала поиска (queries и query_*) старше срока хранения.
+
+Перед удалением каждый истёкший день один раз пересобирается в дневные агрегаты статистики
+и отмечается в query_rollup_folded, поэтому повторный запуск после сбоя ничего не посчитает дважды.
+Строки удаляются пачками в отдельных коротких транзакциях, чтобы не держать долгих блокировок.
+
+С --partition таблица queries (при необходимости однократно) разбивается на помесячные секции:
+истёкшие месяцы удаляются целиком через DETACH/DROP, а секции на ближайшие месяцы создаются заранее.
+
+    python retention.py --days 45
+    python retention.py --days 45 --partition
+"""
+from data_provider import DataProvider, query_links, query_rollup_lock, query_rollup_clear, query_rollup_by_dates
+from psycopg2 import sql
+from decouple import config
+import argparse, datetime, time
+
+retention_days = config('QUERY_RETENTION_DAYS', default=45, cast=int)
+retention_batch = config('QUERY_RETENTION_BATCH', default=5000, cast=int)
+
+# Связи удаляются в том же операторе, что и сами запросы, поэтому внешние ключи не мешают
+delete_batch_query = f"""
+    WITH batch AS (
+        SELECT id FROM queries
+        WHERE date < %(cutoff)s AND date::date IN (SELECT day FROM query_rollup_folded)
+        LIMIT %(batch_size)s
+    ),
+    {',\n    '.join(f"deleted_{table} AS (DELETE FROM {table} WHERE query_id IN (SELECT id FROM batch))" for table, _, _ in query_links)}
+    DELETE FROM queries WHERE id IN (SELECT id FROM batch)
+"""
+
+def month_start(day: datetime.date, shift: int = 0) -> datetime.date:
+    month = day.year * 12 + day.month - 1 + shift
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+def partition_name(month: datetime.date) -> str:
+    return f'queries_y{month.year}m{month.month:02d}'
+
+def fold_expired(data_provider: DataProvider, cutoff: datetime.date) -> int:
+    """Пересобирает агрегаты по каждому истёкшему дню, который ещё не был свёрнут."""
+    days = data_provider.db_request("""
+        SELECT DISTINCT date::date AS day FROM queries
+        WHERE date < %s AND date::date NOT IN (SELECT day FROM query_rollup_folded)
+        ORDER BY day
+    """, params=(cutoff,))
+    for row in days:
+        params = {'date_from': row['day'], 'date_to': row['day'] + datetime.timedelta(days=1)}
+        with data_provider.transaction() as cursor:
+            cursor.execute(query_rollup_lock)
+            for statement in query_rollup_clear + query_rollup_by_dates:
+                cursor.execute(statement, params)
+            cursor.execute("INSERT INTO query_rollup_folded (day) VALUES (%s) ON CONFLICT DO NOTHING", (row['day'],))
+    return len(days)
+
+def delete_expired(data_provider: DataProvider, cutoff: datetime.date, batch_size: int, pause: float) -> int:
+    deleted = 0
+    while True:
+        with data_provider.transaction() as cursor:
+            cursor.execute("SET LOCAL lock_timeout = '5s'")
+            cursor.execute(delete_batch_query, {'cutoff': cutoff, 'batch_size': batch_size})
+            count = cursor.rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+        time.sleep(pause)
+
+def is_partitioned(data_provider: DataProvider) -> bool:
+    return data_provider.db_request("SELECT relkind = 'p' AS partitioned FROM pg_class WHERE oid = 'queries'::regclass")[0]['partitioned']
+
+def create_partitions(cursor, first_month: datetime.date, last_month: datetime.date):
+    month = first_month
+    while month <= last_month:
+        cursor.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF queries FOR VALUES FROM (%s) TO (%s)").format(
+            sql.Identifier(partition_name(month))), (month, month_start(month, 1)))
+        month = month_start(month, 1)
+
+def convert_to_partitioned(data_provider: DataProvider, months_ahead: int, null_date: datetime.date = None):
+    """Однократно переносит queries в таблицу, секционированную по месяцам. Выполняется одной транзакцией
+    и блокирует журнал на время копирования, поэтому запускать её лучше в тихое время.
+
+    Первичный ключ становится (id, date), поэтому записи без даты сначала получают null_date,
+    а без null_date переход не выполняется. Индексы queries, кроме первичного ключа, пересоздаются
+    на новой таблице с теми же именами.
+
+    Внешние ключи query_* на queries удаляются намеренно и не восстанавливаются: на секционированную
+    таблицу можно сослаться только по всему ключу (id, date), а в query_* даты нет. Целостность держит
+    этот скрипт: связи удаляются раньше запросов и в delete_batch_query, и в drop_expired_partitions."""
+    today = datetime.date.today()
+    with data_provider.transaction() as cursor:
+        cursor.execute("LOCK TABLE queries IN ACCESS EXCLUSIVE MODE")
+        cursor.execute("SELECT count(*) AS cnt FROM queries WHERE date IS NULL")
+        undated = cursor.fetchone()['cnt']
+        if undated and null_date is None:
+            raise ValueError(f'В queries {undated} записей без даты: укажите для них --null-date')
+        if undated:
+            cursor.execute("UPDATE queries SET date = %s WHERE date IS NULL", (null_date,))
+        cursor.execute("SELECT pg_get_serial_sequence('queries', 'id') AS sequence, min(date)::date AS first_day FROM queries")
+        row = cursor.fetchone()
+        # Определения читаются до переименования, поэтому ссылаются на queries
+        cursor.execute("SELECT pg_get_indexdef(indexrelid) AS definition FROM pg_index WHERE indrelid = 'queries'::regclass AND NOT indisprimary")
+        indexes = [index['definition'] for index in cursor.fetchall()]
+        cursor.execute("""
+            SELECT conrelid::regclass::text AS table_name, conname
+            FROM pg_constraint WHERE confrelid = 'queries'::regclass AND contype = 'f'
+        """)
+        for constraint in cursor.fetchall():
+            cursor.execute(sql.SQL("ALTER TABLE {} DROP CONSTRAINT {}").format(
+                sql.SQL(constraint['table_name']), sql.Identifier(constraint['conname'])))
+
+        cursor.execute("ALTER TABLE queries RENAME TO queries_legacy")
+        cursor.execute("CREATE TABLE queries (LIKE queries_legacy INCLUDING DEFAULTS INCLUDING CONSTRAINTS) PARTITION BY RANGE (date)")
+        cursor.execute("ALTER TABLE queries ADD PRIMARY KEY (id, date)")
+        # Последовательность id должна принадлежать новой таблице, иначе она удалится вместе со старой
+        cursor.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY queries.id").format(sql.SQL(row['sequence'])))
+        create_partitions(cursor, month_start(row['first_day'] or today), month_start(today, months_ahead))
+        cursor.execute("CREATE TABLE IF NOT EXISTS queries_default PARTITION OF queries DEFAULT")
+        cursor.execute("INSERT INTO queries SELECT * FROM queries_legacy")
+        # Индексы старой таблицы удаляются вместе с ней и освобождают имена
+        cursor.execute("DROP TABLE queries_legacy")
+        for definition in indexes:
+            cursor.execute(definition)
+        cursor.execute("CREATE INDEX IF NOT EXISTS queries_date_idx ON queries (date)")
+
+def drop_expired_partitions(data_provider: DataProvider, cutoff: datetime.date, batch_size: int, pause: float) -> list[str]:
+    """Удаляет секции месяцев, целиком лежащих до cutoff. Связи query_* не секционированы,
+    поэтому сначала они удаляются пачками по id запросов секции."""
+    partitions = data_provider.db_request("""
+        SELECT c.relname AS name FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'queries'::regclass AND c.relname ~ '^queries_y[0-9]{4}m[0-9]{2}$'
+        ORDER BY c.relname
+    """)
+    dropped = []
+    for partition in partitions:
+        month = datetime.date(int(partition['name'][9:13]), int(partition['name'][14:16]), 1)
+        if month_start(month, 1) > cutoff:
+            continue
+        table = sql.Identifier(partition['name'])
+        # Секция удаляется только после свёртки всех её дней
+        unfolded = data_provider.db_request(sql.SQL(
+            "SELECT 1 FROM {} WHERE date::date NOT IN (SELECT day FROM query_rollup_folded) LIMIT 1").format(table))
+        if unfolded:
+            continue
+        last_id = 0
+        while True:
+            with data_provider.transaction() as cursor:
+                cursor.execute(sql.SQL("SELECT id FROM {} WHERE id > %s ORDER BY id LIMIT %s").format(table), (last_id, batch_size))
+                ids = [row['id'] for row in cursor.fetchall()]
+                for link_table, _, _ in query_links:
+                    cursor.execute(f"DELETE FROM {link_table} WHERE query_id = ANY(%s)", (ids,))
+            if len(ids) < batch_size:
+                break
+            last_id = ids[-1]
+            time.sleep(pause)
+        with data_provider.transaction() as cursor:
+            cursor.execute("SET LOCAL lock_timeout = '5s'")
+            cursor.execute(sql.SQL("ALTER TABLE queries DETACH PARTITION {}").format(table))
+            cursor.execute(sql.SQL("DROP TABLE {}").format(table))
+        dropped.append(partition['name'])
+    return dropped
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=retention_days, help='сколько дней журнала хранить')
+    parser.add_argument('--batch-size', type=int, default=retention_batch)
+    parser.add_argument('--pause', type=float, default=0.1, help='пауза между пачками, секунды')
+    parser.add_argument('--partition', action='store_true', help='секционировать queries по месяцам и удалять секции целиком')
+    parser.add_argument('--months-ahead', type=int, default=2, help='на сколько месяцев вперёд создавать секции')
+    parser.add_argument('--null-date', type=datetime.date.fromisoformat,
+                        help='дата (ГГГГ-ММ-ДД) для записей queries без даты при секционировании')
+    args = parser.parse_args()
+
+    cutoff = datetime.date.today() - datetime.timedelta(days=args.days)
+    data_provider = DataProvider(minconn=1, maxconn=1)
+    try:
+        print(f'Свёрнуто дней: {fold_expired(data_provider, cutoff)}')
+        if args.partition:
+            if not is_partitioned(data_provider):
+                convert_to_partitioned(data_provider, args.months_ahead, args.null_date)
+                print('Таблица queries секционирована по месяцам')
+            with data_provider.transaction() as cursor:
+                create_partitions(cursor, month_start(datetime.date.today()), month_start(datetime.date.today(), args.months_ahead))
+            for name in drop_expired_partitions(data_provider, cutoff, args.batch_size, args.pause):
+                print(f'Удалена секция {name}')
+        print(f'Удалено запросов: {delete_expired(data_provider, cutoff, args.batch_size, args.pause)}')
+    finally:
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,29 @@
+"""Пересборка дневных агрегатов журнала поиска (query_counts_daily, query_stats_daily) по сырым
+таблицам queries и query_*. Нужна один раз после появления агрегатов и после ручных правок журнала.
+Дни, свёрнутые retention.py (query_rollup_folded), не трогаются: их сырого журнала уже нет.
+
+    python rollup_queries.py --days 31
+    python rollup_queries.py --from 2024-01-01 --to 2024-02-01
+"""
+from data_provider import DataProvider
+import argparse, datetime
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--from', dest='date_from', type=datetime.date.fromisoformat, help='первый день периода')
+    parser.add_argument('--to', dest='date_to', type=datetime.date.fromisoformat, help='день после конца периода')
+    parser.add_argument('--days', type=int, default=31, help='длина периода до --to, если --from не указан')
+    args = parser.parse_args()
+
+    date_to = args.date_to or datetime.date.today() + datetime.timedelta(days=1)
+    date_from = args.date_from or date_to - datetime.timedelta(days=args.days)
+
+    data_provider = DataProvider(minconn=1, maxconn=1)
+    try:
+        data_provider.rebuild_query_rollups(date_from, date_to)
+        print(f'Агрегаты пересобраны за период {date_from} - {date_to}')
+    finally:
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()
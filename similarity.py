@@ -0,0 +1,65 @@
+"""Поиск похожих фильмов по MinHash-сигнатурам множеств жанров, ключевых слов и актёров.
+
+Сигнатура фильма - num_perm минимумов хэшей его признаков (uint32), доля совпавших позиций двух сигнатур
+оценивает коэффициент Жаккара их множеств. Чтобы не сравнивать фильм со всем каталогом (LSH), сигнатура
+режется на bands полос: фильмы с одинаковой полосой попадают в одну корзину и становятся кандидатами.
+Сигнатуры и корзины хранятся в таблицах movie_signatures и movie_lsh, поэтому индекс общий для бота и приложения.
+"""
+from collections.abc import Iterable
+import hashlib, numpy as np
+
+feature_types = ('genre', 'keyword', 'actor')
+# Простое число 2^31 - 1: произведение коэффициента на признак помещается в uint64
+prime = (1 << 31) - 1
+
+class MinHasher:
+    def __init__(self, num_perm: int = 128, bands: int = 32, seed: int = 1):
+        """Коэффициенты хэшей задаются seed, поэтому у всех процессов с одинаковыми настройками сигнатуры совпадают."""
+        if bands <= 0 or num_perm % bands:
+            raise ValueError(f'Число полос {bands} должно делить длину сигнатуры {num_perm}')
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.a = rng.integers(1, prime, num_perm, dtype=np.uint64)
+        self.b = rng.integers(0, prime, num_perm, dtype=np.uint64)
+
+    def signature(self, features: Iterable[tuple[str, int]]) -> np.ndarray | None:
+        """Сигнатура множества признаков (тип, id); None, если у фильма нет ни одного признака."""
+        # Тип признака кодируется младшими разрядами, чтобы одинаковые id разных справочников не совпадали
+        tokens = np.unique(np.fromiter(
+            (feature_id * len(feature_types) + feature_types.index(feature_type)
+             for feature_type, feature_id in features if feature_type in feature_types),
+            dtype=np.uint64
+        )) % prime
+        if not len(tokens):
+            return None
+        hashes = (self.a[:, None] * tokens[None, :] + self.b[:, None]) % prime
+        return hashes.min(axis=1).astype('<u4')
+
+    def buckets(self, signature: np.ndarray) -> list[tuple[int, int]]:
+        """Пары (полоса, корзина); корзина - 64-битный хэш значений полосы."""
+        data = signature.astype('<u4').tobytes()
+        width = self.rows * 4
+        return [
+            (band, int.from_bytes(hashlib.blake2b(data[band * width:(band + 1) * width], digest_size=8).digest(), 'little', signed=True))
+            for band in range(self.bands)
+        ]
+
+def signature_to_bytes(signature: np.ndarray) -> bytes:
+    return signature.astype('<u4').tobytes()
+
+def signature_from_bytes(data: bytes) -> np.ndarray:
+    return np.frombuffer(data, dtype='<u4')
+
+def rank_similar(signature: np.ndarray, candidates: Iterable[tuple[int, bytes]], k: int) -> list[int]:
+    """id не более k кандидатов (id, сигнатура) с наибольшей оценкой сходства; при равенстве выше меньший id."""
+    candidates = [(movie_id, signature_from_bytes(data)) for movie_id, data in candidates]
+    candidates = [(movie_id, other) for movie_id, other in candidates if len(other) == len(signature)]
+    if k <= 0 or not candidates:
+        return []
+    ids = np.array([movie_id for movie_id, _ in candidates], dtype=np.int64)
+    similarity = (np.vstack([other for _, other in candidates]) == signature).mean(axis=1)
+    order = np.lexsort((ids, -similarity))
+    order = order[similarity[order] > 0][:k]
+    return ids[order].tolist()
@@ -0,0 +1,42 @@
+"""Полная пересборка индекса похожих фильмов (movie_signatures, movie_lsh) по связям фильмов с признаками.
+
+Дальше индекс поддерживается сам: save_movie пересчитывает сигнатуру фильма при изменении его связей.
+Пересборка нужна при первом запуске и после смены MINHASH_PERMUTATIONS или LSH_BANDS.
+
+    python similarity_index.py
+"""
+from data_provider import DataProvider, minhasher, recommender_relation_queries, stream_chunk_size
+from similarity import signature_to_bytes
+from collections import defaultdict
+import argparse, psycopg2.extras
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.parse_args()
+
+    data_provider = DataProvider(minconn=1, maxconn=1)
+    try:
+        features = defaultdict(list)
+        for feature_type, query in recommender_relation_queries.items():
+            for rows in data_provider.stream_request(query, chunk_size=stream_chunk_size * 100):
+                for row in rows:
+                    features[row['movie_id']].append((feature_type, row['feature_id']))
+
+        signatures, buckets = [], []
+        for movie_id, movie_features in features.items():
+            signature = minhasher.signature(movie_features)
+            if signature is None:
+                continue
+            signatures.append((movie_id, signature_to_bytes(signature)))
+            buckets.extend((band, bucket, movie_id) for band, bucket in minhasher.buckets(signature))
+
+        with data_provider.transaction() as cursor:
+            cursor.execute("TRUNCATE movie_lsh, movie_signatures")
+            psycopg2.extras.execute_values(cursor, "INSERT INTO movie_signatures (movie_id, signature) VALUES %s", signatures, page_size=1000)
+            psycopg2.extras.execute_values(cursor, "INSERT INTO movie_lsh (band, bucket, movie_id) VALUES %s", buckets, page_size=1000)
+        print(f'Сигнатур: {len(signatures)}, корзин LSH: {len(buckets)}')
+    finally:
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+"""Обновление рейтинга, сборов, длительности и описания фильмов по ленте изменений TMDB.
+
+Лента /movie/changes запрашивается окнами не длиннее 14 дней (ограничение TMDB) от даты, до которой
+прошлый запуск уже всё применил (tmdb_sync_state), до сегодняшнего дня. Подробности загружаются только
+для изменившихся фильмов, которые есть в каталоге, и записываются групповыми UPDATE, поэтому время
+работы зависит от числа изменений, а не от размера каталога. Дата сохраняется после каждого окна.
+
+    python sync_tmdb.py
+    python sync_tmdb.py --days 7 --api-url http://127.0.0.1:8080/3
+"""
+from data_provider import DataProvider
+from tmdb_client import TMDBClient, TMDBError, api_url
+import argparse, asyncio, datetime
+
+state_name = 'movies'
+# Максимальная длина периода, который принимает /movie/changes
+window_days = 14
+
+def read_mark(data_provider: DataProvider) -> datetime.date | None:
+    rows = data_provider.db_request("SELECT synced_until FROM tmdb_sync_state WHERE name = %s", params=(state_name,))
+    return rows[0]['synced_until'] if rows else None
+
+def write_mark(data_provider: DataProvider, synced_until: datetime.date):
+    data_provider.db_request("""
+        INSERT INTO tmdb_sync_state (name, synced_until) VALUES (%s, %s)
+        ON CONFLICT (name) DO UPDATE SET synced_until = EXCLUDED.synced_until
+    """, False, (state_name, synced_until))
+
+async def fetch_update(client: TMDBClient, tmdb_id: int) -> tuple | None:
+    try:
+        details = await client.details(tmdb_id)
+    except TMDBError as error:
+        if error.status == 404:
+            return None
+        raise
+    return (tmdb_id, details.get('vote_average'), details.get('revenue'), details.get('runtime'), details.get('overview'))
+
+async def sync_window(client: TMDBClient, data_provider: DataProvider, start: datetime.date, end: datetime.date, batch_size: int) -> tuple[int, int]:
+    # Лента отдаёт id TMDB; фильмы каталога сопоставляются с ними по tmdb_id
+    changed_ids = await client.changed_movie_ids(start, end)
+    known_ids = [row['tmdb_id'] for row in await asyncio.to_thread(
+        data_provider.db_request, "SELECT tmdb_id FROM movies WHERE tmdb_id = ANY(%s)", True, (changed_ids,))] if changed_ids else []
+    updated = 0
+    for offset in range(0, len(known_ids), batch_size):
+        rows = [row for row in await asyncio.gather(*(fetch_update(client, tmdb_id) for tmdb_id in known_ids[offset:offset + batch_size])) if row]
+        if rows:
+            await asyncio.to_thread(data_provider.update_movies, rows)
+        updated += len(rows)
+    return len(changed_ids), updated
+
+async def run(args, data_provider: DataProvider):
+    today = datetime.date.today()
+    start = read_mark(data_provider) or today - datetime.timedelta(days=args.days)
+    async with TMDBClient(base_url=args.api_url) as client:
+        while True:
+            end = min(start + datetime.timedelta(days=window_days), today)
+            changed, updated = await sync_window(client, data_provider, start, end, args.batch_size)
+            # Последний день окна станет началом следующего запуска: изменения за сегодня ещё могут прийти
+            await asyncio.to_thread(write_mark, data_provider, end)
+            print(f'{start} - {end}: изменено в TMDB {changed}, обновлено в каталоге {updated}')
+            if end >= today:
+                break
+            start = end
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--days', type=int, default=1, help='за сколько дней брать изменения при первом запуске')
+    parser.add_argument('--batch-size', type=int, default=500, help='сколько фильмов обновлять одним запросом')
+    parser.add_argument('--api-url', default=api_url, help='адрес API TMDB (например, локального тестового сервера)')
+    args = parser.parse_args()
+
+    data_provider = DataProvider(minconn=1, maxconn=1)
+    try:
+        asyncio.run(run(args, data_provider))
+    finally:
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""sync_tmdb.run против локальной ленты изменений: окна не длиннее 14 дней и сохранение даты после каждого окна."""
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from unittest import IsolatedAsyncioTestCase
+import argparse, datetime, os
+
+# Настройки, без которых не импортируются модули; база и сеть в тесте не используются
+for name, value in {'API_TOKEN': 'test', 'TMDB_DNS': '', 'DB_NAME': 'test', 'DB_USER': 'test', 'DB_PSWD': 'test', 'DB_HOST': 'localhost'}.items():
+    os.environ.setdefault(name, value)
+import sync_tmdb
+
+class FakeCatalogue:
+    """Вместо DataProvider: фильмы каталога по tmdb_id, дата синхронизации и записанные обновления."""
+    def __init__(self, tmdb_ids: set[int], mark: datetime.date = None):
+        self.tmdb_ids = tmdb_ids
+        self.mark = mark
+        self.marks = []
+        self.updates = []
+
+    def db_request(self, query: str, get: bool = True, params = None):
+        if 'SELECT synced_until' in query:
+            return [{'synced_until': self.mark}] if self.mark else []
+        if 'INSERT INTO tmdb_sync_state' in query:
+            self.mark = params[1]
+            self.marks.append(self.mark)
+            return None
+        if 'SELECT tmdb_id FROM movies' in query:
+            return [{'tmdb_id': tmdb_id} for tmdb_id in params[0] if tmdb_id in self.tmdb_ids]
+        raise AssertionError(query)
+
+    def update_movies(self, rows: list[tuple]):
+        self.updates.extend(rows)
+
+class ChangesFeedTest(IsolatedAsyncioTestCase):
+    page_size = 2
+
+    async def asyncSetUp(self):
+        self.today = datetime.date.today()
+        # id фильмов, изменённых в TMDB, по дням
+        self.changes: dict[datetime.date, list[int]] = {}
+        self.windows = []
+        self.failing_window = None
+        app = web.Application()
+        app.router.add_get('/3/movie/changes', self.movie_changes)
+        app.router.add_get('/3/movie/{movie_id}', self.movie_details)
+        self.server = TestServer(app)
+        await self.server.start_server()
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def movie_changes(self, request: web.Request) -> web.Response:
+        start = datetime.date.fromisoformat(request.query['start_date'])
+        end = datetime.date.fromisoformat(request.query['end_date'])
+        if end - start > datetime.timedelta(days=sync_tmdb.window_days):
+            return web.json_response({'status_message': 'Invalid date range'}, status=422)
+        if request.query['page'] == '1':
+            self.windows.append((start, end))
+        if len(self.windows) == self.failing_window:
+            return web.json_response({'status_message': 'Bad request'}, status=400)
+        ids = [movie_id for day, day_ids in sorted(self.changes.items()) if start <= day <= end for movie_id in day_ids]
+        page = int(request.query['page'])
+        return web.json_response({
+            'results': [{'id': movie_id} for movie_id in ids[(page - 1) * self.page_size:page * self.page_size]],
+            'page': page,
+            'total_pages': max(1, -(-len(ids) // self.page_size)),
+        })
+
+    async def movie_details(self, request: web.Request) -> web.Response:
+        movie_id = int(request.match_info['movie_id'])
+        return web.json_response({'id': movie_id, 'vote_average': 7.5, 'revenue': movie_id * 100, 'runtime': 90, 'overview': 'Описание'})
+
+    def args(self, days: int = 1) -> argparse.Namespace:
+        return argparse.Namespace(days=days, batch_size=2, api_url=str(self.server.make_url('/3')))
+
+    def day(self, days_ago: int) -> datetime.date:
+        return self.today - datetime.timedelta(days=days_ago)
+
+    async def test_long_period_is_split_into_windows(self):
+        self.changes = {self.day(30): [1, 2], self.day(20): [3, 4, 5], self.day(5): [6], self.today: [7]}
+        catalogue = FakeCatalogue({1, 3, 5, 6, 7})
+        await sync_tmdb.run(self.args(days=35), catalogue)
+
+        self.assertEqual(self.windows[0][0], self.day(35))
+        self.assertEqual(self.windows[-1][1], self.today)
+        for (start, end), (next_start, _) in zip(self.windows, self.windows[1:]):
+            self.assertEqual(end, next_start)
+        self.assertTrue(all(end - start <= datetime.timedelta(days=sync_tmdb.window_days) for start, end in self.windows))
+        self.assertEqual(len(self.windows), 3)
+        # Дата сохраняется после каждого окна и доходит до сегодняшнего дня
+        self.assertEqual(catalogue.marks, [end for _, end in self.windows])
+        self.assertEqual(catalogue.mark, self.today)
+        self.assertEqual(sorted(row[0] for row in catalogue.updates), [1, 3, 5, 6, 7])
+
+    async def test_next_run_starts_from_saved_mark(self):
+        self.changes = {self.day(3): [1], self.day(1): [2]}
+        catalogue = FakeCatalogue({1, 2}, mark=self.day(2))
+        await sync_tmdb.run(self.args(days=30), catalogue)
+
+        self.assertEqual(self.windows, [(self.day(2), self.today)])
+        self.assertEqual([row[0] for row in catalogue.updates], [2])
+
+        self.windows.clear()
+        await sync_tmdb.run(self.args(days=30), catalogue)
+        self.assertEqual(self.windows, [(self.today, self.today)])
+
+    async def test_failed_window_keeps_previous_mark(self):
+        self.changes = {self.day(25): [1], self.day(5): [2]}
+        self.failing_window = 2
+        catalogue = FakeCatalogue({1, 2})
+        with self.assertRaises(sync_tmdb.TMDBError):
+            await sync_tmdb.run(self.args(days=30), catalogue)
+
+        self.assertEqual(catalogue.marks, [self.windows[0][1]])
+        self.assertEqual([row[0] for row in catalogue.updates], [1])
+
+        # Повторный запуск продолжает с последнего применённого окна
+        self.failing_window = None
+        self.windows.clear()
+        await sync_tmdb.run(self.args(days=30), catalogue)
+        self.assertEqual(self.windows[0][0], catalogue.marks[0])
+        self.assertEqual(catalogue.mark, self.today)
+        self.assertIn(2, [row[0] for row in catalogue.updates])
@@ -0,0 +1,133 @@
+"""TMDBClient против локального тестового сервера: повторы, Retry-After и перепроверка кэша ответом 304."""
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+from email.utils import format_datetime
+from unittest import IsolatedAsyncioTestCase, TestCase, mock
+import asyncio, datetime, os, threading, time
+
+os.environ.setdefault('API_TOKEN', 'test')
+import tmdb_client
+from tmdb_client import SharedClient, TMDBClient, TMDBError, retry_after_seconds
+
+class MemoryCache:
+    """Хранилище ответов с тем же интерфейсом, что у data_provider.ResponseCache, но в памяти."""
+    def __init__(self):
+        self.responses = {}
+        self.fresh = True
+        self.revalidations = 0
+
+    def get(self, path: str, params: dict) -> dict | None:
+        cached = self.responses.get(path)
+        return cached and {**cached, 'fresh': self.fresh}
+
+    def put(self, path: str, params: dict, body: dict, etag: str = None, last_modified: str = None):
+        self.responses[path] = {'body': body, 'etag': etag, 'last_modified': last_modified}
+
+    def revalidated(self, path: str, params: dict):
+        self.revalidations += 1
+
+class TMDBServerTestCase(IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.requests = []
+        app = web.Application()
+        app.router.add_get('/3/movie/{movie_id}', self.movie)
+        self.server = TestServer(app)
+        await self.server.start_server()
+        self.responses = []
+
+    async def asyncTearDown(self):
+        await self.server.close()
+
+    async def movie(self, request: web.Request) -> web.Response:
+        self.requests.append(request.headers.copy())
+        return self.responses.pop(0)
+
+    def client(self, **kwargs) -> TMDBClient:
+        return TMDBClient(base_url=str(self.server.make_url('/3')), token='test', dns='', **kwargs)
+
+    async def test_retries_429_then_returns_body(self):
+        self.responses = [web.Response(status=429), web.Response(status=503), web.json_response({'id': 7})]
+        with mock.patch.object(tmdb_client, 'api_backoff', 0.01):
+            async with self.client() as client:
+                self.assertEqual(await client.details(7), {'id': 7})
+        self.assertEqual(len(self.requests), 3)
+
+    async def test_gives_up_after_retries(self):
+        self.responses = [web.Response(status=500) for _ in range(3)]
+        with mock.patch.object(tmdb_client, 'api_backoff', 0.01):
+            async with self.client(retries=2) as client:
+                with self.assertRaises(TMDBError) as error:
+                    await client.details(7)
+        self.assertEqual(error.exception.status, 500)
+        self.assertEqual(len(self.requests), 3)
+
+    async def test_does_not_retry_404(self):
+        self.responses = [web.Response(status=404)]
+        async with self.client() as client:
+            with self.assertRaises(TMDBError):
+                await client.details(7)
+        self.assertEqual(len(self.requests), 1)
+
+    async def test_retry_after_seconds_is_respected(self):
+        self.responses = [web.Response(status=429, headers={'Retry-After': '0.3'}), web.json_response({'id': 7})]
+        async with self.client() as client:
+            start = time.monotonic()
+            await client.details(7)
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+
+    async def test_retry_after_is_clamped_to_backoff_max(self):
+        later = format_datetime(datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(hours=1), usegmt=True)
+        self.responses = [
+            web.Response(status=429, headers={'Retry-After': '3600'}),
+            web.Response(status=429, headers={'Retry-After': later}),
+            web.json_response({'id': 7}),
+        ]
+        with mock.patch.object(tmdb_client, 'api_backoff_max', 0.05):
+            async with self.client() as client:
+                start = time.monotonic()
+                await client.details(7)
+        self.assertLess(time.monotonic() - start, 2)
+
+    async def test_stale_response_is_revalidated_with_304(self):
+        cache = MemoryCache()
+        self.responses = [
+            web.json_response({'id': 7}, headers={'ETag': '"v1"', 'Last-Modified': 'Wed, 01 Jan 2025 00:00:00 GMT'}),
+            web.Response(status=304),
+        ]
+        async with self.client(cache=cache) as client:
+            self.assertEqual(await client.details(7), {'id': 7})
+            # Свежий ответ отдаётся без запроса
+            self.assertEqual(await client.details(7), {'id': 7})
+            self.assertEqual(len(self.requests), 1)
+            cache.fresh = False
+            self.assertEqual(await client.details(7), {'id': 7})
+        self.assertEqual(len(self.requests), 2)
+        self.assertEqual(self.requests[1]['If-None-Match'], '"v1"')
+        self.assertEqual(self.requests[1]['If-Modified-Since'], 'Wed, 01 Jan 2025 00:00:00 GMT')
+        self.assertEqual(cache.revalidations, 1)
+
+class RetryAfterTest(TestCase):
+    def test_seconds(self):
+        self.assertEqual(retry_after_seconds('2.5'), 2.5)
+
+    def test_http_date(self):
+        later = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+        self.assertAlmostEqual(retry_after_seconds(format_datetime(later, usegmt=True)), 30, delta=2)
+
+    def test_garbage(self):
+        self.assertIsNone(retry_after_seconds('soon'))
+
+class SharedClientTest(TestCase):
+    def test_calls_from_threads_share_one_client(self):
+        shared = SharedClient(token='test', dns='')
+        clients = []
+        try:
+            clients.append(shared.run(lambda client: asyncio.sleep(0, client)))
+            thread = threading.Thread(target=lambda: clients.append(shared.run(lambda client: asyncio.sleep(0, client))))
+            thread.start()
+            thread.join()
+        finally:
+            shared.close()
+        self.assertIs(clients[0], clients[1])
+        self.assertIs(clients[0].bucket, clients[1].bucket)
+        self.assertTrue(clients[0].session.closed)
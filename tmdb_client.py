@@ -0,0 +1,281 @@
+"""Асинхронный клиент TMDB API на aiohttp.
+
+Число одновременных запросов ограничено семафором, частота - корзиной токенов (по умолчанию 40 запросов
+в секунду, ниже лимита TMDB). Ответы 429 и 5xx, обрывы соединения и таймауты повторяются с экспоненциальной
+задержкой со случайным разбросом; заголовок Retry-After (в секундах или датой) имеет приоритет, но не превышает
+TMDB_BACKOFF_MAX. Адрес API задаётся в TMDB_API_URL, поэтому клиент можно направить на локальный тестовый сервер.
+
+SharedClient держит один клиент на фоновом цикле событий для синхронного кода (DataProvider), чтобы сессия
+и лимиты не создавались заново на каждый запрос.
+"""
+from collections.abc import Awaitable, Callable
+from decouple import config
+from urllib.parse import urlencode
+import aiohttp, asyncio, datetime, email.utils, hashlib, json, os, random, re, threading, time
+
+api_url = config('TMDB_API_URL', default='https://api.themoviedb.org/3')
+api_token = config('API_TOKEN')
+api_language = config('TMDB_LANGUAGE', default='ru-RU')
+# Пустое значение - системный резолвер; по умолчанию тот же DNS, что и у DNSClientSession
+api_dns = config('TMDB_DNS', default='9.9.9.9')
+api_concurrency = config('TMDB_CONCURRENCY', default=8, cast=int)
+api_rate = config('TMDB_RATE', default=40, cast=float)
+api_retries = config('TMDB_RETRIES', default=4, cast=int)
+api_timeout = config('TMDB_TIMEOUT', default=10, cast=float)
+api_backoff = config('TMDB_BACKOFF', default=0.5, cast=float)
+api_backoff_max = config('TMDB_BACKOFF_MAX', default=30, cast=float)
+
+retry_statuses = {429, 500, 502, 503, 504}
+
+class TMDBError(Exception):
+    def __init__(self, status: int, path: str, message: str = ''):
+        super().__init__(f'TMDB {status} {path} {message}'.strip())
+        self.status = status
+        self.path = path
+
+class TokenBucket:
+    """Не более rate запросов в секунду в среднем и не более capacity подряд."""
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+def retry_after_seconds(value: str) -> float | None:
+    """Задержка из заголовка Retry-After: число секунд или HTTP-дата; None, если значение не разобрать."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        date = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        date = date.replace(tzinfo=datetime.timezone.utc)
+    return (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds()
+
+def is_cyrillic(text: str) -> bool:
+    return bool(re.search('[а-яА-ЯёЁ]', text))
+
+def parse_credits(credits: dict) -> tuple[list[tuple[int, str, str]], list | None]:
+    """Актёры (id, имя, фамилия) и режиссёр [id, имя, фамилия] из ответа /movie/{id}/credits.
+    Берутся только люди с именем на кириллице, как их хранит каталог."""
+    actors = []
+    director = None
+    for credit in credits.get('cast', []) + credits.get('crew', []):
+        name = credit.get('name') or ''
+        if not is_cyrillic(name):
+            continue
+        ns = name.split()
+        if len(ns) < 2:
+            continue
+        if credit.get('known_for_department') == 'Acting':
+            actors.append((credit['id'], ns[0], ns[1]))
+        elif credit.get('known_for_department') == 'Directing':
+            director = [credit['id'], ns[0], ns[1]]
+            break
+    return actors, director
+
+class TMDBClient:
+    """Используется как асинхронный контекстный менеджер: сессия и лимиты общие для всех запросов внутри него."""
+    def __init__(self, base_url: str = api_url, token: str = api_token, language: str = api_language,
+                 concurrency: int = api_concurrency, rate: float = api_rate, retries: int = api_retries,
+                 timeout: float = api_timeout, dns: str = api_dns, cache = None):
+        """cache - хранилище ответов с методами get/put/revalidated (data_provider.ResponseCache) или None."""
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.language = language
+        self.concurrency = concurrency
+        self.retries = retries
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.dns = dns
+        self.cache = cache
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.bucket = TokenBucket(rate)
+        self.session: aiohttp.ClientSession = None
+
+    async def __aenter__(self) -> 'TMDBClient':
+        resolver = aiohttp.AsyncResolver(nameservers=[self.dns]) if self.dns else None
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.concurrency, resolver=resolver),
+            headers={'accept': 'application/json', 'Authorization': f'Bearer {self.token}'},
+            timeout=self.timeout,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def get(self, path: str, **params) -> dict:
+        params.setdefault('language', self.language)
+        cached = self.cache.get(path, params) if self.cache is not None else None
+        if cached and cached['fresh']:
+            return cached['body']
+        # Устаревший ответ перепроверяется: при 304 тело не передаётся повторно
+        conditional = {}
+        if cached and cached['etag']:
+            conditional['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            conditional['If-Modified-Since'] = cached['last_modified']
+        for attempt in range(self.retries + 1):
+            retry_after = None
+            try:
+                async with self.semaphore:
+                    await self.bucket.acquire()
+                    async with self.session.get(f'{self.base_url}/{path.lstrip('/')}', params=params, headers=conditional) as response:
+                        if response.status == 304 and cached:
+                            self.cache.revalidated(path, params)
+                            return cached['body']
+                        if response.status < 400:
+                            body = await response.json()
+                            if self.cache is not None:
+                                self.cache.put(path, params, body, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+                            return body
+                        if response.status not in retry_statuses or attempt == self.retries:
+                            raise TMDBError(response.status, path, await response.text())
+                        retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError):
+                if attempt == self.retries:
+                    raise
+            await asyncio.sleep(self.__delay(attempt, retry_after))
+
+    def __delay(self, attempt: int, retry_after: str = None) -> float:
+        seconds = retry_after_seconds(retry_after) if retry_after else None
+        if seconds is not None:
+            # Слишком большое значение не должно останавливать загрузку надолго
+            return min(api_backoff_max, max(0.0, seconds))
+        # Полный разброс: одновременно упавшие запросы не повторяются одной волной
+        return random.uniform(0, min(api_backoff_max, api_backoff * 2 ** attempt))
+
+    async def search(self, title: str) -> dict | None:
+        """Первый результат поиска фильма по названию."""
+        results = (await self.get('search/movie', query=title, include_adult='false', page=1)).get('results', [])
+        return results[0] if results else None
+
+    async def details(self, movie_id: int) -> dict:
+        return await self.get(f'movie/{movie_id}')
+
+    async def credits(self, movie_id: int) -> dict:
+        return await self.get(f'movie/{movie_id}/credits')
+
+    async def keywords(self, movie_id: int) -> dict:
+        return await self.get(f'movie/{movie_id}/keywords')
+
+    async def changed_movie_ids(self, start_date: datetime.date, end_date: datetime.date) -> list[int]:
+        """id фильмов, изменённых в TMDB за период не длиннее 14 дней; страницы после первой запрашиваются одновременно."""
+        params = {'start_date': start_date.isoformat(), 'end_date': end_date.isoformat()}
+        first = await self.get('movie/changes', page=1, **params)
+        pages = [first] + list(await asyncio.gather(
+            *(self.get('movie/changes', page=page, **params) for page in range(2, first.get('total_pages', 1) + 1))
+        ))
+        return list(dict.fromkeys(result['id'] for page in pages for result in page.get('results', [])))
+
+    async def find_movie(self, title: str) -> tuple[dict, dict, dict] | None:
+        """Результат поиска, подробности и титры фильма; подробности и титры запрашиваются одновременно."""
+        movie = await self.search(title)
+        if movie is None:
+            return None
+        details, credits = await asyncio.gather(self.details(movie['id']), self.credits(movie['id']))
+        return movie, details, credits
+
+class FixtureClient(TMDBClient):
+    """Клиент, который записывает ответы API в каталог (record=True) или отвечает из него без сети.
+    Ответ 404 записывается тоже, чтобы воспроизведение повторяло и ненайденные фильмы."""
+    def __init__(self, directory: str, record: bool = False, **kwargs):
+        super().__init__(**kwargs)
+        self.directory = directory
+        self.record = record
+
+    async def __aenter__(self) -> 'FixtureClient':
+        if self.record:
+            os.makedirs(self.directory, exist_ok=True)
+            return await super().__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.session is not None:
+            await super().__aexit__(*exc_info)
+
+    def fixture_path(self, path: str, params: dict) -> str:
+        key = f'{path}?{urlencode(sorted(params.items()))}'
+        name = re.sub('[^0-9A-Za-z]+', '_', path).strip('_')
+        return os.path.join(self.directory, f'{name}-{hashlib.sha1(key.encode()).hexdigest()[:12]}.json')
+
+    async def get(self, path: str, **params) -> dict:
+        params.setdefault('language', self.language)
+        fixture = self.fixture_path(path, params)
+        if not self.record:
+            if not os.path.exists(fixture):
+                raise TMDBError(404, path, 'нет записанного ответа')
+            with open(fixture, encoding='utf-8') as file:
+                data = json.load(file)
+            if 'fixture_error' in data:
+                raise TMDBError(data['fixture_error'], path)
+            return data
+        try:
+            data = await super().get(path, **params)
+        except TMDBError as error:
+            if error.status != 404:
+                raise
+            self.__save(fixture, {'fixture_error': error.status})
+            raise
+        self.__save(fixture, data)
+        return data
+
+    def __save(self, fixture: str, data: dict):
+        with open(f'{fixture}.tmp', 'w', encoding='utf-8') as file:
+            json.dump(data, file, ensure_ascii=False)
+        os.replace(f'{fixture}.tmp', fixture)
+
+class SharedClient:
+    """Один TMDBClient на процесс для синхронного кода: клиент живёт в фоновом потоке со своим циклом событий,
+    поэтому сессия, семафор и корзина токенов общие для всех вызовов. Поток запускается при первом вызове run."""
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.__lock = threading.Lock()
+        self.__loop: asyncio.AbstractEventLoop = None
+        self.__client: TMDBClient = None
+
+    def run(self, fn: Callable[[TMDBClient], Awaitable]):
+        """Выполняет fn(client) на общем цикле и ждёт результата. Вызывать можно из любого потока, кроме самого цикла."""
+        loop, client = self.__start()
+        return asyncio.run_coroutine_threadsafe(fn(client), loop).result()
+
+    def close(self):
+        with self.__lock:
+            if self.__loop is None:
+                return
+            asyncio.run_coroutine_threadsafe(self.__client.__aexit__(None, None, None), self.__loop).result()
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__loop, self.__client = None, None
+
+    def __start(self) -> tuple[asyncio.AbstractEventLoop, TMDBClient]:
+        with self.__lock:
+            if self.__loop is None:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=self.__serve, args=(loop,), name='tmdb-client', daemon=True).start()
+                # Сессия aiohttp создаётся внутри цикла, в котором будет работать
+                self.__client = asyncio.run_coroutine_threadsafe(self.__open(), loop).result()
+                self.__loop = loop
+            return self.__loop, self.__client
+
+    @staticmethod
+    def __serve(loop: asyncio.AbstractEventLoop):
+        loop.run_forever()
+        loop.close()
+
+    async def __open(self) -> TMDBClient:
+        return await TMDBClient(**self.kwargs).__aenter__()
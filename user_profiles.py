@@ -0,0 +1,38 @@
+"""Пересборка профилей вкуса пользователей (user_profiles) по их оценкам и избранному.
+
+Обычно профиль меняется на месте при каждой оценке и изменении избранного. Пересборка нужна один раз
+для заполнения профилей существующих пользователей, после изменения расчёта весов, а также после массовых
+правок связей фильмов: приращения считаются по признакам фильма на момент оценки.
+
+    python user_profiles.py
+    python user_profiles.py --user 123456789
+"""
+from data_provider import DataProvider, rebuild_profiles_statements
+import argparse
+
+users_query = """
+    SELECT user_id FROM movies_scores
+    UNION
+    SELECT user_id FROM favorite_movies
+    ORDER BY user_id
+"""
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--user', type=int, action='append', help='пересобрать профиль только этого пользователя')
+    parser.add_argument('--batch-size', type=int, default=500, help='сколько пользователей пересобирать одной транзакцией')
+    args = parser.parse_args()
+
+    data_provider = DataProvider(minconn=1, maxconn=1)
+    try:
+        users = args.user or [row['user_id'] for row in data_provider.db_request(users_query)]
+        for start in range(0, len(users), args.batch_size):
+            with data_provider.transaction() as cursor:
+                for statement in rebuild_profiles_statements:
+                    cursor.execute(statement, {'users': users[start:start + args.batch_size]})
+        print(f'Пересобрано профилей: {len(users)}')
+    finally:
+        data_provider.close()
+
+if __name__ == '__main__':
+    main()